@@ -0,0 +1,182 @@
+import numpy as np
+
+from shared import per_connection
+
+# Columns of the position table; the float ones are kept in NumPy arrays
+POSITION_COLUMNS = ['contract', 'symbol', 'position', 'avg_cost', 'market_price', 'market_value',
+                    'unrealized_pnl', 'realized_pnl', 'account']
+FLOAT_COLUMNS = ['position', 'avg_cost', 'market_price', 'market_value', 'unrealized_pnl', 'realized_pnl']
+
+
+class PositionTable:
+    """
+    Positions in column arrays with an index from (account, conId) to row.
+
+    Updates write into the arrays in place and closed positions are removed
+    by moving the last row into their slot, so the table never holds gaps.
+    """
+
+    def __init__(self, capacity=64):
+        self._rows = {}  # (account, conId) -> row
+        self._floats = {name: np.zeros(capacity) for name in FLOAT_COLUMNS}
+        self._objects = {name: np.empty(capacity, dtype=object) for name in ('contract', 'symbol', 'account')}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def column(self, name):
+        """View of one column over the current rows."""
+        values = self._floats.get(name)
+        if values is None:
+            values = self._objects[name]
+        return values[:len(self._rows)]
+
+    def get(self, account, con_id):
+        """Row of one position as a dict, or None."""
+        row = self._rows.get((account, con_id))
+        if row is None:
+            return None
+        return {name: self.column(name)[row] for name in POSITION_COLUMNS}
+
+    def update(self, account, contract, **values):
+        key = (account, contract.conId)
+        row = self._rows.get(key)
+        if values.get('position', 1) == 0:
+            if row is not None:
+                self._remove(key, row)
+            return
+        if row is None:
+            row = len(self._rows)
+            if row == len(self._objects['contract']):
+                self._grow()
+            self._rows[key] = row
+            for name in FLOAT_COLUMNS:
+                self._floats[name][row] = np.nan
+        self._objects['contract'][row] = contract
+        self._objects['symbol'][row] = contract.symbol
+        self._objects['account'][row] = account
+        for name, value in values.items():
+            self._floats[name][row] = value
+
+    def _remove(self, key, row):
+        last = len(self._rows) - 1
+        del self._rows[key]
+        if row != last:
+            for columns in (self._floats, self._objects):
+                for values in columns.values():
+                    values[row] = values[last]
+            moved = (self._objects['account'][row], self._objects['contract'][row].conId)
+            self._rows[moved] = row
+        for values in self._objects.values():
+            values[last] = None
+
+    def _grow(self):
+        for columns in (self._floats, self._objects):
+            for name, values in columns.items():
+                grown = np.empty(2 * len(values), dtype=values.dtype)
+                grown[:len(values)] = values
+                columns[name] = grown
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name).copy() for name in POSITION_COLUMNS})
+
+
+class AccountState:
+    """
+    Account values and positions of one connection, kept up to date from
+    IB's events.
+
+    Values are indexed by (account, tag, currency) and by (tag, currency),
+    so balance lookups are dictionary hits instead of scans over
+    ``ib.accountValues()``.
+    """
+
+    def __init__(self, ib):
+        self.ib = ib
+        self._values = {}  # (account, tag, currency) -> value
+        self._by_tag = {}  # (tag, currency) -> {account: value}
+        self.positions = PositionTable()
+        ib.accountValueEvent += self._on_account_value
+        ib.updatePortfolioEvent += self._on_portfolio
+        ib.positionEvent += self._on_position
+        for value in ib.accountValues():
+            self._on_account_value(value)
+        for position in ib.positions():
+            self._on_position(position)
+        for item in ib.portfolio():
+            self._on_portfolio(item)
+
+    @property
+    def accounts(self):
+        return sorted({account for account, _, _ in self._values})
+
+    def value(self, tag, currency='USD', account=None):
+        """
+        One account value as a float, NaN if it is not a number, or None if
+        IB has not sent it. Without an account, the value of the first
+        account that sent it, as the first match in ``ib.accountValues()``.
+        """
+        if account is not None:
+            value = self._values.get((account, tag, currency))
+            return _number(value) if value is not None else None
+        values = self._by_tag.get((tag, currency))
+        if not values:
+            return None
+        return _number(next(iter(values.values())))
+
+    def balance(self, currency='USD', account=None):
+        """Total cash balance in one currency."""
+        return self.value('TotalCashBalance', currency, account)
+
+    def balances(self, tag='TotalCashBalance', account=None):
+        """Values of one tag per currency."""
+        currencies = {currency for t, currency in self._by_tag if t == tag}
+        return {currency: self.value(tag, currency, account) for currency in sorted(currencies)}
+
+    def values_frame(self):
+        import pandas as pd
+        keys = list(self._values)
+        return pd.DataFrame({
+            'account': [k[0] for k in keys], 'tag': [k[1] for k in keys], 'currency': [k[2] for k in keys],
+            'value': list(self._values.values()),
+        })
+
+    def to_frame(self):
+        """Positions as a DataFrame with the columns of ``POSITION_COLUMNS``."""
+        return self.positions.to_frame()
+
+    def _on_account_value(self, value):
+        if value.modelCode:
+            return
+        self._values[(value.account, value.tag, value.currency)] = value.value
+        self._by_tag.setdefault((value.tag, value.currency), {})[value.account] = value.value
+
+    def _on_portfolio(self, item):
+        self.positions.update(
+            item.account, item.contract, position=item.position, avg_cost=item.averageCost,
+            market_price=item.marketPrice, market_value=item.marketValue,
+            unrealized_pnl=item.unrealizedPNL, realized_pnl=item.realizedPNL
+        )
+
+    def _on_position(self, position):
+        key = (position.account, position.contract.conId)
+        if key in self.positions:
+            self.positions.update(position.account, position.contract, position=position.position,
+                                  avg_cost=position.avgCost)
+        else:
+            self.positions.update(position.account, position.contract, position=position.position,
+                                  avg_cost=position.avgCost, market_price=np.nan, market_value=np.nan)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+account_state = per_connection(AccountState)
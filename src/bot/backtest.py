@@ -0,0 +1,297 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from bars import BAR_DTYPE, bar_store
+from indicators import sma
+from risk import calculate_pos_size
+
+# One row per parameter combination: SMA crossover lengths, stop-loss distance
+# as a fraction of the entry price and the risk per trade in percent of equity.
+PARAM_DTYPE = np.dtype([('fast', '<i4'), ('slow', '<i4'), ('stop', '<f8'), ('risk', '<f8')])
+
+INITIAL_EQUITY = 100_000.0
+COMMISSION_PER_SHARE = 0.005
+MIN_COMMISSION = 1.0
+
+
+@dataclass
+class Panel:
+    """OHLCV bars of many symbols aligned on one time axis, as (symbols, time) arrays."""
+    symbols: list
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+    valid: np.ndarray  # False where a symbol had no bar
+
+    @classmethod
+    def from_bars(cls, bars):
+        """Align a dict of symbol -> BAR_DTYPE array."""
+        symbols = list(bars)
+        times = np.unique(np.concatenate([bars[s]['time'] for s in symbols])) if symbols else np.empty(0, 'i8')
+        shape = (len(symbols), len(times))
+        columns = {name: np.full(shape, np.nan) for name in ('open', 'high', 'low', 'close', 'volume')}
+        valid = np.zeros(shape, dtype=bool)
+        for i, symbol in enumerate(symbols):
+            idx = np.searchsorted(times, bars[symbol]['time'])
+            valid[i, idx] = True
+            for name, values in columns.items():
+                values[i, idx] = bars[symbol][name]
+        # Carry prices over missing bars so positions can still be valued;
+        # bars before a symbol's first one take its first price
+        for name in ('open', 'high', 'low', 'close'):
+            columns[name] = _fill(columns[name], valid)
+        columns['volume'][~valid] = 0.0
+        return cls(symbols, times, valid=valid, **columns)
+
+    @property
+    def shape(self):
+        return self.close.shape
+
+
+def _fill(values, valid):
+    idx = np.where(valid, np.arange(values.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = np.take_along_axis(values, idx, axis=1)
+    first = np.argmax(valid, axis=1)
+    leading = np.arange(values.shape[1]) < first[:, None]
+    return np.where(leading, values[np.arange(len(values)), first][:, None], filled)
+
+
+def load_store(symbols, bar_size='1 day', what_to_show='TRADES', start=None, end=None):
+    """Bars saved in the local bar store by earlier IB history requests."""
+    store = bar_store()
+    bars = {symbol: np.array(store.read(symbol, bar_size, what_to_show, start, end)) for symbol in symbols}
+    missing = [symbol for symbol, b in bars.items() if not len(b)]
+    if missing:
+        raise ValueError(f"No stored {bar_size} bars for {', '.join(missing)}.")
+    return bars
+
+
+def load_csv(path):
+    """
+    Bars from a CSV file with date, open, high, low, close and volume columns,
+    such as a Yahoo Finance export or a saved ``to_frame`` dump.
+    """
+    import pandas as pd
+    df = pd.read_csv(path)
+    df.columns = [c.strip().lower() for c in df.columns]
+    dates = pd.to_datetime(df.pop('date' if 'date' in df else df.columns[0]), utc=True)
+    bars = np.empty(len(df), dtype=BAR_DTYPE)
+    bars['time'] = dates.dt.as_unit('s').astype('int64').to_numpy()
+    for name in ('open', 'high', 'low', 'close', 'volume'):
+        bars[name] = df[name].to_numpy(dtype=float) if name in df else 0.0
+    return np.sort(bars, order='time')
+
+
+def param_grid(fast, slow, stop, risk):
+    """Every combination of the given values where the fast average is shorter than the slow one."""
+    mesh = np.meshgrid(np.asarray(fast), np.asarray(slow), np.asarray(stop), np.asarray(risk), indexing='ij')
+    grid = np.empty(mesh[0].size, dtype=PARAM_DTYPE)
+    for name, values in zip(PARAM_DTYPE.names, mesh):
+        grid[name] = values.ravel()
+    grid = grid[grid['fast'] < grid['slow']]
+    if not len(grid):
+        raise ValueError("No parameter combinations with fast < slow.")
+    if np.any(grid['stop'] <= 0) or np.any(grid['stop'] >= 1):
+        raise ValueError("Stop-loss distance must be between 0 and 1.")
+    return grid
+
+
+def _commission(shares):
+    return np.where(shares > 0, np.maximum(MIN_COMMISSION, shares * COMMISSION_PER_SHARE), 0.0)
+
+
+def simulate(panel, params, equity=INITIAL_EQUITY):
+    """
+    Run an SMA crossover strategy with a stop loss for every parameter
+    combination and symbol at once.
+
+    Signals are taken at the close and traded at the next open. A position
+    is sized so that hitting its stop loses ``risk`` percent of equity,
+    capped at an equal share of equity per symbol, and is closed when the
+    fast average falls below the slow one or the stop is hit.
+    Returns the metrics of each combination.
+    """
+    n_symbols, n_times = panel.shape
+    n_params = len(params)
+    lengths, index = np.unique(np.concatenate([params['fast'], params['slow']]), return_inverse=True)
+    fast_idx, slow_idx = index[:n_params], index[n_params:]
+    averages = np.stack([sma(panel.close, n) for n in lengths])  # (lengths, symbols, time)
+    stop = params['stop'][:, None]
+    risk = params['risk'][:, None]
+
+    cash = np.full(n_params, float(equity))
+    shares = np.zeros((n_params, n_symbols))
+    stop_price = np.zeros((n_params, n_symbols))
+    enter = np.zeros((n_params, n_symbols), dtype=bool)
+    above = np.zeros((n_params, n_symbols), dtype=bool)
+    curve = np.empty((n_params, n_times))
+    curve[:, 0] = equity
+    traded = np.zeros(n_params)
+    trades = np.zeros(n_params, dtype=int)
+
+    for t in range(1, n_times):
+        open_, low, close = panel.open[:, t], panel.low[:, t], panel.close[:, t]
+        # A bar without a usable open is skipped, as if the symbol had no bar that day
+        valid = panel.valid[:, t] & (open_ > 0)
+        price = np.where(valid, open_, np.nan)
+
+        # Orders from yesterday's signals fill at today's open
+        fast, slow = averages[fast_idx, :, t - 1], averages[slow_idx, :, t - 1]
+        exit_ = (shares > 0) & ~(fast > slow) & valid
+        proceeds = np.where(exit_, shares * open_, 0.0)
+        cash += (proceeds - _commission(np.where(exit_, shares, 0))).sum(axis=1)
+        traded += proceeds.sum(axis=1)
+        shares[exit_] = 0
+
+        entry = enter & (shares == 0) & valid
+        if entry.any():
+            level = curve[:, t - 1][:, None]
+            entry_stop = price * (1 - stop)
+            size = calculate_pos_size(level, risk, price, entry_stop)
+            size = np.floor(np.minimum(size, level / n_symbols / price))
+            size = np.where(entry, size, 0)
+            cost = np.where(entry, size * open_, 0.0)
+            cash -= (cost + _commission(size)).sum(axis=1)
+            traded += cost.sum(axis=1)
+            trades += (size > 0).sum(axis=1)
+            shares += size
+            stop_price = np.where(size > 0, entry_stop, stop_price)
+
+        # Stops trigger intrabar, at the stop or at the open if it gapped through
+        hit = (shares > 0) & valid & (low <= stop_price)
+        if hit.any():
+            proceeds = np.where(hit, shares * np.minimum(open_, stop_price), 0.0)
+            cash += (proceeds - _commission(np.where(hit, shares, 0))).sum(axis=1)
+            traded += proceeds.sum(axis=1)
+            shares[hit] = 0
+
+        curve[:, t] = cash + shares @ close
+
+        # Enter on the close where the fast average crosses above the slow one
+        fast, slow = averages[fast_idx, :, t], averages[slow_idx, :, t]
+        crossed = fast > slow
+        enter = crossed & ~above & ~np.isnan(averages[slow_idx, :, t - 1]) & valid
+        above = crossed
+
+    peak = np.maximum.accumulate(curve, axis=1)
+    return {
+        'pnl': curve[:, -1] - equity,
+        'return': (curve[:, -1] / equity - 1) * 100,
+        'max_drawdown': ((peak - curve) / peak).max(axis=1) * 100,
+        'turnover': traded / curve.mean(axis=1),
+        'trades': trades,
+    }
+
+
+_panel = None
+
+
+def _init_worker(panel):
+    global _panel
+    _panel = panel
+
+
+def _simulate_chunk(params):
+    return simulate(_panel, params)
+
+
+@dataclass
+class BacktestResult:
+    symbols: list
+    params: np.ndarray
+    metrics: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+    by: str = 'pnl'  # default ranking of best() and report()
+    top: int = 10
+
+    def best(self, by=None, top=None):
+        by, top = by or self.by, top or self.top
+        if by not in self.metrics:
+            raise ValueError(f"Cannot sort by {by}. Use one of {', '.join(self.metrics)}.")
+        order = np.argsort(self.metrics[by])
+        return order[::-1][:top] if by != 'max_drawdown' else order[:top]
+
+    def rows(self, by=None, top=None):
+        """Parameters and metrics of the best combinations as dicts."""
+        return [
+            dict(zip(PARAM_DTYPE.names, self.params[i].tolist()),
+                 **{name: values[i].item() for name, values in self.metrics.items()})
+            for i in self.best(by, top)
+        ]
+
+    def to_json(self):
+        return {'symbols': self.symbols, 'combinations': len(self.params), 'elapsed': self.elapsed,
+                'by': self.by, 'best': self.rows()}
+
+    def report(self, by=None, top=None):
+        lines = [f"{'fast':>5}{'slow':>6}{'stop%':>7}{'risk%':>7}{'P&L':>13}{'return%':>9}"
+                 f"{'maxDD%':>8}{'turnover':>10}{'trades':>8}"]
+        for i in self.best(by, top):
+            p, m = self.params[i], {name: values[i] for name, values in self.metrics.items()}
+            lines.append(
+                f"{p['fast']:>5}{p['slow']:>6}{p['stop'] * 100:>7.1f}{p['risk']:>7.2f}{m['pnl']:>13,.2f}"
+                f"{m['return']:>9.2f}{m['max_drawdown']:>8.2f}{m['turnover']:>10.2f}{m['trades']:>8}"
+            )
+        rate = f" ({len(self.params) / self.elapsed:,.0f} combinations/s)" if self.elapsed > 0 else ""
+        lines.append(f"{len(self.params)} parameter combinations over {len(self.symbols)} symbols "
+                     f"in {self.elapsed:.2f}s{rate}")
+        return "\n".join(lines)
+
+
+def sweep(panel, grid, workers=None, chunk_size=256):
+    """Simulate every parameter combination, spreading chunks of the grid over a process pool."""
+    start = time.perf_counter()
+    chunks = [grid[i:i + chunk_size] for i in range(0, len(grid), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        results = [simulate(panel, chunk) for chunk in chunks]
+    else:
+        # Spawned workers: the sweep runs from threads of the CLI's event loop, which a fork would copy mid-flight
+        with ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'), initializer=_init_worker,
+                                 initargs=(panel,)) as pool:
+            results = list(pool.map(_simulate_chunk, chunks))
+    metrics = {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+    return BacktestResult(panel.symbols, grid, metrics, time.perf_counter() - start)
+
+
+def parse_values(text, kind=float):
+    """Parse ``5:50:5`` (inclusive range) or ``0.02,0.05`` into an array."""
+    if ':' in text:
+        start, stop, step = (kind(x) for x in (text.split(':') + ['1'])[:3])
+        if step <= 0:
+            raise ValueError(f"The step of {text} must be positive.")
+        return np.arange(start, stop + step / 2, step).astype(kind)
+    return np.array([kind(x) for x in text.split(',')])
+
+
+def load_inputs(ib, inputs, duration='5 Y', bar_size='1 day'):
+    """Bars for each input: a CSV file, or a symbol brought up to date in the bar store."""
+    return ib.run(load_inputs_async(ib, inputs, duration, bar_size))
+
+
+async def load_inputs_async(ib, inputs, duration='5 Y', bar_size='1 day'):
+    bars = {}
+    symbols = []
+    for item in inputs:
+        if Path(item).suffix.lower() == '.csv':
+            bars[Path(item).stem.upper()] = load_csv(item)
+        else:
+            symbols.append(item.upper())
+    store = bar_store()
+    results = await asyncio.gather(
+        *(store.ensure_async(ib, symbol, duration, bar_size, what_to_show='TRADES') for symbol in symbols)
+    )
+    for symbol, symbol_bars in zip(symbols, results):
+        bars[symbol] = np.array(symbol_bars)
+    return bars
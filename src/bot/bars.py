@@ -0,0 +1,264 @@
+import datetime
+import json
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from contracts import contract_registry, registry_key
+from pacing import history_class, request_scheduler
+from settings import file_lock
+
+BARS_DIR = Path(__file__).resolve().parent / 'bars'
+
+BAR_DTYPE = np.dtype([
+    ('time', '<i8'),  # bar start, seconds since the epoch (UTC)
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+
+DURATION_UNITS = {'S': 1, 'D': 86400, 'W': 7 * 86400, 'M': 30 * 86400, 'Y': 365 * 86400}
+BAR_SIZE_UNITS = {'sec': 1, 'min': 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400}
+YF_INTERVALS = {'1 min': '1m', '2 mins': '2m', '5 mins': '5m', '15 mins': '15m', '30 mins': '30m',
+                '1 hour': '1h', '1 day': '1d', '1 week': '1wk', '1 month': '1mo'}
+
+
+class BarsUnavailable(RuntimeError):
+    """Neither IB nor Yahoo Finance returned bars for a window with nothing stored."""
+
+
+def duration_seconds(duration):
+    """Length in seconds of an IB duration string such as ``'5 Y'``."""
+    count, unit = duration.split()
+    return int(count) * DURATION_UNITS[unit.upper()]
+
+
+def duration_str(seconds, bar_size='1 min'):
+    """Smallest IB duration string covering ``seconds`` that is valid for the bar size."""
+    if seconds <= 86400 and bar_seconds(bar_size) < 86400:
+        return f"{max(int(math.ceil(seconds)), 60)} S"
+    days = int(math.ceil(seconds / 86400))
+    if days <= 365:
+        return f"{days} D"
+    return f"{int(math.ceil(days / 365))} Y"
+
+
+def bar_seconds(bar_size):
+    """Length in seconds of an IB bar size such as ``'5 mins'``."""
+    count, unit = bar_size.split()
+    return int(count) * BAR_SIZE_UNITS[unit.rstrip('s')]
+
+
+def to_epoch(date):
+    if isinstance(date, datetime.datetime):
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return int(date.timestamp())
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+
+
+def bars_to_array(bars):
+    """Convert ib_insync BarData objects to a BAR_DTYPE array."""
+    array = np.empty(len(bars), dtype=BAR_DTYPE)
+    for i, bar in enumerate(bars):
+        array[i] = (to_epoch(bar.date), bar.open, bar.high, bar.low, bar.close, bar.volume)
+    return array
+
+
+def to_frame(bars):
+    """Copy a BAR_DTYPE array into a DataFrame with a UTC ``date`` column."""
+    import pandas as pd
+    df = pd.DataFrame(bars)
+    df.insert(0, 'date', pd.to_datetime(df.pop('time'), unit='s', utc=True))
+    return df
+
+
+class BarStore:
+    """
+    Historical bars on disk, one fixed-width file per symbol/barSize/whatToShow.
+
+    Reads return slices of a memory map of the file, so charts and
+    indicators share the stored arrays without copying them.
+    """
+
+    def __init__(self, root=BARS_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, symbol, bar_size, what_to_show):
+        return self.root / f"{symbol}_{bar_size.replace(' ', '')}_{what_to_show}.bin"
+
+    def read(self, symbol, bar_size='1 day', what_to_show='TRADES', start=None, end=None):
+        """Return the stored bars with ``start <= time < end`` (epoch seconds)."""
+        path = self._path(symbol, bar_size, what_to_show)
+        try:
+            # Whole records only: another process may be appending right now
+            count = path.stat().st_size // BAR_DTYPE.itemsize
+        except FileNotFoundError:
+            count = 0
+        if not count:
+            return np.empty(0, dtype=BAR_DTYPE)
+        bars = np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(count,))
+        lo = 0 if start is None else np.searchsorted(bars['time'], start, side='left')
+        hi = len(bars) if end is None else np.searchsorted(bars['time'], end, side='left')
+        return bars[lo:hi]
+
+    def write(self, symbol, bar_size, what_to_show, bars):
+        """Merge bars into the store; newer values win for bars with the same time."""
+        if not len(bars):
+            return
+        path = self._path(symbol, bar_size, what_to_show)
+        # The CLI, the connection service and the dashboard share the store
+        with file_lock(path):
+            stored = self.read(symbol, bar_size, what_to_show)
+            if not len(stored) or bars['time'][0] > stored['time'][-1]:
+                # Common case: new bars at the tail, so just append them
+                with open(path, 'ab') as f:
+                    f.write(np.ascontiguousarray(bars, dtype=BAR_DTYPE).tobytes())
+                return
+
+            merged = np.concatenate([bars, stored])
+            _, first = np.unique(merged['time'], return_index=True)
+            self._replace(path, merged[first].tobytes())
+
+    def coverage(self, symbol, bar_size, what_to_show):
+        """Time range (start, end) that has already been fetched for this key."""
+        path = self._path(symbol, bar_size, what_to_show).with_suffix('.json')
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return meta['start'], meta['end']
+
+    def _set_coverage(self, symbol, bar_size, what_to_show, start, end):
+        path = self._path(symbol, bar_size, what_to_show).with_suffix('.json')
+        with file_lock(path):
+            self._replace(path, json.dumps({'start': start, 'end': end}).encode())
+
+    @staticmethod
+    def _replace(path, data):
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def ensure(self, ib, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """Blocking wrapper around ``ensure_async``."""
+        return ib.run(self.ensure_async(ib, symbol, duration, bar_size, what_to_show, use_rth))
+
+    async def ensure_async(self, ib, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """
+        Return the bars for the last ``duration``, fetching only the parts
+        of the window that are not in the store yet.
+        """
+        now = int(time.time())
+        start = now - duration_seconds(duration)
+        step = bar_seconds(bar_size)
+        covered = self.coverage(symbol, bar_size, what_to_show)
+
+        if covered is None:
+            gaps = [(start, now)]
+        else:
+            gaps = []
+            if start < covered[0]:
+                gaps.append((start, covered[0]))
+            if now - covered[1] >= step:
+                # Re-fetch from the last stored bar, which may have been incomplete
+                stored = self.read(symbol, bar_size, what_to_show)
+                tail = int(stored['time'][-1]) if len(stored) else covered[1]
+                gaps.append((min(tail, covered[1]), now))
+
+        new_start, new_end = covered if covered is not None else (None, None)
+        errors = []
+        for gap_start, gap_end in gaps:
+            bars, error = await self._fetch(ib, symbol, gap_start, gap_end, bar_size, what_to_show, use_rth)
+            if not len(bars):
+                # Nothing came back, e.g. IB and Yahoo were both unavailable: the gap is asked for again next time
+                if error is not None:
+                    errors.append(error)
+                continue
+            self.write(symbol, bar_size, what_to_show, bars)
+            new_start = gap_start if new_start is None else min(new_start, gap_start)
+            new_end = gap_end if new_end is None else max(new_end, gap_end)
+        if (new_start, new_end) != (covered or (None, None)):
+            self._set_coverage(symbol, bar_size, what_to_show, new_start, new_end)
+
+        bars = self.read(symbol, bar_size, what_to_show, start=start)
+        if not len(bars) and errors:
+            raise BarsUnavailable(f"No bars for {symbol}: {errors[0]}") from errors[0]
+        return bars
+
+    async def _fetch(self, ib, symbol, start, end, bar_size, what_to_show, use_rth):
+        """Bars of a range from IB, else from Yahoo Finance, and the error IB raised if it did."""
+        error = None
+        try:
+            contract = (await contract_registry(ib).resolve_async([symbol]))[registry_key(symbol)].contract
+            # An empty end time asks IB for bars up to now
+            end_dt = '' if end >= time.time() - 60 else datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+            duration = duration_str(end - start, bar_size)
+            # Paced to IB's historical data limits; an identical request shortly after gets the same bars
+            bars = await request_scheduler(ib).run(
+                history_class(bar_size), (contract.conId, str(end_dt), duration, bar_size, what_to_show, use_rth),
+                lambda: ib.reqHistoricalDataAsync(
+                    contract,
+                    endDateTime=end_dt,
+                    durationStr=duration,
+                    barSizeSetting=bar_size,
+                    whatToShow=what_to_show,
+                    useRTH=use_rth,
+                    formatDate=2
+                )
+            )
+            if bars:
+                return bars_to_array(bars), None
+        except Exception as e:
+            error = e
+        return fetch_yfinance(symbol, start, end, bar_size), error
+
+
+def fetch_yfinance(symbol, start, end, bar_size):
+    """Fetch bars from Yahoo Finance as a BAR_DTYPE array; none when yfinance is not installed."""
+    try:
+        import yfinance as yf
+    except ImportError:
+        return np.empty(0, dtype=BAR_DTYPE)
+    df = yf.Ticker(symbol).history(
+        start=datetime.datetime.fromtimestamp(start, datetime.timezone.utc),
+        end=datetime.datetime.fromtimestamp(end, datetime.timezone.utc),
+        interval=YF_INTERVALS.get(bar_size, '1d')
+    )
+    array = np.empty(len(df), dtype=BAR_DTYPE)
+    array['time'] = df.index.tz_convert('UTC').normalize().asi8 // 10**9 if bar_size.endswith('day') \
+        else df.index.tz_convert('UTC').asi8 // 10**9
+    for column in ('open', 'high', 'low', 'close', 'volume'):
+        array[column] = df[column.capitalize()].to_numpy()
+    return array
+
+
+_store = None
+
+
+def bar_store():
+    """Return the process-wide bar store."""
+    global _store
+    if _store is None:
+        _store = BarStore()
+    return _store
+
+
+def set_bar_store(store):
+    """Use ``store`` as the process-wide bar store; None goes back to the default one on next use."""
+    global _store
+    _store = store
+    return store
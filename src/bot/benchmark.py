@@ -0,0 +1,133 @@
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from bars import BarStore, set_bar_store
+from contracts import ContractRegistry, set_contract_registry
+from ib_insync import util
+from orders import Leg, submit_batch
+from simulator import FILL_MODELS, SimConfig, SimIB
+from utils import get_real_time_price
+
+# The page loaders live with the dashboard
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'visualizer'))
+
+SYMBOLS = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'AMD', 'NFLX', 'INTC',
+           'ORCL', 'CRM', 'ADBE', 'QCOM', 'AVGO', 'TXN', 'CSCO', 'IBM', 'PYPL', 'SHOP']
+
+
+class Stats:
+    """Latency samples of one benchmark, in seconds."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.elapsed = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def row(self):
+        if not self.samples:
+            return f"{self.name:<28}{'no samples':>10}"
+        p50, p99 = np.percentile(self.samples, [50, 99]) * 1000
+        rate = len(self.samples) / self.elapsed if self.elapsed else 0.0
+        return f"{self.name:<28}{len(self.samples):>6}{p50:>10.1f} ms{p99:>10.1f} ms{rate:>10.1f}/s"
+
+
+def connect(config, root):
+    """Connect a simulated session whose contract and bar stores live under ``root``."""
+    ib = SimIB(config=config)
+    ib.connect('127.0.0.1', 4002, clientId=1)
+    # Start from empty caches so every run measures the same work
+    set_contract_registry(ib, ContractRegistry(ib, path=str(Path(root) / 'contracts.json')))
+    set_bar_store(BarStore(Path(root) / 'bars'))
+    return ib
+
+
+def bench_quotes(config, symbols, runs):
+    cold, warm = Stats("quote fetch (cold)"), Stats("quote fetch (warm)")
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as root:
+            ib = connect(config, root)
+            for stats in (cold, warm):
+                start = time.perf_counter()
+                for symbol in symbols:
+                    t = time.perf_counter()
+                    get_real_time_price(ib, symbol)
+                    stats.add(time.perf_counter() - t)
+                stats.elapsed += time.perf_counter() - start
+            ib.disconnect()
+    return [cold, warm]
+
+
+def bench_orders(config, symbols, legs, runs):
+    acks = Stats(f"batch orders ({legs} legs)")
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as root:
+            ib = connect(config, root)
+            # Limit prices away from the market so the orders rest
+            prices = {s: get_real_time_price(ib, s) for s in symbols}
+            batch = [Leg(symbols[i % len(symbols)], 1, round(prices[symbols[i % len(symbols)]] * 0.9, 2))
+                     for i in range(legs)]
+            result = submit_batch(ib, batch)
+            for r in result.acknowledged:
+                acks.add(r.latency)
+            acks.elapsed += result.elapsed
+            ib.disconnect()
+    return [acks]
+
+
+def bench_page(config, symbols, runs):
+    from app.portfolio import load_histories_async, load_positions_async
+
+    cold, warm = Stats("page data load (cold)"), Stats("page data load (warm)")
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as root:
+            ib = connect(config, root)
+            for stats in (cold, warm):
+                start = time.perf_counter()
+                portfolio_df, _ = ib.run(load_positions_async(ib))
+                ib.run(load_histories_async(ib, list(portfolio_df['symbol'])))
+                stats.add(time.perf_counter() - start)
+                stats.elapsed += time.perf_counter() - start
+            ib.disconnect()
+    return [cold, warm]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency benchmarks against the simulated IB Gateway.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Gateway response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.005, help="Random extra latency in seconds")
+    parser.add_argument('--symbols', type=int, default=10, help="Number of symbols to quote and hold")
+    parser.add_argument('--legs', type=int, default=50, help="Legs per order batch")
+    parser.add_argument('--runs', type=int, default=5, help="Runs per benchmark, each on a fresh session")
+    parser.add_argument('--fill-model', choices=FILL_MODELS, default='touch')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    util.logToConsole(level=40)
+    symbols = SYMBOLS[:args.symbols]
+    config = SimConfig(
+        latency=args.latency, jitter=args.jitter, seed=args.seed, fill_model=args.fill_model,
+        positions={symbol: (10, 100.0) for symbol in symbols}
+    )
+
+    results = []
+    results += bench_quotes(config, symbols, args.runs)
+    results += bench_orders(config, symbols, args.legs, args.runs)
+    results += bench_page(config, symbols, args.runs)
+
+    print(f"Simulated gateway: latency {args.latency * 1000:.0f} ms, jitter {args.jitter * 1000:.0f} ms, "
+          f"{len(symbols)} symbols, {args.runs} runs")
+    print(f"{'benchmark':<28}{'n':>6}{'p50':>13}{'p99':>13}{'throughput':>12}")
+    for stats in results:
+        print(stats.row())
+
+
+if __name__ == "__main__":
+    main()
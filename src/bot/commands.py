@@ -0,0 +1,715 @@
+import asyncio
+import dataclasses
+import datetime
+import math
+import re
+import shlex
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from metrics import command_profiler, metrics
+
+# Handlers import the trading modules on first run, so 'help' and offline commands never load ib_insync
+
+# Exit codes of a CLI run: the highest code of its commands
+EXIT_OK = 0
+EXIT_FAILED = 1  # a command raised an error
+EXIT_USAGE = 2  # unknown command or bad arguments
+EXIT_CONNECTION = 3  # could not reach IB Gateway or the connection service
+
+
+class UsageError(ValueError):
+    """Unknown command or arguments that do not match its usage."""
+
+
+# Set by sessions that outlive their commands; a script's client-side trailing stops would die with it
+_persistent = False
+
+
+def set_persistent_session(persistent=True):
+    """Mark this process as one that keeps running after the commands it was given."""
+    global _persistent
+    _persistent = persistent
+
+
+@dataclass
+class Command:
+    name: str
+    handler: object  # async (ib, args) -> result
+    usage: str
+    help: str
+    format: object = str  # result -> text shown to the user
+    serial: bool = False  # places or changes orders, so it runs alone in script order
+    offline: object = False  # needs no connection: True, or (args) -> bool
+
+    def runs_offline(self, args):
+        return self.offline(args) if callable(self.offline) else self.offline
+
+
+COMMANDS = {}
+
+
+def command(name, usage, help, format=str, serial=False, offline=False):
+    """Register an async handler as a CLI command."""
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, usage, help, format, serial, offline)
+        return handler
+    return register
+
+
+@dataclass
+class CommandResult:
+    line: str
+    code: int = EXIT_OK
+    result: object = None
+    text: str = ''
+    error: str = ''
+    elapsed: float = 0.0
+
+    @property
+    def ok(self):
+        return self.code == EXIT_OK
+
+    def to_dict(self):
+        return {'line': self.line, 'code': self.code, 'result': jsonable(self.result), 'text': self.text,
+                'error': self.error, 'elapsed': self.elapsed}
+
+
+def jsonable(value):
+    """Convert a command result into plain JSON types."""
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    # Only the commands that loaded numpy can return its types
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(value, np.generic):
+        return jsonable(value.item())
+    if np is not None and isinstance(value, np.ndarray):
+        if value.dtype.names:
+            return [dict(zip(value.dtype.names, map(jsonable, row))) for row in value.tolist()]
+        return [jsonable(v) for v in value.tolist()]
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if hasattr(value, 'to_dict') and hasattr(value, 'columns'):
+        return [{k: jsonable(v) for k, v in row.items()} for row in value.to_dict(orient='records')]
+    if hasattr(value, 'to_json'):
+        return jsonable(value.to_json())
+    if dataclasses.is_dataclass(value):
+        return {f.name: jsonable(getattr(value, f.name)) for f in dataclasses.fields(value)}
+    return str(value)
+
+
+def split_line(line):
+    """Tokens of one command line; ``#`` starts a comment."""
+    return shlex.split(line, comments=True)
+
+
+def script_lines(lines):
+    """Command lines of a script, without blanks and comments, up to an ``exit``."""
+    for line in lines:
+        tokens = split_line(line)
+        if not tokens:
+            continue
+        if tokens[0] == 'exit':
+            return
+        yield line.strip()
+
+
+def needs_connection(line):
+    """Whether running the line needs IB Gateway; unknown commands fail without it."""
+    tokens = split_line(line)
+    cmd = COMMANDS.get(tokens[0]) if tokens else None
+    return cmd is not None and not cmd.runs_offline(tokens[1:])
+
+
+async def run_line_async(ib, line):
+    """
+    Run one command line, turning errors into a failed result. ``ib`` is
+    either connected already or a coroutine function returning the
+    connection, awaited only by commands that need it.
+    """
+    start = time.perf_counter()
+    result = CommandResult(line)
+    name = 'invalid'
+    profiler = command_profiler()
+    profile = profiler.start() if profiler else None
+    try:
+        tokens = split_line(line)
+        cmd = COMMANDS.get(tokens[0]) if tokens else None
+        if cmd is None:
+            raise UsageError("Invalid command. Type 'help' to see available commands.")
+        name = cmd.name
+        args = tokens[1:]
+        if cmd.runs_offline(args):
+            ib = None
+        elif callable(ib):
+            ib = await ib()
+        result.result = await cmd.handler(ib, args)
+        result.text = cmd.format(result.result)
+    except UsageError as e:
+        result.code, result.error = EXIT_USAGE, str(e)
+    except ConnectionError as e:
+        result.code, result.error = EXIT_CONNECTION, str(e) or repr(e)
+    except Exception as e:
+        result.code, result.error = EXIT_FAILED, str(e) or repr(e)
+    result.elapsed = time.perf_counter() - start
+    if profile is not None:
+        profiler.stop(profile, name, result.elapsed)
+    m = metrics()
+    m.commands.observe(result.elapsed, name)
+    if not result.ok:
+        m.command_errors.inc(name, str(result.code))
+    return result
+
+
+async def run_script_async(ib, lines, emit=None):
+    """
+    Run command lines on one connection. Commands that only read run
+    concurrently; a command that places or changes orders waits for the
+    ones before it and runs alone. Results are passed to ``emit`` and
+    returned in script order.
+    """
+    results = []
+    pending = []
+
+    async def drain():
+        for task in pending:
+            result = await task
+            results.append(result)
+            if emit:
+                emit(result)
+        pending.clear()
+
+    for line in script_lines(lines):
+        tokens = split_line(line)
+        cmd = COMMANDS.get(tokens[0])
+        if cmd is not None and cmd.serial:
+            await drain()
+            pending.append(asyncio.ensure_future(run_line_async(ib, line)))
+            await drain()
+        else:
+            pending.append(asyncio.ensure_future(run_line_async(ib, line)))
+    await drain()
+    return results
+
+
+def exit_code(results):
+    return max((r.code for r in results), default=EXIT_OK)
+
+
+def help_text():
+    lines = ["", "Available Commands:"]
+    for cmd in COMMANDS.values():
+        first, *rest = cmd.help.split('\n')
+        lines.append(f"  {cmd.usage:<56} - {first}" if len(cmd.usage) <= 56 else f"  {cmd.usage}\n{'':<58}- {first}")
+        lines.extend(f"{'':<60}{line}" for line in rest)
+    lines.append(f"  {'exit':<56} - Exit the CLI")
+    return "\n".join(lines)
+
+
+def _args(args, count, usage):
+    if len(args) != count:
+        raise UsageError(f"Usage: {usage}")
+    return args
+
+
+def _int(text, name):
+    """An integer argument; a malformed one is a usage error rather than a failed command."""
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        raise UsageError(f"Invalid {name}: {text}") from None
+
+
+def _float(text, name):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        raise UsageError(f"Invalid {name}: {text}") from None
+
+
+def _trail(text):
+    from orders import parse_trail
+    try:
+        return parse_trail(text)
+    except ValueError:
+        raise UsageError(f"Invalid trail: {text}. Use a positive amount or percent, e.g. 1.5 or 2%") from None
+
+
+def read_legs(tokens):
+    """Legs from inline <symbol,quantity,price,action[,stop]> tokens and CSV/JSON files, skipping bad ones."""
+    from orders import load_legs, parse_leg
+    legs = []
+    for token in tokens:
+        try:
+            if Path(token).suffix.lower() in {".csv", ".json"}:
+                legs.extend(load_legs(token))
+            else:
+                legs.append(parse_leg(token))
+        except (ValueError, KeyError, OSError) as e:
+            # Not on stdout, which may carry the JSON results
+            print(f"{e} Skipping...", file=sys.stderr)
+    return legs
+
+
+@command("fetch_balance", "fetch_balance", "Fetch account balance",
+         format=lambda balance: f"Account balance: {balance}")
+async def _fetch_balance(ib, args):
+    _args(args, 0, "fetch_balance")
+    from utils import fetch_account_balance
+    return fetch_account_balance(ib)
+
+
+@command("is_market_open", "is_market_open <symbol>", "Check if the market is open for a specific symbol",
+         format=lambda status: f"Market is {status.summary()}")
+async def _is_market_open(ib, args):
+    symbol, = _args(args, 1, "is_market_open <symbol>")
+    from utils import is_market_open_async
+    return await is_market_open_async(ib, symbol)
+
+
+def _format_positions(positions):
+    return "No positions." if positions.empty else positions.drop(columns='contract').to_string(index=False)
+
+
+@command("fetch_positions", "fetch_positions", "Fetch all current positions", format=_format_positions)
+async def _fetch_positions(ib, args):
+    _args(args, 0, "fetch_positions")
+    from utils import fetch_positions_frame
+    return fetch_positions_frame(ib)
+
+
+@command("get_price", "get_price <symbol>", "Get real-time stock price (e.g., get_price AAPL)",
+         format=lambda quote: f"Real-time price for {quote['symbol']}: {quote['price']}")
+async def _get_price(ib, args):
+    symbol, = _args(args, 1, "get_price <symbol>")
+    from utils import get_real_time_price_async
+    return {'symbol': symbol, 'price': await get_real_time_price_async(ib, symbol)}
+
+
+def _format_bars(bars):
+    from bars import to_frame
+    return str(to_frame(bars))
+
+
+@command("fetch_historical", "fetch_historical <symbol>", "Fetch historical data for a symbol", format=_format_bars)
+async def _fetch_historical(ib, args):
+    symbol, = _args(args, 1, "fetch_historical <symbol>")
+    from utils import fetch_historical_data_async
+    return await fetch_historical_data_async(ib, symbol)
+
+
+@command("bid_ask_spread", "bid_ask_spread <symbol>", "Get bid-ask spread (e.g., bid_ask_spread AAPL)",
+         format=lambda spread: f"Bid-Ask Spread for {spread['symbol']}: {spread}" if spread else "")
+async def _bid_ask_spread(ib, args):
+    symbol, = _args(args, 1, "bid_ask_spread <symbol>")
+    from utils import bid_ask_spread_async
+    return await bid_ask_spread_async(ib, symbol)
+
+
+def _format_trade(kind):
+    return lambda trade: f"{kind} placed. Status: {trade.orderStatus.status} OrderId: {trade.order.orderId}"
+
+
+@command("place_limit_order", "place_limit_order <symbol> <quantity> <price> <action>",
+         "Place a limit order (e.g., place_limit_order AAPL 10 150.0 BUY)",
+         format=_format_trade("Limit order"), serial=True)
+async def _place_limit_order(ib, args):
+    symbol, quantity, price, action = _args(args, 4, "place_limit_order <symbol> <quantity> <price> <action>")
+    from utils import place_limit_order_async
+    return await place_limit_order_async(ib, symbol, _int(quantity, 'quantity'), _float(price, 'price'), action)
+
+
+@command("place_market_order", "place_market_order <symbol> <quantity> <action>",
+         "Place a market order (e.g., place_market_order AAPL 10 BUY)",
+         format=_format_trade("Market order"), serial=True)
+async def _place_market_order(ib, args):
+    symbol, quantity, action = _args(args, 3, "place_market_order <symbol> <quantity> <action>")
+    from utils import place_market_order_async
+    return await place_market_order_async(ib, symbol, _int(quantity, 'quantity'), action)
+
+
+@command("place_batch_orders", "place_batch_orders <symbol,quantity,price,action> ...",
+         "Place multiple limit orders as a batch (e.g., AAPL,10,150.0,BUY TSLA,5,700.0,SELL)\n"
+         "or a batch read from <legs.csv|legs.json>. Legs may end with a planned stop\n"
+         "(AAPL,10,150.0,BUY,145.0); legs failing the risk checks are rejected before sending",
+         format=lambda result: result.report(), serial=True)
+async def _place_batch_orders(ib, args):
+    legs = read_legs(args)
+    if not legs:
+        raise UsageError("No valid orders to place. Format: <symbol,quantity,price,action> "
+                         "(e.g., AAPL,10,150.0,BUY TSLA,5,700.0,SELL) or <file.csv|file.json>")
+    from orders import submit_batch_async
+    from risk import configured_limits
+    return await submit_batch_async(ib, legs, limits=configured_limits())
+
+
+@command("broadcast_batch", "broadcast_batch <symbol,quantity,price,action[,stop]> ...",
+         "Place the same batch on every gateway in gateways.json, scaled per gateway",
+         format=lambda result: result.report(lambda batch: batch.report()), serial=True)
+async def _broadcast_batch(ib, args):
+    legs = read_legs(args)
+    if not legs:
+        raise UsageError("Usage: broadcast_batch <symbol,quantity,price,action[,stop]> ... or <file.csv|file.json>")
+    from fanout import gateway_fanout
+    from risk import configured_limits
+    fan = gateway_fanout()
+    await fan.connect_async()
+    return await fan.broadcast_async(legs, limits=configured_limits())
+
+
+def _format_gateways(view):
+    balances = ", ".join(f"{name} {value:,.2f}" for name, value in view['net_liquidation'].items())
+    return f"{_format_positions(view['positions'])}\nNet liquidation: {balances}"
+
+
+@command("combined_positions", "combined_positions", "Positions and net liquidation of all gateways combined",
+         format=_format_gateways)
+async def _combined_positions(ib, args):
+    _args(args, 0, "combined_positions")
+    from fanout import combine_positions, gateway_fanout
+    fan = gateway_fanout()
+    connected = await fan.connect_async()
+    for name, error in connected.errors.items():
+        print(f"Gateway {name} is not connected: {error}", file=sys.stderr)
+    return {'positions': combine_positions(fan.positions_frame()), 'net_liquidation': fan.balances()}
+
+
+@command("check_batch", "check_batch <symbol,quantity,price,action[,stop]> ...",
+         "Run the pre-trade risk checks on a batch without placing it", format=lambda report: report.report())
+async def _check_batch(ib, args):
+    legs = read_legs(args)
+    if not legs:
+        raise UsageError("Usage: check_batch <symbol,quantity,price,action[,stop]> ... or <file.csv|file.json>")
+    from risk import check_legs_async
+    return await check_legs_async(ib, legs)
+
+
+@command("change_limit_price", "change_limit_price <orderId> <new_price> ...",
+         "Modify the price of one or more working limit orders in place",
+         format=lambda results: "\n".join(r.report() for r in results), serial=True)
+async def _change_limit_price(ib, args):
+    if not args or len(args) % 2:
+        raise UsageError("Usage: change_limit_price <orderId> <new_price> [<orderId> <new_price> ...]")
+    from orders import reprice_orders_async
+    trades_and_prices = [(_trade(ib, order_id), _float(price, 'price')) for order_id, price in zip(args[::2], args[1::2])]
+    return await reprice_orders_async(ib, trades_and_prices)
+
+
+def _trade(ib, order_id):
+    from orderbook import order_book
+    trade = order_book(ib).trade(_int(order_id, 'order id'))
+    if trade is None:
+        raise ValueError(f"Trade with ID {order_id} not found.")
+    return trade
+
+
+@command("get_order_status", "get_order_status <orderId>", "Get the order status of a trade",
+         format=lambda record: record.summary())
+async def _get_order_status(ib, args):
+    order_id, = _args(args, 1, "get_order_status <orderId>")
+    from orderbook import order_book
+    record = order_book(ib).get(_int(order_id, 'order id'))
+    if record is None:
+        raise ValueError(f"Trade with ID {order_id} not found.")
+    return record
+
+
+@command("cancel_order", "cancel_order <orderId>", "Cancel a pending order",
+         format=lambda trade: f"Order {trade.order.orderId} canceled.", serial=True)
+async def _cancel_order(ib, args):
+    order_id, = _args(args, 1, "cancel_order <orderId>")
+    from utils import cancel_order_async
+    trade = await cancel_order_async(ib, _trade(ib, order_id))
+    if trade is None:
+        # ib_insync only logs a cancel of an order it does not know
+        raise ValueError(f"Order {order_id} is not known to this session.")
+    return trade
+
+
+@command("set_stop_loss", "set_stop_loss <symbol> <quantity> <stop_price>", "Place a stop-loss order for a symbol",
+         format=_format_trade("Stop-loss order"), serial=True)
+async def _set_stop_loss(ib, args):
+    symbol, quantity, stop_price = _args(args, 3, "set_stop_loss <symbol> <quantity> <stop_price>")
+    from utils import set_stop_loss_async
+    return await set_stop_loss_async(ib, symbol, _int(quantity, 'quantity'), _float(stop_price, 'stop price'))
+
+
+@command("set_trailing_stop", "set_trailing_stop <symbol> <quantity> <trail>",
+         "Place a trailing stop that IB moves after the price;\n<trail> is an amount or a percent (e.g., 2%)",
+         format=_format_trade("Trailing stop order"), serial=True)
+async def _set_trailing_stop(ib, args):
+    symbol, quantity, trail = _args(args, 3, "set_trailing_stop <symbol> <quantity> <trail>")
+    from utils import set_trailing_stop_async
+    trail_amount, trail_percent = _trail(trail)
+    return await set_trailing_stop_async(ib, symbol, _int(quantity, 'quantity'), trail_amount, trail_percent)
+
+
+def _options(args, names, usage):
+    """Split ``name=value`` options from the positional arguments."""
+    options, values = {}, []
+    for token in args:
+        if '=' in token:
+            key, value = token.split('=', 1)
+            if key not in names:
+                raise UsageError(f"Unknown option: {key}. Usage: {usage}")
+            options[key] = value
+        else:
+            values.append(token)
+    return options, values
+
+
+def _percent(text):
+    return _float(text.rstrip('%'), 'percent') if text else None
+
+
+BRACKET_USAGE = "place_bracket <symbol> <quantity> <entry> [tp=<price>] [stop=<price>] [trail=<trail>] [action=BUY]"
+
+
+@command("place_bracket", BRACKET_USAGE,
+         "Place an entry limit order with take-profit and stop (or trailing stop) exits,\n"
+         "transmitted together (e.g., place_bracket AAPL 10 150 tp=165 stop=145)",
+         format=lambda result: result.report(), serial=True)
+async def _place_bracket(ib, args):
+    options, values = _options(args, {'tp', 'stop', 'trail', 'action'}, BRACKET_USAGE)
+    if len(values) != 3 or not options.keys() & {'tp', 'stop', 'trail'}:
+        raise UsageError(f"Usage: {BRACKET_USAGE}")
+    from orders import Bracket, place_brackets_async
+    symbol, quantity, entry = values
+    trail = _trail(options['trail']) if 'trail' in options else (None, None)
+    bracket = Bracket(symbol, _int(quantity, 'quantity'), options.get('action', 'BUY'), _float(entry, 'entry'),
+                      _float(options['tp'], 'take-profit') if 'tp' in options else None,
+                      _float(options['stop'], 'stop') if 'stop' in options else None, *trail)
+    return await place_brackets_async(ib, [bracket])
+
+
+PROTECT_USAGE = "protect_positions [tp=<percent>] [stop=<percent>] [trail=<trail>] [<symbol> ...]"
+
+
+@command("protect_positions", PROTECT_USAGE,
+         "Place exits for every position without a working stop, paced as one batch;\n"
+         "take-profit and stop are percents from the market price, take-profit and stop\n"
+         "of a position cancel each other (e.g., protect_positions tp=10% trail=3%)",
+         format=lambda result: result.report(), serial=True)
+async def _protect_positions(ib, args):
+    options, symbols = _options(args, {'tp', 'stop', 'trail'}, PROTECT_USAGE)
+    if not options.keys() & {'tp', 'stop', 'trail'}:
+        raise UsageError(f"Usage: {PROTECT_USAGE}")
+    from orders import protect_positions_async
+    trail = _trail(options['trail']) if 'trail' in options else (None, None)
+    return await protect_positions_async(ib, _percent(options.get('tp')), _percent(options.get('stop')), trail,
+                                         symbols)
+
+
+def _format_stops(stops):
+    return "\n".join(stop.summary() for stop in stops) or "No trailing stops."
+
+
+@command("trail_stop", "trail_stop <orderId> <trail> [<orderId> <trail> ...]",
+         "Move working stop orders after the price from this session, in bulk and rate limited;\n"
+         "only in the interactive CLI or with --connect-once, which keep running",
+         format=_format_stops, serial=True)
+async def _trail_stop(ib, args):
+    if not args or len(args) % 2:
+        raise UsageError("Usage: trail_stop <orderId> <trail> [<orderId> <trail> ...]")
+    pairs = [(_trade(ib, order_id), _trail(trail)) for order_id, trail in zip(args[::2], args[1::2])]
+    if not _persistent:
+        raise ValueError("Stops are trailed by this process, which exits after the script. Run trail_stop "
+                         "in the interactive CLI or with --connect-once on the connection service.")
+    from contracts import contract_registry, registry_key
+    from trailing import trailing_manager
+    manager = trailing_manager(ib)
+    infos = await contract_registry(ib).resolve_async([trade.contract for trade, _ in pairs])
+    ticks = [getattr(infos.get(registry_key(trade.contract)), 'minTick', 0.01) for trade, _ in pairs]
+    return [manager.add(trade, *trail, min_tick=tick) for (trade, trail), tick in zip(pairs, ticks)]
+
+
+@command("trailing_stops", "trailing_stops", "Show the stops trailed by this session", format=_format_stops)
+async def _trailing_stops(ib, args):
+    _args(args, 0, "trailing_stops")
+    from trailing import trailing_manager
+    return trailing_manager(ib).stops()
+
+
+def _format_sizes(sizes):
+    return "\n".join(f"Entry {s['entry']} with stop {s['stop']}: {s['size']:.0f} shares" for s in sizes)
+
+
+@command("calculate_pos_size", "calculate_pos_size <acc_balance> <risk%> <entry> <stop_loss> [<entry> <stop_loss> ...]",
+         "Calculate position sizes based on account balance and risk", format=_format_sizes, offline=True)
+async def _calculate_pos_size(ib, args):
+    if len(args) < 4 or len(args) % 2:
+        raise UsageError("Usage: calculate_pos_size <acc_balance> <risk%> <entry> <stop_loss> "
+                         "[<entry> <stop_loss> ...]")
+    account_bal, risk_perc = _float(args[0], 'balance'), _float(args[1], 'risk')
+    entries, stops = [_float(x, 'entry') for x in args[2::2]], [_float(x, 'stop') for x in args[3::2]]
+    from risk import position_sizes
+    sizes = position_sizes(account_bal, risk_perc, entries, stops)
+    return [{'entry': e, 'stop': s, 'size': size} for e, s, size in zip(entries, stops, sizes)]
+
+
+@command("test_order", "test_order <symbol> <quantity> <action>",
+         "Simulate an order to check for errors or margin impact",
+         format=lambda state: f"Order validation: {state}")
+async def _test_order(ib, args):
+    symbol, quantity, action = _args(args, 3, "test_order <symbol> <quantity> <action>")
+    from utils import test_order_async
+    return await test_order_async(ib, symbol, _int(quantity, 'quantity'), action)
+
+
+BACKTEST_USAGE = ("backtest <symbol|bars.csv> ... [fast=5:50:5] [slow=20:200:10] [stop=0.02,0.05] [risk=1] "
+                  "[duration=5Y] [sort=pnl]")
+
+
+def _only_csv(args):
+    # A backtest over bar files alone needs no connection
+    return all(Path(token).suffix.lower() == '.csv' for token in args if '=' not in token)
+
+
+@command("backtest", BACKTEST_USAGE, "Backtest an SMA crossover with a stop loss over a parameter grid",
+         format=lambda result: result.report(), offline=_only_csv)
+async def _backtest(ib, args):
+    # Format: backtest AAPL MSFT bars.csv fast=5:50:5 slow=20:200:10 stop=0.02,0.05 risk=0.5,1
+    options = {'fast': '5:50:5', 'slow': '20:200:10', 'stop': '0.02,0.05,0.1', 'risk': '1',
+               'duration': '5Y', 'sort': 'pnl', 'top': '10'}
+    inputs = []
+    for token in args:
+        if '=' in token:
+            key, value = token.split('=', 1)
+            if key not in options:
+                raise UsageError(f"Unknown backtest option: {key}")
+            options[key] = value
+        else:
+            inputs.append(token)
+    if not inputs:
+        raise UsageError(f"Usage: {BACKTEST_USAGE.replace('[sort=pnl]', '[sort=pnl|return|max_drawdown|turnover]')}")
+
+    from backtest import Panel, load_inputs_async, param_grid, parse_values, sweep
+    duration = options['duration'].upper()
+    try:
+        grid = param_grid(parse_values(options['fast'], int), parse_values(options['slow'], int),
+                          parse_values(options['stop']), parse_values(options['risk']))
+    except ValueError as e:
+        raise UsageError(f"Invalid parameter range: {e}") from None
+    panel = Panel.from_bars(await load_inputs_async(ib, inputs, duration=f"{duration[:-1]} {duration[-1]}"))
+    # The sweep runs in worker processes; wait for it off the event loop
+    result = await asyncio.get_running_loop().run_in_executor(None, sweep, panel, grid)
+    result.by, result.top = options['sort'], _int(options['top'], 'top')
+    return result
+
+
+SCAN_USAGE = ("scan <watchlist.txt|symbol> ... [<column><op><value> ...] [sort=<column>[:asc]] [top=<n>] "
+              "[stream=yes] [lines=<n>] [dwell=<seconds>]")
+
+
+def _scan_args(args):
+    from scanner import SCAN_COLUMNS, parse_filter
+    options, filters, symbols = {}, [], []
+    for token in args:
+        # Whatever comes before the first operator: a column for filters, a name for options
+        name = re.split(r'[<>!=]', token, maxsplit=1)[0]
+        if name in SCAN_COLUMNS[1:] and name != token or re.search(r'[<>!]|==', token):
+            try:
+                filters.append(parse_filter(token))
+            except ValueError as e:
+                raise UsageError(f"{e} Usage: {SCAN_USAGE}") from None
+        elif '=' in token:
+            if name not in {'sort', 'top', 'stream', 'lines', 'dwell'}:
+                raise UsageError(f"Unknown option: {name}. Usage: {SCAN_USAGE}")
+            options[name] = token.split('=', 1)[1]
+        elif Path(token).is_file():
+            from recorder import load_watchlist
+            symbols.extend(load_watchlist(token))
+        else:
+            symbols.append(token.upper())
+    if not symbols:
+        raise UsageError(f"Usage: {SCAN_USAGE}")
+    return symbols, filters, options
+
+
+def _print_rows(columns):
+    import pandas as pd
+    print(pd.DataFrame(columns).round(4).to_string(index=False), flush=True)
+
+
+@command("scan", SCAN_USAGE,
+         "Quote a watchlist, rotating through the free market data lines, and show the symbols\n"
+         "passing every filter on bid, ask, price, close, spread, spread_pct, change_pct (vs. the\n"
+         "prior close), volume and volume_rate (vs. the average daily volume),\n"
+         "e.g., scan watchlist.txt spread_pct<0.1 change_pct>2 sort=change_pct top=20",
+         format=lambda result: result.report())
+async def _scan(ib, args):
+    symbols, filters, options = _scan_args(args)
+    from scanner import SCAN_COLUMNS, SCAN_DWELL, Scanner
+    by, _, order = options.get('sort', '').partition(':')
+    if by and by not in SCAN_COLUMNS:
+        raise UsageError(f"Unknown scan column: {by}. Usage: {SCAN_USAGE}")
+    scanner = Scanner(ib, _int(options.get('lines', 0), 'lines') or None,
+                      _float(options.get('dwell', SCAN_DWELL), 'dwell'))
+    # Streamed matches are printed as they come in, the sorted table at the end
+    stream = _print_rows if options.get('stream', 'no').lower() in ('yes', 'true', '1') else None
+    result = await scanner.scan_async(symbols, filters, on_rows=stream)
+    result.by, result.ascending = by or None, order == 'asc'
+    result.top = _int(options['top'], 'top') if 'top' in options else None
+    return result
+
+
+SETTINGS_USAGE = "settings [MODE=Paper|Live] [PAPER_PORT=<port>] [LIVE_PORT=<port>] [CLI_CLIENT_ID=<id>] " \
+                 "[DASHBOARD_CLIENT_ID=<id>] [MARKET_DATA_LINES=<lines>] [risk.<limit>=<value>] ..."
+SETTINGS_KEYS = {'MODE': str, 'PAPER_PORT': int, 'LIVE_PORT': int, 'CLI_CLIENT_ID': int, 'DASHBOARD_CLIENT_ID': int,
+                 'MARKET_DATA_LINES': int}
+
+
+def _format_settings(values):
+    lines = [f"{key}: {value}" for key, value in sorted(values.items()) if key != 'RISK']
+    lines += [f"risk.{key}: {value}" for key, value in sorted((values.get('RISK') or {}).items())]
+    return "\n".join(lines) or "No settings saved; the defaults apply."
+
+
+@command("settings", SETTINGS_USAGE,
+         "Show or change the settings shared with the dashboard: mode, gateway ports, the\n"
+         "client ids of the CLI and the dashboard, the account's market data lines and the\n"
+         "risk limits of batches (e.g., settings risk.max_quantity=500)",
+         format=_format_settings, offline=True)
+async def _settings(ib, args):
+    from settings import settings_store
+    store = settings_store()
+    if not args:
+        return store.load()
+    names = {f'risk.{name}' for name in _risk_fields()} if any(a.startswith('risk.') for a in args) else set()
+    options, values = _options(args, SETTINGS_KEYS.keys() | names, SETTINGS_USAGE)
+    if values:
+        raise UsageError(f"Usage: {SETTINGS_USAGE}")
+    if options.get('MODE', 'Paper') not in ('Paper', 'Live'):
+        raise UsageError(f"Usage: {SETTINGS_USAGE}")
+    changes, risk = {}, dict(store.get('RISK') or {})
+    try:
+        for key, value in options.items():
+            if key.startswith('risk.'):
+                name = key[len('risk.'):]
+                risk[name] = _risk_fields()[name](value)
+            else:
+                changes[key] = SETTINGS_KEYS[key](value)
+    except ValueError:
+        raise UsageError(f"Invalid value: {key}={value}") from None
+    if names:
+        changes['RISK'] = risk
+    return store.update(changes)
+
+
+def _risk_fields():
+    # Only loaded when risk limits are changed; the risk module brings ib_insync and numpy
+    from risk import RiskLimits
+    return {f.name: f.type for f in dataclasses.fields(RiskLimits)}
+
+
+@command("help", "help", "Show available commands", format=lambda text: text, offline=True)
+async def _help(ib, args):
+    return help_text()
@@ -0,0 +1,430 @@
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from metrics import METRICS_PORT, MetricsServer, enable_profiling, instrument
+from settings import settings_store
+
+# ib_insync is imported where used, so the CLI does not load it before its prompt
+
+PORTS = {'Paper': 4002, 'Live': 4001}
+IB_HOST = '127.0.0.1'
+
+# Local socket the connection service listens on
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 4010
+
+# The service keeps client id 0 and leases the others; without it each front end has a fixed id
+SERVICE_CLIENT_ID = 0
+CLI_CLIENT_ID = 1
+DASHBOARD_CLIENT_ID = 2
+LIVE_CLIENT_ID = 3
+LEASED_CLIENT_IDS = range(4, 32)
+RECORDER_CLIENT_ID = 33
+# Connections the fan-out layer holds, one id per configured gateway entry
+FANOUT_CLIENT_IDS = range(40, 72)
+
+# Output of a service started in the background by the CLI
+SERVICE_LOG = str(Path(tempfile.gettempdir()) / 'ib-connection-service.log')
+# Secret every request to the service carries, readable by the service's user alone
+SERVICE_TOKEN_FILE = str(Path.home() / '.ib-connection-service.token')
+
+
+def client_port(mode):
+    """IB Gateway port for 'Paper' or 'Live' mode, as set in the settings (PAPER_PORT, LIVE_PORT)."""
+    return int(settings_store().get(f'{mode.upper()}_PORT', PORTS[mode]))
+
+
+def configured_mode():
+    """Trading mode chosen in the settings, defaulting to Paper."""
+    mode = settings_store().get('MODE', 'Paper')
+    return mode if mode in PORTS else 'Paper'
+
+
+def configured_client_id(front_end='CLI'):
+    """Client id of the CLI or the dashboard when it connects without the connection service."""
+    default = DASHBOARD_CLIENT_ID if front_end == 'DASHBOARD' else CLI_CLIENT_ID
+    return int(settings_store().get(f'{front_end}_CLIENT_ID', default))
+
+
+def write_service_token(path=SERVICE_TOKEN_FILE):
+    """Create a fresh token in a file only its owner may read, replacing any older one."""
+    token = secrets.token_hex(32)
+    Path(path).unlink(missing_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def read_service_token(path=SERVICE_TOKEN_FILE):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def encode(obj):
+    """Primitive, non-default fields of an ib_insync dataclass."""
+    from ib_insync import util
+    return {
+        k: v for k, v in util.dataclassNonDefaults(obj).items()
+        if isinstance(v, (str, int, float, bool))
+    }
+
+
+class ClientIdPool:
+    """Hands out IB client ids so front ends never share one."""
+
+    def __init__(self, ids=LEASED_CLIENT_IDS):
+        self._free = list(ids)
+        self._leased = set()
+
+    def lease(self):
+        if not self._free:
+            raise RuntimeError("No free client ids left.")
+        client_id = self._free.pop(0)
+        self._leased.add(client_id)
+        return client_id
+
+    def release(self, client_id):
+        if client_id in self._leased:
+            self._leased.remove(client_id)
+            self._free.insert(0, client_id)
+
+
+class ConnectionManager:
+    """Keeps one IB session connected, reconnecting with exponential backoff."""
+
+    def __init__(self, host=IB_HOST, port=None, client_id=SERVICE_CLIENT_ID, max_backoff=60.0):
+        self.host = host
+        self.port = port or client_port(configured_mode())
+        self.client_id = client_id
+        self.max_backoff = max_backoff
+        from ib_insync import IB
+        self.ib = instrument(IB())
+        self._reconnecting = None
+        self._closing = False
+        self.ib.disconnectedEvent += self._on_disconnected
+
+    async def connect(self):
+        from orderbook import order_book
+        delay = 1.0
+        while not self._closing:
+            try:
+                await self.ib.connectAsync(self.host, self.port, clientId=self.client_id, timeout=10)
+                print(f"Connected to IB Gateway on port {self.port}")
+                if self.client_id == 0:
+                    # Client 0 gets status updates for orders placed by the other clients too
+                    self.ib.reqAutoOpenOrders(True)
+                await order_book(self.ib).refresh_async()
+                return
+            except (ConnectionRefusedError, OSError, asyncio.TimeoutError) as e:
+                print(f"Connection to IB Gateway failed ({e!r}), retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def disconnect(self):
+        self._closing = True
+        self.ib.disconnect()
+
+    def _on_disconnected(self):
+        if not self._closing and (self._reconnecting is None or self._reconnecting.done()):
+            print("Disconnected from IB Gateway, reconnecting...")
+            self._reconnecting = asyncio.ensure_future(self.connect())
+
+
+class ConnectionService:
+    """
+    Serves positions, orders and quotes from one warm IB session over a
+    local socket, one JSON request and response per line.
+    """
+
+    def __init__(self, manager, host=SERVICE_HOST, port=SERVICE_PORT, token_file=SERVICE_TOKEN_FILE):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.token_file = token_file
+        self.token = None
+        self.client_ids = ClientIdPool()
+
+    @property
+    def ib(self):
+        return self.manager.ib
+
+    async def serve(self):
+        self.token = write_service_token(self.token_file)
+        await self.manager.connect()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Connection service listening on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        leases = []
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    # Not our protocol, e.g. an HTTP request a web page sent to this port
+                    break
+                if not isinstance(request, dict) or not self._authorized(request.get('token')):
+                    writer.write(json.dumps({'error': "Unauthorized."}).encode() + b'\n')
+                    await writer.drain()
+                    break
+                try:
+                    result = await self.dispatch(request.get('method'), request.get('params', {}), leases)
+                    response = {'result': result}
+                except Exception as e:
+                    response = {'error': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # Client ids leased over this connection are freed when it closes
+            for client_id in leases:
+                self.client_ids.release(client_id)
+            writer.close()
+
+    def _authorized(self, token):
+        return self.token is not None and isinstance(token, str) and hmac.compare_digest(token, self.token)
+
+    async def dispatch(self, method, params, leases):
+        from ib_insync import Contract
+        from bars import bar_store
+        from contracts import contract_registry
+        from orderbook import order_book
+        if method == 'status':
+            return {'connected': self.ib.isConnected(), 'port': self.manager.port}
+        if method == 'lease_client_id':
+            client_id = self.client_ids.lease()
+            leases.append(client_id)
+            return client_id
+        if method == 'release_client_id':
+            self.client_ids.release(params['client_id'])
+            if params['client_id'] in leases:
+                leases.remove(params['client_id'])
+            return None
+        if not self.ib.isConnected():
+            raise ConnectionError("Not connected to IB Gateway.")
+        if method == 'positions':
+            return [
+                {'account': p.account, 'contract': encode(p.contract), 'position': p.position, 'avgCost': p.avgCost}
+                for p in self.ib.positions()
+            ]
+        if method == 'portfolio':
+            return [dict(item._asdict(), contract=encode(item.contract)) for item in self.ib.portfolio()]
+        if method == 'orders':
+            trades = order_book(self.ib).open_trades()
+            return [
+                {'contract': encode(t.contract), 'order': encode(t.order), 'orderStatus': encode(t.orderStatus)}
+                for t in trades
+            ]
+        if method == 'contracts':
+            contracts = [Contract.create(**c) for c in params['contracts']]
+            infos = await contract_registry(self.ib).resolve_async(contracts)
+            return {key: dict(vars(info), contract=encode(info.contract)) for key, info in infos.items()}
+        if method == 'quotes':
+            return await self.quotes(params['symbols'], params.get('timeout', 2.0))
+        if method == 'history':
+            store = bar_store()
+            results = await asyncio.gather(*(
+                store.ensure_async(self.ib, symbol, params['duration'], params['bar_size'],
+                                   params['what_to_show'], params['use_rth'])
+                for symbol in params['symbols']
+            ), return_exceptions=True)
+            # Bars stored per symbol, or why there are none
+            return {symbol: str(bars) if isinstance(bars, Exception) else len(bars)
+                    for symbol, bars in zip(params['symbols'], results)}
+        if method == 'run':
+            # Imported here: the commands build on modules that import this one
+            from commands import run_script_async
+            results = await run_script_async(self.ib, params['lines'])
+            return [r.to_dict() for r in results]
+        raise ValueError(f"Unknown method: {method}")
+
+    async def quotes(self, symbols, timeout):
+        from contracts import contract_registry, registry_key
+        from market_data import has_last, ticker_cache
+        cache = ticker_cache(self.ib)
+        infos = await contract_registry(self.ib).resolve_async(symbols)
+        tickers = {symbol: cache.ticker(infos[registry_key(symbol)].contract) for symbol in symbols
+                   if registry_key(symbol) in infos}
+        await asyncio.gather(*(cache.wait(t, has_last, timeout) for t in tickers.values()))
+        return {
+            symbol: {'bid': t.bid, 'ask': t.ask, 'last': t.last, 'close': t.close}
+            for symbol, t in tickers.items()
+        }
+
+
+class ServiceClient:
+    """Blocking client for the connection service, safe to share between threads."""
+
+    def __init__(self, host=SERVICE_HOST, port=SERVICE_PORT, timeout=30.0, token_file=SERVICE_TOKEN_FILE):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.token_file = token_file
+        self._token = None
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def is_running(self):
+        try:
+            return self.call('status')['connected']
+        except OSError:
+            return False
+
+    def call(self, method, **params):
+        with self._lock:
+            if self._sock is None:
+                self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                self._file = self._sock.makefile('rb')
+                # Read again on every connection: a restarted service writes a new token
+                try:
+                    self._token = read_service_token(self.token_file)
+                except OSError:
+                    self.close()
+                    raise
+            try:
+                request = {'method': method, 'params': params, 'token': self._token}
+                self._sock.sendall(json.dumps(request).encode() + b'\n')
+                line = self._file.readline()
+            except OSError:
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise ConnectionError("Connection service closed the connection.")
+        response = json.loads(line)
+        if response.get('error') == "Unauthorized.":
+            # The service closed the connection; its token file is not this user's or is stale
+            self.close()
+            raise PermissionError(f"Connection service refused the token in {self.token_file}.")
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+
+    def lease_client_id(self):
+        return self.call('lease_client_id')
+
+    def positions(self):
+        from ib_insync import Contract, Position
+        return [
+            Position(p['account'], Contract.create(**p['contract']), p['position'], p['avgCost'])
+            for p in self.call('positions')
+        ]
+
+    def portfolio(self):
+        from ib_insync import Contract, PortfolioItem
+        return [
+            PortfolioItem(**dict(item, contract=Contract.create(**item['contract'])))
+            for item in self.call('portfolio')
+        ]
+
+    def open_trades(self):
+        from ib_insync import Contract, Order, OrderStatus, Trade
+        return [
+            Trade(Contract.create(**t['contract']), Order(**t['order']), OrderStatus(**t['orderStatus']))
+            for t in self.call('orders')
+        ]
+
+    def contracts(self, contracts):
+        from ib_insync import Contract
+        from contracts import ContractInfo
+        infos = self.call('contracts', contracts=[encode(c) for c in contracts])
+        return {key: ContractInfo(**dict(info, contract=Contract.create(**info['contract'])))
+                for key, info in infos.items()}
+
+    def quotes(self, symbols, timeout=2.0):
+        return self.call('quotes', symbols=list(symbols), timeout=timeout)
+
+    def history(self, symbols, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """
+        Have the service bring the shared bar store up to date for these
+        symbols; the bars are then read locally from the store. Returns the
+        number of bars per symbol, or the reason there are none.
+        """
+        return self.call('history', symbols=list(symbols), duration=duration, bar_size=bar_size,
+                         what_to_show=what_to_show, use_rth=use_rth)
+
+    def run(self, lines):
+        """Run CLI command lines on the service's session; returns ``CommandResult.to_dict()`` of each."""
+        return self.call('run', lines=list(lines))
+
+
+def ensure_service(mode, timeout=60.0):
+    """
+    Start the connection service in the background unless it is already
+    up, and wait until it is connected to IB Gateway.
+    """
+    client = ServiceClient(timeout=5.0)
+    try:
+        client.call('status')
+    except OSError:
+        with open(SERVICE_LOG, 'ab') as log:
+            subprocess.Popen([sys.executable, str(Path(__file__).resolve()), '--mode', mode],
+                             stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while not client.is_running():
+        if time.monotonic() > deadline:
+            client.close()
+            raise ConnectionError(f"Connection service did not connect to IB Gateway within {timeout:.0f}s, "
+                                  f"see {SERVICE_LOG}")
+        time.sleep(0.25)
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep one IB session warm and share it over a local socket.")
+    parser.add_argument('--mode', choices=list(PORTS), default=None,
+                        help="Paper or Live; defaults to the mode chosen in the dashboard settings")
+    parser.add_argument('--host', default=IB_HOST, help="IB Gateway host")
+    parser.add_argument('--service-port', type=int, default=SERVICE_PORT, help="Local port to serve on")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Local HTTP port of the metrics; 0 turns them off")
+    parser.add_argument('--profile-slow', type=float, default=None, metavar='SECONDS',
+                        help="Profile a sample of the commands run and keep the profiles of those slower than this")
+    parser.add_argument('--profile-rate', type=float, default=0.1,
+                        help="Share of the commands profiled with --profile-slow")
+    args = parser.parse_args()
+    from ib_insync import util
+
+    if args.profile_slow is not None:
+        enable_profiling(args.profile_slow, args.profile_rate)
+    server = MetricsServer(port=args.metrics_port).start() if args.metrics_port else None
+
+    manager = ConnectionManager(args.host, client_port(args.mode or configured_mode()))
+    service = ConnectionService(manager, port=args.service_port)
+    # Imported here: the commands build on modules that import this one
+    from commands import set_persistent_session
+    set_persistent_session()
+    try:
+        util.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.disconnect()
+        if server is not None:
+            server.close()
+
+
+if __name__ == "__main__":
+    main()
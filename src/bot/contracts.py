@@ -0,0 +1,174 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from ib_insync import Contract, Stock
+
+from connection import encode
+from pacing import request_scheduler
+from settings import JsonStore
+from shared import per_connection
+
+# Next to the bot modules, so every front end shares one file whatever directory it started in
+CONTRACTS_DB = str(Path(__file__).resolve().parent / 'contracts.json')
+CONTRACT_TTL = 24 * 60 * 60
+
+
+@dataclass
+class ContractInfo:
+    """Qualified contract together with the contract details we use."""
+    contract: Contract
+    conId: int
+    longName: str
+    tradingHours: str
+    liquidHours: str
+    timeZoneId: str
+    minTick: float
+    fetched: float
+
+    @classmethod
+    def from_details(cls, details):
+        return cls(
+            contract=details.contract,
+            conId=details.contract.conId,
+            longName=details.longName,
+            tradingHours=details.tradingHours,
+            liquidHours=details.liquidHours,
+            timeZoneId=details.timeZoneId,
+            minTick=details.minTick,
+            fetched=time.time()
+        )
+
+    def to_json(self):
+        return dict(vars(self), contract=encode(self.contract))
+
+    @classmethod
+    def from_json(cls, values):
+        return cls(**dict(values, contract=Contract.create(**values['contract'])))
+
+
+def round_to_tick(price, min_tick=0.01):
+    """Price rounded to a multiple of the contract's minimum tick."""
+    if not min_tick or not min_tick > 0:
+        min_tick = 0.01
+    # Rounded again to drop the binary noise of the multiplication, e.g. 0.30000000000000004
+    return round(round(price / min_tick) * min_tick, 10)
+
+
+def registry_key(item, exchange='SMART', currency='USD'):
+    """Store key for a symbol or a contract."""
+    if isinstance(item, Contract):
+        if item.conId:
+            return str(item.conId)
+        return f"{item.symbol}:{item.exchange or exchange}:{item.currency or currency}"
+    return f"{item}:{exchange}:{currency}"
+
+
+class ContractRegistry:
+    """
+    Cache of qualified contracts and their details.
+
+    Lookups are served from memory, then from an on-disk store, and only
+    the remaining misses go to IB in a single concurrent batch. The store
+    is the JSON file the other processes of the bot share, written whole
+    by an atomic rename, so their fetches are seen here without asking IB.
+    """
+
+    def __init__(self, ib, path=CONTRACTS_DB, ttl=CONTRACT_TTL):
+        self.ib = ib
+        self.path = path
+        self.ttl = ttl
+        self._infos = {}
+        self._store = JsonStore(path)
+
+    def _lookup(self, key):
+        """Unexpired ContractInfo of a key from memory or the store, else None."""
+        info = self._infos.get(key)
+        if info is None or self._expired(info):
+            values = self._store.get(key)
+            info = ContractInfo.from_json(values) if values is not None else None
+            if info is None or self._expired(info):
+                return None
+            self._infos[key] = info
+        return info
+
+    def get(self, item, exchange='SMART', currency='USD'):
+        """Return the ContractInfo for a symbol or contract."""
+        infos = self.resolve([item], exchange, currency)
+        key = registry_key(item, exchange, currency)
+        if key not in infos:
+            raise ValueError(f"Unknown contract: {item}")
+        return infos[key]
+
+    async def get_async(self, item, exchange='SMART', currency='USD'):
+        infos = await self.resolve_async([item], exchange, currency)
+        key = registry_key(item, exchange, currency)
+        if key not in infos:
+            raise ValueError(f"Unknown contract: {item}")
+        return infos[key]
+
+    def contract(self, item, exchange='SMART', currency='USD'):
+        """Return the qualified contract for a symbol or contract."""
+        return self.get(item, exchange, currency).contract
+
+    def resolve(self, items, exchange='SMART', currency='USD'):
+        """Resolve many symbols or contracts, keyed by ``registry_key``."""
+        keys = [registry_key(item, exchange, currency) for item in items]
+        if all(self._lookup(key) is not None for key in keys):
+            return {key: self._infos[key] for key in keys}
+        return self.ib.run(self.resolve_async(items, exchange, currency))
+
+    async def resolve_async(self, items, exchange='SMART', currency='USD'):
+        keyed = {registry_key(item, exchange, currency): item for item in items}
+        missing = {key: item for key, item in keyed.items() if self._lookup(key) is None}
+        if missing:
+            await self._fetch(missing, exchange, currency)
+        return {key: self._infos[key] for key in keyed if key in self._infos}
+
+    def invalidate(self, item=None, exchange='SMART', currency='USD'):
+        """Drop one entry, or the whole cache, from memory and disk."""
+        if item is None:
+            self._infos.clear()
+            self._store.clear()
+        else:
+            key = registry_key(item, exchange, currency)
+            self._infos.pop(key, None)
+            self._store.update(remove=[key])
+
+    async def _fetch(self, missing, exchange, currency):
+        keys = list(missing)
+        requests = []
+        for key in keys:
+            item = missing[key]
+            contract = item if isinstance(item, Contract) else Stock(symbol=item, exchange=exchange, currency=currency)
+            # Callers resolving the same symbol at once share one request
+            requests.append(request_scheduler(self.ib).run(
+                'contract', key, lambda contract=contract: self.ib.reqContractDetailsAsync(contract)))
+        results = await asyncio.gather(*requests, return_exceptions=True)
+
+        fetched = {}
+        for key, details in zip(keys, results):
+            if isinstance(details, Exception) or not details:
+                continue
+            info = ContractInfo.from_details(details[0])
+            fetched[key] = info
+            fetched[str(info.conId)] = info
+
+        self._infos.update(fetched)
+        if fetched:
+            # Entries expired for every process are dropped while the file is rewritten anyway
+            expired = [key for key, values in self._store.load().items() if time.time() - values['fetched'] > self.ttl]
+            self._store.update({key: info.to_json() for key, info in fetched.items()}, remove=expired)
+
+    def _expired(self, info):
+        return time.time() - info.fetched > self.ttl
+
+
+contract_registry = per_connection(ContractRegistry)
+
+
+def set_contract_registry(ib, registry):
+    """Use ``registry`` for this connection, e.g. one with its own file for a benchmark or a test."""
+    contract_registry.instances[ib] = registry
+    return registry
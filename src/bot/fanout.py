@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+from ib_insync import IB
+
+from account import POSITION_COLUMNS, account_state
+from connection import FANOUT_CLIENT_IDS, IB_HOST, client_port, configured_mode
+from orders import Leg, submit_batch_async
+
+# One gateway per entry, client_id optional:
+# [{"name": "main", "port": 4002, "client_id": 40, "account": "DU1234567", "scale": 1.0}, ...]
+GATEWAYS_FILE = str(Path(__file__).resolve().parent / 'gateways.json')
+
+# Seconds one gateway may take before the others stop waiting for it
+GATEWAY_TIMEOUT = 10.0
+
+
+@dataclass
+class Gateway:
+    """One IB Gateway login, optionally narrowed to one of its accounts."""
+    name: str
+    port: int
+    host: str = IB_HOST
+    client_id: int = None  # the next free one of FANOUT_CLIENT_IDS if not set
+    account: str = ''
+    scale: float = 1.0  # quantity multiplier for broadcast batches
+    timeout: float = GATEWAY_TIMEOUT
+
+
+def _assign_client_ids(gateways):
+    """Give gateways without a client id one no other entry uses; entries of one gateway must not share an id."""
+    used = set()
+    for g in gateways:
+        if g.client_id is not None:
+            if (g.host, g.port, g.client_id) in used:
+                raise ValueError(f"Client id {g.client_id} is used twice on {g.host}:{g.port}.")
+            used.add((g.host, g.port, g.client_id))
+    free = (i for i in FANOUT_CLIENT_IDS if i not in {client_id for _, _, client_id in used})
+    for g in gateways:
+        if g.client_id is None:
+            g.client_id = next(free, None)
+            if g.client_id is None:
+                raise ValueError(f"More gateways than client ids in {FANOUT_CLIENT_IDS}.")
+
+
+def load_gateways(path=GATEWAYS_FILE):
+    """Gateways from the JSON file, or the gateway of the configured mode if there is none."""
+    try:
+        with open(path) as f:
+            return [Gateway(**entry) for entry in json.load(f)]
+    except FileNotFoundError:
+        mode = configured_mode()
+        return [Gateway(mode, client_port(mode))]
+
+
+@dataclass
+class FanOutResult:
+    """Per-gateway results of one call, with the gateways that failed or timed out."""
+    results: dict = field(default_factory=dict)  # gateway name -> result
+    errors: dict = field(default_factory=dict)  # gateway name -> error message
+    elapsed: dict = field(default_factory=dict)  # gateway name -> seconds
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def report(self, describe=str):
+        lines = []
+        for name in sorted(set(self.results) | set(self.errors)):
+            took = f" ({self.elapsed[name] * 1000:.0f} ms)" if name in self.elapsed else ""
+            if name in self.errors:
+                lines.append(f"[{name}] Error = {self.errors[name]}{took}")
+            else:
+                lines.append(f"[{name}]{took}\n{describe(self.results[name])}")
+        return "\n".join(lines)
+
+
+class FanOut:
+    """
+    Connections to several gateways on one event loop. Calls go to every
+    connected gateway at once, and each gateway has its own timeout so a
+    slow one never holds up the results of the others.
+    """
+
+    def __init__(self, gateways, factory=None):
+        self.gateways = {g.name: g for g in gateways}
+        if len(self.gateways) != len(gateways):
+            raise ValueError("Gateway names must be unique.")
+        _assign_client_ids(gateways)
+        factory = factory or (lambda gateway: IB())
+        self.ibs = {name: factory(g) for name, g in self.gateways.items()}
+        # Work that outlived its timeout keeps running here instead of being cancelled half done
+        self._background = set()
+
+    def connected(self):
+        return {name: ib for name, ib in self.ibs.items() if ib.isConnected()}
+
+    def is_connected(self):
+        return bool(self.connected())
+
+    async def connect_async(self):
+        """Connect every gateway that is not connected yet, concurrently."""
+        async def connect(name, ib):
+            g = self.gateways[name]
+            await ib.connectAsync(g.host, g.port, clientId=g.client_id, timeout=g.timeout, account=g.account)
+            account_state(ib)
+
+        pending = {name: ib for name, ib in self.ibs.items() if not ib.isConnected()}
+        return await self.gather(connect, pending, cancel=True)
+
+    def connect(self):
+        return self._run(self.connect_async())
+
+    def disconnect(self):
+        for ib in self.ibs.values():
+            ib.disconnect()
+
+    async def gather(self, fn, ibs=None, cancel=False):
+        """
+        Run ``fn(name, ib)`` on every connected gateway concurrently. A
+        gateway that exceeds its timeout is reported as an error; its call
+        is cancelled only with ``cancel``, otherwise it finishes in the
+        background so half-sent work is not abandoned.
+        """
+        result = FanOutResult()
+        if ibs is None:
+            ibs = self.connected()
+            for name in set(self.ibs) - set(ibs):
+                result.errors[name] = "Not connected"
+
+        async def run(name, ib):
+            start = time.perf_counter()
+            task = asyncio.ensure_future(fn(name, ib))
+            try:
+                result.results[name] = await asyncio.wait_for(
+                    task if cancel else asyncio.shield(task), self.gateways[name].timeout)
+            except asyncio.TimeoutError:
+                result.errors[name] = f"No result within {self.gateways[name].timeout:g}s"
+                if not cancel:
+                    self._background.add(task)
+                    task.add_done_callback(self._background.discard)
+            except Exception as e:
+                result.errors[name] = str(e) or repr(e)
+            result.elapsed[name] = time.perf_counter() - start
+
+        await asyncio.gather(*(run(name, ib) for name, ib in ibs.items()))
+        return result
+
+    async def broadcast_async(self, legs, limits=None):
+        """
+        Submit the same batch to every gateway, scaling quantities by each
+        gateway's ``scale``. Returns the ``BatchResult`` of each gateway.
+        """
+        async def submit(name, ib):
+            g = self.gateways[name]
+            scaled = [Leg(leg.symbol, int(leg.quantity * g.scale), leg.price, leg.action, leg.stop) for leg in legs]
+            return await submit_batch_async(ib, [leg for leg in scaled if leg.quantity > 0], limits=limits,
+                                            account=g.account)
+
+        return await self.gather(submit)
+
+    def broadcast(self, legs, limits=None):
+        return self._run(self.broadcast_async(legs, limits))
+
+    def positions_frame(self):
+        """Positions of all gateways in one frame with a ``gateway`` column."""
+        import pandas as pd
+        frames = []
+        for name, ib in self.connected().items():
+            df = account_state(ib).to_frame()
+            account = self.gateways[name].account
+            if account:
+                df = df[df['account'] == account]
+            frames.append(df.assign(gateway=name))
+        if not frames:
+            return pd.DataFrame(columns=POSITION_COLUMNS + ['gateway'])
+        return pd.concat(frames, ignore_index=True)
+
+    def balances(self, tag='NetLiquidation', currency='USD'):
+        """One account value of every gateway and their total."""
+        values = {}
+        for name, ib in self.connected().items():
+            value = account_state(ib).value(tag, currency, self.gateways[name].account or None)
+            if value is not None:
+                values[name] = float(value)
+        values['total'] = sum(values.values())
+        return values
+
+    def _run(self, coro):
+        ib = next(iter(self.ibs.values()))
+        return ib.run(coro)
+
+
+def combine_positions(positions):
+    """
+    Merge the rows of the same symbol across gateways and accounts:
+    quantities, values and P&L add up, the average cost is weighted by
+    position size.
+    """
+    if positions.empty:
+        return positions.drop(columns=['gateway', 'account'], errors='ignore')
+    df = positions.assign(cost=positions['avg_cost'] * positions['position'])
+    combined = df.groupby('symbol', sort=True).agg(
+        contract=('contract', 'first'), position=('position', 'sum'), cost=('cost', 'sum'),
+        market_price=('market_price', 'mean'), market_value=('market_value', 'sum'),
+        unrealized_pnl=('unrealized_pnl', 'sum'), realized_pnl=('realized_pnl', 'sum'),
+    ).reset_index()
+    position = combined['position'].to_numpy(dtype=float)
+    combined['avg_cost'] = np.divide(combined['cost'].to_numpy(), position, out=np.full(len(position), np.nan),
+                                     where=position != 0)
+    return combined[position != 0][[c for c in positions.columns if c not in ('gateway', 'account')]]
+
+
+_fanout = None
+
+
+def gateway_fanout():
+    """Return the process-wide fan-out over the gateways in ``GATEWAYS_FILE``."""
+    global _fanout
+    if _fanout is None:
+        _fanout = FanOut(load_gateways())
+    return _fanout
@@ -0,0 +1,230 @@
+import copy
+
+import numpy as np
+
+# Indicators work on 2-D arrays of shape (symbols, time) so one pass covers every
+# symbol. Histories must be aligned on the time axis; pad shorter ones with
+# leading NaN, each row starts from its first valid value.
+
+
+def _as_2d(x):
+    x = np.asarray(x, dtype=float)
+    return x[None, :] if x.ndim == 1 else x
+
+
+def _first_valid(x):
+    """Index of the first non-NaN value of each row, the row length for rows without one."""
+    valid = ~np.isnan(x)
+    return np.where(valid.any(axis=1), valid.argmax(axis=1), x.shape[1])
+
+
+def sma(close, n):
+    """Simple moving average; NaN until a row has ``n`` values in its window."""
+    close = _as_2d(close)
+    out = np.full_like(close, np.nan)
+    if close.shape[1] < n:
+        return out
+    valid = ~np.isnan(close)
+    csum = np.cumsum(np.where(valid, close, 0.0), axis=1)
+    count = np.cumsum(valid, axis=1)
+    out[:, n - 1] = csum[:, n - 1]
+    out[:, n:] = csum[:, n:] - csum[:, :-n]
+    full = np.zeros_like(valid)
+    full[:, n - 1] = count[:, n - 1] == n
+    full[:, n:] = count[:, n:] - count[:, :-n] == n
+    out[:, n - 1:] /= n
+    out[~full] = np.nan
+    return out
+
+
+def _smooth(x, n, alpha):
+    """Exponential smoothing of each row, seeded with the mean of its first ``n`` valid values."""
+    out = np.full_like(x, np.nan)
+    seed = _first_valid(x) + n - 1
+    rows = np.flatnonzero(seed < x.shape[1])
+    if not len(rows):
+        return out
+    for r in rows:
+        out[r, seed[r]] = x[r, seed[r] - n + 1:seed[r] + 1].mean()
+    for t in range(int(seed[rows].min()) + 1, x.shape[1]):
+        step = out[:, t - 1] + alpha * (x[:, t] - out[:, t - 1])
+        out[:, t] = np.where(seed < t, step, out[:, t])
+    return out
+
+
+def ema(close, n):
+    """Exponential moving average seeded with the SMA of the first ``n`` values."""
+    return _smooth(_as_2d(close), n, 2 / (n + 1))
+
+
+def _wilder(x, n):
+    """Wilder's smoothing (an EMA with alpha = 1/n) seeded with a simple mean."""
+    return _smooth(x, n, 1 / n)
+
+
+def _rsi_from_averages(avg_gain, avg_loss):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+
+
+def rsi(close, n=14):
+    close = _as_2d(close)
+    out = np.full_like(close, np.nan)
+    delta = np.diff(close, axis=1)
+    avg_gain = _wilder(np.clip(delta, 0, None), n)
+    avg_loss = _wilder(np.clip(-delta, 0, None), n)
+    out[:, 1:] = _rsi_from_averages(avg_gain, avg_loss)
+    return out
+
+
+def true_range(high, low, close):
+    high, low, close = _as_2d(high), _as_2d(low), _as_2d(close)
+    prev_close = np.empty_like(close)
+    prev_close[:, 0] = np.nan
+    prev_close[:, 1:] = close[:, :-1]
+    return np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+
+
+def atr(high, low, close, n=14):
+    return _wilder(true_range(high, low, close), n)
+
+
+def vwap(high, low, close, volume):
+    """Volume weighted average price over the whole window."""
+    typical = (_as_2d(high) + _as_2d(low) + _as_2d(close)) / 3
+    volume = _as_2d(volume)
+    pv = np.nancumsum(typical * volume, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Zero volume before a row's first bar leaves its padding NaN
+        return pv / np.nancumsum(volume, axis=1)
+
+
+class IndicatorEngine:
+    """
+    Indicator columns for many symbols, kept up to date bar by bar.
+
+    ``fit`` computes the columns from history in one pass and captures the
+    rolling state; ``update`` then appends one bar per symbol in O(1).
+    Columns are named like pandas_ta's (``SMA_50``, ``EMA_20``, ``RSI_14``,
+    ``ATR_14``, ``VWAP``).
+    """
+
+    def __init__(self, sma=(50,), ema=(), rsi=14, atr=14, vwap=True):
+        self.sma_lengths = tuple(sma)
+        self.ema_lengths = tuple(ema)
+        self.rsi_length = rsi
+        self.atr_length = atr
+        self.with_vwap = vwap
+        self.length = 0
+        self._columns = {}
+        self._state = {}
+
+    @property
+    def warmup(self):
+        """Number of bars ``fit`` needs before ``update`` can be used."""
+        return max(self.sma_lengths + self.ema_lengths + (self.rsi_length + 1, self.atr_length, 1))
+
+    @property
+    def names(self):
+        return list(self._columns)
+
+    def column(self, name):
+        """Indicator values as a (symbols, time) view."""
+        return self._columns[name][:, :self.length]
+
+    def fit(self, high, low, close, volume):
+        high, low, close, volume = _as_2d(high), _as_2d(low), _as_2d(close), _as_2d(volume)
+        if (close.shape[1] - _first_valid(close)).min() < self.warmup:
+            raise ValueError(f"Need at least {self.warmup} bars of every symbol to fit the indicators.")
+
+        columns = {}
+        state = {'close': close[:, -1].copy()}
+        for n in self.sma_lengths:
+            columns[f'SMA_{n}'] = sma(close, n)
+            state[f'SMA_{n}'] = {'window': close[:, -n:].copy(), 'sum': close[:, -n:].sum(axis=1), 'pos': 0}
+        for n in self.ema_lengths:
+            columns[f'EMA_{n}'] = ema(close, n)
+            state[f'EMA_{n}'] = columns[f'EMA_{n}'][:, -1].copy()
+        if self.rsi_length:
+            n = self.rsi_length
+            delta = np.diff(close, axis=1)
+            avg_gain = _wilder(np.clip(delta, 0, None), n)
+            avg_loss = _wilder(np.clip(-delta, 0, None), n)
+            column = np.full_like(close, np.nan)
+            column[:, 1:] = _rsi_from_averages(avg_gain, avg_loss)
+            columns[f'RSI_{n}'] = column
+            state[f'RSI_{n}'] = {'gain': avg_gain[:, -1].copy(), 'loss': avg_loss[:, -1].copy()}
+        if self.atr_length:
+            n = self.atr_length
+            columns[f'ATR_{n}'] = atr(high, low, close, n)
+            state[f'ATR_{n}'] = columns[f'ATR_{n}'][:, -1].copy()
+        if self.with_vwap:
+            typical = (high + low + close) / 3
+            state['VWAP'] = {'pv': np.nansum(typical * volume, axis=1), 'v': np.nansum(volume, axis=1)}
+            columns['VWAP'] = vwap(high, low, close, volume)
+
+        self.length = close.shape[1]
+        self._columns = {name: self._with_capacity(values) for name, values in columns.items()}
+        self._state = state
+        return self
+
+    def update(self, high, low, close, volume):
+        """Append one bar per symbol and return the latest indicator values."""
+        latest = self._step(self._state, high, low, close, volume)
+        self._append(latest)
+        return latest
+
+    def peek(self, high, low, close, volume):
+        """Indicator values with one more bar, e.g. one still forming, without appending it."""
+        return self._step(copy.deepcopy(self._state), high, low, close, volume)
+
+    def _step(self, state, high, low, close, volume):
+        if not state:
+            raise ValueError("Call fit() with enough history before update().")
+        high, low, close, volume = (np.asarray(x, dtype=float) for x in (high, low, close, volume))
+        prev_close = state['close']
+        latest = {}
+
+        for n in self.sma_lengths:
+            s = state[f'SMA_{n}']
+            s['sum'] += close - s['window'][:, s['pos']]
+            s['window'][:, s['pos']] = close
+            s['pos'] = (s['pos'] + 1) % n
+            latest[f'SMA_{n}'] = s['sum'] / n
+        for n in self.ema_lengths:
+            state[f'EMA_{n}'] = state[f'EMA_{n}'] + 2 / (n + 1) * (close - state[f'EMA_{n}'])
+            latest[f'EMA_{n}'] = state[f'EMA_{n}']
+        if self.rsi_length:
+            n = self.rsi_length
+            s = state[f'RSI_{n}']
+            delta = close - prev_close
+            s['gain'] = s['gain'] + (np.clip(delta, 0, None) - s['gain']) / n
+            s['loss'] = s['loss'] + (np.clip(-delta, 0, None) - s['loss']) / n
+            latest[f'RSI_{n}'] = _rsi_from_averages(s['gain'], s['loss'])
+        if self.atr_length:
+            n = self.atr_length
+            tr = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+            state[f'ATR_{n}'] = state[f'ATR_{n}'] + (tr - state[f'ATR_{n}']) / n
+            latest[f'ATR_{n}'] = state[f'ATR_{n}']
+        if self.with_vwap:
+            s = state['VWAP']
+            s['pv'] = s['pv'] + (high + low + close) / 3 * volume
+            s['v'] = s['v'] + volume
+            with np.errstate(divide='ignore', invalid='ignore'):
+                latest['VWAP'] = s['pv'] / s['v']
+
+        state['close'] = close.copy()
+        return latest
+
+    def _with_capacity(self, values):
+        buffer = np.full((values.shape[0], max(2 * values.shape[1], 16)), np.nan)
+        buffer[:, :values.shape[1]] = values
+        return buffer
+
+    def _append(self, latest):
+        for name, values in latest.items():
+            buffer = self._columns[name]
+            if self.length == buffer.shape[1]:
+                buffer = self._columns[name] = self._with_capacity(buffer)
+            buffer[:, self.length] = values
+        self.length += 1
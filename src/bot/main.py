@@ -1,155 +1,287 @@
-from ib_insync import *
-import nest_asyncio
+import time
 
-from utils import *
+# Taken before any other import so --profile-startup includes them
+_START = time.perf_counter()
 
-nest_asyncio.apply()
+import argparse
+import asyncio
+import json
+import sys
+import threading
+from contextlib import redirect_stdout
+
+from commands import (EXIT_CONNECTION, EXIT_OK, EXIT_USAGE, CommandResult, exit_code, help_text, needs_connection,
+                      run_line_async, run_script_async, script_lines, set_persistent_session)
+from connection import (IB_HOST, PORTS, ServiceClient, client_port, configured_client_id, configured_mode,
+                        ensure_service)
+from metrics import MetricsServer, enable_profiling, instrument
+
+class StartupProfile:
+    """Time from the start of main.py to each startup phase, for --profile-startup."""
+
+    def __init__(self, start=_START):
+        self.start = start
+        self.marks = {}  # phase -> (seconds, modules loaded)
+
+    def mark(self, phase):
+        # Only the first time a phase is reached counts
+        self.marks.setdefault(phase, (time.perf_counter() - self.start, len(sys.modules)))
+
+    def report(self):
+        lines = ["Startup profile:", f"  {'phase':<20}{'ms':>9}{'+ms':>9}{'modules':>9}"]
+        last = 0.0
+        for phase, (seconds, modules) in sorted(self.marks.items(), key=lambda item: item[1][0]):
+            lines.append(f"  {phase:<20}{seconds * 1000:>9.1f}{(seconds - last) * 1000:>9.1f}{modules:>9}")
+            last = seconds
+        return "\n".join(lines)
+
+class Session:
+    """
+    The CLI's IB connection, opened in the background so the prompt and the
+    offline commands never wait for it. Awaiting ``session()`` returns the
+    connected IB, which is how the commands that need it get it.
+    """
+
+    def __init__(self, mode, profile, interactive=False):
+        self.mode = mode
+        self.profile = profile
+        # An interactive session announces the connection and tries again after a failure
+        self.interactive = interactive
+        self.ib = None
+        self.service = None
+        self._task = None
+
+    def start(self):
+        """Start connecting unless connected or already connecting."""
+        if self._task is None or (self.interactive and self._task.done() and self.ib is None):
+            self._task = asyncio.ensure_future(self._connect())
+            self._task.add_done_callback(self._connected)
+
+    async def __call__(self):
+        self.start()
+        return await asyncio.shield(self._task)
+
+    async def _connect(self):
+        import nest_asyncio
+        from ib_insync import IB
+        from orderbook import order_book
+
+        # The synchronous helpers run IB requests from inside the CLI's event loop
+        nest_asyncio.apply()
+        self.profile.mark('ib_insync loaded')
+        # Lease a client id from the connection service when it runs so we never clash with the dashboard
+        self.service = self.service or ServiceClient()
+        client_id = self.service.lease_client_id() if self.service.is_running() else configured_client_id()
+        ib = instrument(IB())
+        ib.client.apiStart += lambda: self.profile.mark('API handshake')
+        try:
+            await ib.connectAsync(IB_HOST, client_port(self.mode), clientId=client_id)
+        except (OSError, asyncio.TimeoutError) as e:
+            ib.disconnect()
+            raise ConnectionError(f"Cannot connect to IB Gateway ({self.mode}): {e!r}") from None
+        # Start recording order events right away so status queries see every transition
+        order_book(ib)
+        self.ib = ib
+        self.profile.mark('connected')
+        return ib
+
+    def _connected(self, task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if not self.interactive:
+            return
+        if error is None:
+            print(f"\nConnected to IB Gateway ({self.mode}, client id {self.ib.client.clientId})")
+        else:
+            print(f"\n{error}; commands that need it will try again.", file=sys.stderr)
+
+    def close(self):
+        # Called on the event loop: disconnecting writes to the socket
+        if self.ib is not None:
+            self.ib.disconnect()
+        if self.service is not None:
+            self.service.close()
 
 def show_help():
     """Display available commands."""
-    print("""
-Available Commands:
-  fetch_balance                                            - Fetch account balance
-  is_market_open <symbol>                                  - Check if the market is open for a specific symbol
-  fetch_positions                                          - Fetch all current positions
-  get_price <symbol>                                       - Get real-time stock price (e.g., get_price AAPL)
-  fetch_historical <symbol>                                - Fetch historical data for a symbol
-  bid_ask_spread <symbol>                                  - Get bid-ask spread (e.g., bid_ask_spread AAPL)
-  place_limit_order <symbol> <quantity> <price> <action>   - Place a limit order (e.g., place_limit_order AAPL 10 150.0 BUY)
-  place_market_order <symbol> <quantity> <action>          - Place a market order (e.g., place_market_order AAPL 10 BUY)
-  place_batch_orders [<symbol>, <quantity>, <price>, ...]  - Place multiple orders as a batch
-  change_limit_price <trade> <new_price>                   - Modify an existing limit order's price
-  get_order_status <tradeId>                               - Get the order status of a trade
-  cancel_order <tradeId>                                    - Cancel a pending order
-  set_stop_loss <symbol> <quantity> <stop_price>           - Place a stop-loss order for a symbol
-  calculate_pos_size <acc_balance> <risk%> <entry> <stop_loss>
-                                                          - Calculate position size based on account balance and risk
-  test_order <symbol> <quantity> <action>                  - Simulate an order to check for errors or margin impact
-  help                                                     - Show available commands
-  exit                                                     - Exit the CLI
-""")
+    print(help_text())
 
-def main():
-    # Connect to IB Gateway
-    ib = IB()
-    ib.connect('127.0.0.1', 4002, clientId=1)
-    print("Connected to IB Gateway")
+def print_result(result, as_json=False, out=None):
+    """Print a command's output, or its error to stderr."""
+    out = out or sys.stdout
+    if as_json:
+        print(json.dumps(result.to_dict()), file=out, flush=True)
+    elif result.ok:
+        if result.text:
+            print(result.text, file=out, flush=True)
+    elif result.code in (EXIT_USAGE, EXIT_CONNECTION):
+        print(result.error, file=sys.stderr)
+    else:
+        print(f"An error occurred: {result.error}", file=sys.stderr)
+
+def read_command():
+    """The next command line, or None at the end of input or on exit."""
+    try:
+        # Read user input
+        command = input(">>> ").strip()
+    except EOFError:
+        return None
+
+    # Exit condition
+    if command == "exit":
+        print("Exiting the CLI... Unlike your trades, this exit is guaranteed!")
+        return None
+    return command
+
+async def in_thread(fn):
+    """Run a blocking call in a daemon thread, which unlike the executor's never holds up exiting."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        # Whatever fn raises is handed to the waiting coroutine, which would otherwise wait forever
+        try:
+            result, error = fn(), None
+        except BaseException as e:
+            result, error = None, e
+        loop.call_soon_threadsafe(resolve, result, error)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+def interactive(run):
+    """Read commands until exit, running each with ``run(line)``."""
     show_help()
+    while (command := read_command()) is not None:
+        if command:
+            print_result(run(command))
+
+async def interactive_async(session, profile):
+    """Read commands until exit while the session connects in the background."""
+    show_help()
+    session.start()
+    try:
+        profile.mark('prompt')
+        while (command := await in_thread(read_command)) is not None:
+            if command:
+                print_result(await run_line_async(session, command))
+                profile.mark('first result')
+    finally:
+        session.close()
+
+def run_script(session, lines, as_json, profile):
+    """Run a script of commands, printing each result as soon as those before it are done."""
+    out = sys.stdout
+
+    def emit(result):
+        print_result(result, as_json, out)
+        profile.mark('first result')
 
-    while True:
+    async def run():
+        # Connect while the offline commands at the top of the script already run
+        if any(needs_connection(line) for line in lines):
+            session.start()
         try:
-            # Read user input
-            command = input(">>> ").strip()
-
-            # Exit condition
-            if command == "exit":
-                print("Exiting the CLI... Unlike your trades, this exit is guaranteed!")
-                break
-
-            # Process commands
-            if command == "fetch_balance":
-                balance = fetch_account_balance(ib)
-                print(f"Account balance: {balance}")
-
-            elif command.startswith("is_market_open"):
-                _, symbol = command.split()
-                is_open = is_market_open(ib, symbol)
-                print(f"Market is {is_open}")
-
-            elif command == "fetch_positions":
-                positions = fetch_positions(ib)
-                for pos in positions:
-                    print(pos)
-
-            elif command.startswith("get_price"):
-                _, symbol = command.split()
-                price = get_real_time_price(ib, symbol)
-                print(f"Real-time price for {symbol}: {price}")
-
-            elif command.startswith("fetch_historical"):
-                _, symbol = command.split()
-                bars = fetch_historical_data(ib, symbol)
-                for bar in bars:
-                    print(bar)
-
-            elif command.startswith("bid_ask_spread"):
-                _, symbol = command.split()
-                spread = bid_ask_spread(ib, symbol)
-                print(f"Bid-Ask Spread for {symbol}: {spread}")
-
-            elif command.startswith("place_market_order"):
-                _, symbol, quantity, action = command.split()
-                trade = place_market_order(ib, symbol, int(quantity), action)
-                print(f"Market order placed. Status: {trade.orderStatus.status} OrderId: {trade.order.orderId}")
-
-            elif command.startswith("place_limit_order"):
-                _, symbol, quantity, price, action = command.split()
-                trade = place_limit_order(ib, symbol, int(quantity), float(price), action)
-                print(f"Limit order placed. Status: {trade.orderStatus.status} OrderId: {trade.order.orderId}")
-
-            elif command.startswith("place_batch_orders"):
-                try:
-                    # Extract batch orders from the input after the command
-                    batch_input = command[len("place_batch_orders"):].strip()
-                    
-                    # Ensure input is not empty
-                    if not batch_input:
-                        print("No orders provided. Format: <symbol,quantity,price,action> (e.g., AAPL,10,150.0,BUY TSLA,5,700.0,SELL)")
-                        return
-                    
-                    # Parse orders from the batch input
-                    # Format: AAPL,10,150.0,BUY TSLA,5,700.0,SELL
-                    orders = []
-                    for order in batch_input.split():
-                        try:
-                            symbol, quantity, price, action = order.split(',')
-                            quantity = int(quantity)
-                            price = float(price)
-                            action = action.upper()
-            
-                            # Validate the action
-                            if action not in {"BUY", "SELL"}:
-                                print(f"Invalid action for {symbol}. Use 'BUY' or 'SELL'. Skipping this order...")
-                                continue
-            
-                            # Add the parsed order to the list
-                            orders.append((symbol, quantity, price, action))
-                        except ValueError:
-                            print(f"Invalid format for order: {order}. Use <symbol,quantity,price,action>. Skipping this order...")
-            
-                    # Check if any valid orders exist
-                    if not orders:
-                        print("No valid orders to place.")
-                        return
-            
-                    # Place batch orders
-                    print(f"Placing the following batch orders: {orders}")
-                    trades = place_batch_orders(ib, orders)
-            
-                    # Print results of the trades
-                    for trade in trades:
-                        print(f"Order for {trade.contract.symbol}: Status = {trade.orderStatus.status} OrderId = {trade.order.orderId}")
-            
-                except Exception as e:
-                    print(f"An error occurred while processing batch orders: {e}")
-
-            # elif command.startswith("get_order_status"):
-                
-            # elif command.startswith("cancel_order"):
-                
-            
-            elif command == "help":
-                show_help()
-
-            else:
-                print("Invalid command. Type 'help' to see available commands.")
-
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
-    # Disconnect from IB Gateway
-    ib.disconnect()
-    print("Disconnected from IB Gateway.")
+            return await run_script_async(session, lines, emit=emit)
+        finally:
+            session.close()
+
+    # Keep stray prints of the helpers out of the JSON stream
+    with redirect_stdout(sys.stderr if as_json else out):
+        results = asyncio.run(run())
+    return exit_code(results)
+
+def run_remote(lines, mode, as_json):
+    """Run commands on the connection service's session, starting the service if needed."""
+    ensure_service(mode)
+    service = ServiceClient(timeout=None)
+    try:
+        if lines is None:
+            interactive(lambda line: CommandResult(**service.run([line])[0]))
+            return EXIT_OK
+        results = [CommandResult(**r) for r in service.run(lines)]
+    finally:
+        service.close()
+    for result in results:
+        print_result(result, as_json)
+    return exit_code(results)
+
+def read_script(args):
+    """Command lines from -c options, a script file or piped stdin; None for an interactive session."""
+    if args.command:
+        return list(script_lines(args.command))
+    if args.script == '-' or (args.script is None and not sys.stdin.isatty()):
+        return list(script_lines(sys.stdin))
+    if args.script:
+        with open(args.script) as f:
+            return list(script_lines(f))
+    return None
+
+def main():
+    profile = StartupProfile()
+    profile.mark('imports')
+    parser = argparse.ArgumentParser(
+        description="Trade through IB Gateway interactively, or run commands from a script, stdin or -c. "
+                    "Commands that need no connection (help, calculate_pos_size, backtest on CSV files) "
+                    "run without waiting for IB Gateway.",
+        epilog="Exit codes: 0 success, 1 a command failed, 2 bad command or arguments, 3 no connection."
+    )
+    parser.add_argument('script', nargs='?', help="File of commands, one per line; '-' reads stdin")
+    parser.add_argument('-c', '--command', action='append', help="Command to run; may be repeated")
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per command")
+    parser.add_argument('--connect-once', action='store_true',
+                        help="Run the commands on the connection service's session, starting it in the "
+                             "background if needed, so repeated invocations reuse one connection")
+    parser.add_argument('--mode', choices=list(PORTS), default=None,
+                        help="Paper or Live; defaults to the mode chosen in the dashboard settings")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Report on stderr how long each startup phase took")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve latency and error metrics of this session on a local HTTP port")
+    parser.add_argument('--profile-slow', type=float, default=None, metavar='SECONDS',
+                        help="Profile a sample of the commands and keep the profiles of those slower than this")
+    parser.add_argument('--profile-rate', type=float, default=1.0,
+                        help="Share of the commands profiled with --profile-slow (default: all)")
+    args = parser.parse_args()
+
+    mode = args.mode or configured_mode()
+    lines = read_script(args)
+    if args.profile_slow is not None:
+        enable_profiling(args.profile_slow, args.profile_rate)
+    server = MetricsServer(port=args.metrics_port).start() if args.metrics_port is not None else None
+    profile.mark('arguments')
+    if args.connect_once:
+        try:
+            code = run_remote(lines, mode, args.json)
+        except (OSError, RuntimeError) as e:
+            print(f"Cannot reach the connection service: {e}", file=sys.stderr)
+            code = EXIT_CONNECTION
+    else:
+        session = Session(mode, profile, interactive=lines is None)
+        if lines is None:
+            set_persistent_session()
+            asyncio.run(interactive_async(session, profile))
+            code = EXIT_OK
+            if session.ib is not None:
+                print("Disconnected from IB Gateway.")
+        else:
+            code = run_script(session, lines, args.json, profile)
+
+    if server is not None:
+        server.close()
+    profile.mark('exit')
+    if args.profile_startup:
+        print(profile.report(), file=sys.stderr)
+    return code
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
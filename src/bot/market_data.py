@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from ib_insync import util
+
+from pacing import request_scheduler
+from settings import settings_store
+from shared import per_connection
+
+# Market data lines of a basic IB account; set MARKET_DATA_LINES in the settings for more
+MARKET_DATA_LINES = 100
+
+
+def market_data_lines():
+    """Market data lines of the account, as set in the settings."""
+    return int(settings_store().get('MARKET_DATA_LINES', MARKET_DATA_LINES))
+
+
+def contract_key(contract):
+    """Key that identifies a contract independently of the object instance."""
+    if contract.conId:
+        return contract.conId
+    return (contract.secType, contract.symbol, contract.exchange, contract.currency)
+
+
+def has_last(ticker):
+    return not util.isNan(ticker.last)
+
+
+def has_quote(ticker):
+    return ticker.bid > 0 and ticker.ask > 0
+
+
+class TickerCache:
+    """
+    Long-lived market data subscriptions keyed by contract.
+
+    Subscriptions are reused between calls and only the least recently used
+    ones are cancelled once the number of lines exceeds ``max_lines``.
+    Tickers someone follows over time, like a trailing stop, are held and
+    never cancelled for lack of lines until every holder released them.
+    """
+
+    def __init__(self, ib, max_lines=None, max_age=5.0):
+        self.ib = ib
+        self.max_lines = max_lines or market_data_lines()
+        self.max_age = max_age
+        self._subscriptions = OrderedDict()  # key -> (contract, ticker)
+        self._updated = {}  # key -> monotonic time of the last update
+        self._holds = {}  # key -> number of holders
+        ib.disconnectedEvent += self.clear
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def __contains__(self, contract):
+        return contract_key(contract) in self._subscriptions
+
+    def ticker(self, contract):
+        """Return the live ticker for the contract, subscribing if needed."""
+        key = contract_key(contract)
+        entry = self._subscriptions.get(key)
+        if entry is not None:
+            self._subscriptions.move_to_end(key)
+            return entry[1]
+
+        ticker = self.ib.reqMktData(contract)
+        ticker.updateEvent += lambda t, key=key: self._touch(key)
+        self._subscriptions[key] = (contract, ticker)
+        self._evict()
+        return ticker
+
+    def hold(self, contract):
+        """Subscribe if needed and keep the ticker until as many ``release`` calls."""
+        key = contract_key(contract)
+        # Held before subscribing, so a new ticker is not the one evicted to make room
+        self._holds[key] = self._holds.get(key, 0) + 1
+        return self.ticker(contract)
+
+    def release(self, contract):
+        key = contract_key(contract)
+        count = self._holds.get(key, 0) - 1
+        if count > 0:
+            self._holds[key] = count
+        else:
+            self._holds.pop(key, None)
+            # Held tickers may have kept the cache above its lines
+            self._evict()
+
+    def is_held(self, contract):
+        return contract_key(contract) in self._holds
+
+    def get(self, contract, ready=has_last, timeout=2.0):
+        """
+        Return a ticker that satisfies ``ready``.
+
+        A fresh ticker is returned at once, otherwise this waits on the
+        ticker's update event for at most ``timeout`` seconds and returns
+        the ticker in whatever state it is in.
+        """
+        ticker = self.ticker(contract)
+        if self.is_fresh(contract, ready):
+            return ticker
+        self.ib.run(self.wait(ticker, ready, timeout))
+        return ticker
+
+    async def get_async(self, contract, ready=has_last, timeout=2.0):
+        if contract not in self:
+            # New subscriptions wait their turn, so a watchlist does not burst past the message rate
+            await request_scheduler(self.ib).acquire('market_data')
+        ticker = self.ticker(contract)
+        if not self.is_fresh(contract, ready):
+            await self.wait(ticker, ready, timeout)
+        return ticker
+
+    def is_fresh(self, contract, ready=has_last):
+        key = contract_key(contract)
+        entry = self._subscriptions.get(key)
+        if entry is None or not ready(entry[1]):
+            return False
+        updated = self._updated.get(key)
+        return updated is not None and time.monotonic() - updated <= self.max_age
+
+    async def wait(self, ticker, ready=has_last, timeout=2.0):
+        """Wait until ``ready(ticker)`` holds, returning False on timeout."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not ready(ticker):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._next_update(ticker), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    @staticmethod
+    async def _next_update(ticker):
+        return await ticker.updateEvent
+
+    def cancel(self, contract):
+        key = contract_key(contract)
+        entry = self._subscriptions.pop(key, None)
+        self._updated.pop(key, None)
+        if entry is not None and self.ib.isConnected():
+            self.ib.cancelMktData(entry[0])
+
+    def clear(self):
+        """Forget all subscriptions, e.g. after the connection dropped."""
+        self._subscriptions.clear()
+        self._updated.clear()
+
+    def _touch(self, key):
+        if key in self._subscriptions:
+            self._updated[key] = time.monotonic()
+
+    def _evict(self):
+        excess = len(self._subscriptions) - self.max_lines
+        if excess <= 0:
+            return
+        # Least recently used first; when every line is held the cache stays above max_lines
+        for key in [key for key in self._subscriptions if key not in self._holds][:excess]:
+            contract, _ = self._subscriptions.pop(key)
+            self._updated.pop(key, None)
+            if self.ib.isConnected():
+                self.ib.cancelMktData(contract)
+
+
+ticker_cache = per_connection(TickerCache)
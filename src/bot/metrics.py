@@ -0,0 +1,368 @@
+import bisect
+import json
+import random
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from pathlib import Path
+
+# Standard library only, the larger parts imported where used, so the CLI starts quickly
+
+# Local HTTP endpoint of the metrics; the connection service serves on it by default
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 4011
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# IB methods timed by instrument(); the synchronous ones call these, so each call counts once
+BROKER_CALLS = (
+    'reqMktData', 'cancelMktData', 'reqTickersAsync', 'reqRealTimeBars', 'cancelRealTimeBars',
+    'reqHistoricalDataAsync', 'reqHeadTimeStampAsync', 'reqContractDetailsAsync', 'reqMatchingSymbolsAsync',
+    'placeOrder', 'cancelOrder', 'whatIfOrderAsync', 'reqAllOpenOrdersAsync', 'reqOpenOrdersAsync',
+    'reqExecutionsAsync', 'reqPositionsAsync', 'accountSummaryAsync', 'reqAccountSummaryAsync',
+)
+
+# Message rate and pacing errors; history pacing is 162 with 'pacing violation' in the message
+PACING_CODES = {100, 420}
+
+# cProfile captures of slow commands, see CommandProfiler
+PROFILE_DIR = str(Path(__file__).resolve().parent / 'profiles')
+
+
+class Metric:
+    """A named metric with one value per combination of label values."""
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, value in self.samples():
+            lines.append(f"{self.name}{self._label_text(values)} {value:g}")
+        return lines
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.help, 'labels': list(self.labels),
+                'samples': [[list(values), value] for values, value in self.samples()]}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Counts of observations per bucket, with their sum and the largest one."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Counts per bucket, the last one above every bound; then sum, count, max
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+            state[3] = max(state[3], value)
+
+    def samples(self):
+        with self._lock:
+            return [(values, [list(counts), total, count, largest])
+                    for values, (counts, total, count, largest) in self._values.items()]
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count, _) in self.samples():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(values)} {total:g}")
+            lines.append(f"{self.name}_count{self._label_text(values)} {count}")
+        return lines
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+def histogram_quantile(q, buckets, counts):
+    """Estimate a quantile from bucket counts, interpolating inside the bucket like Prometheus."""
+    total = sum(counts)
+    if not total:
+        return float('nan')
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(counts):
+        if n and seen + n >= rank:
+            if i == len(buckets):
+                # Above the highest bound there is nothing to interpolate to
+                return buckets[-1]
+            lower = buckets[i - 1] if i else 0.0
+            return lower + (buckets[i] - lower) * (rank - seen) / n
+        seen += n
+    return buckets[-1]
+
+
+class Metrics:
+    """The metrics of this process: broker calls, IB errors and CLI commands."""
+
+    def __init__(self):
+        self.requests = Histogram('ib_request_seconds', "Latency of calls to IB by method", ['method'])
+        self.in_flight = Gauge('ib_requests_in_flight', "IB requests awaiting their answer", ['method'])
+        self.request_errors = Counter('ib_request_errors_total', "IB calls that raised or timed out", ['method'])
+        self.ib_errors = Counter('ib_errors_total', "Error and warning messages from IB by code", ['code'])
+        self.pacing_violations = Counter('ib_pacing_violations_total', "Pacing violations reported by IB")
+        self.commands = Histogram('cli_command_seconds', "Run time of CLI commands", ['command'])
+        self.command_errors = Counter('cli_command_errors_total', "Failed CLI commands by exit code",
+                                      ['command', 'code'])
+        self.profiles = Counter('cli_command_profiles_total', "Profiles saved of slow CLI commands", ['command'])
+
+    def all(self):
+        return [value for value in vars(self).values() if isinstance(value, Metric)]
+
+    def exposition(self):
+        """All metrics in the Prometheus text format."""
+        return "\n".join(line for metric in self.all() for line in metric.exposition()) + "\n"
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.all()}
+
+
+_metrics = None
+
+
+def metrics():
+    """Return the process-wide metrics."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def _timed(method, label):
+    m = metrics()
+
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            m.request_errors.inc(label)
+            raise
+        finally:
+            m.requests.observe(time.perf_counter() - start, label)
+    return call
+
+
+def _timed_async(method, label):
+    m = metrics()
+
+    async def call(*args, **kwargs):
+        start = time.perf_counter()
+        m.in_flight.inc(label)
+        try:
+            return await method(*args, **kwargs)
+        except BaseException:
+            # Timeouts and cancellations included
+            m.request_errors.inc(label)
+            raise
+        finally:
+            m.in_flight.dec(label)
+            m.requests.observe(time.perf_counter() - start, label)
+    return call
+
+
+def _on_error(reqId, errorCode, errorString, contract):
+    m = metrics()
+    m.ib_errors.inc(str(errorCode))
+    if errorCode in PACING_CODES or (errorCode == 162 and 'pacing violation' in errorString.lower()):
+        m.pacing_violations.inc()
+
+
+_instrumented = weakref.WeakSet()
+
+
+def instrument(ib, methods=BROKER_CALLS):
+    """
+    Time the broker calls of an IB instance and count the errors it
+    receives. The methods are wrapped on the instance, so every caller of
+    this connection is covered. Calling it again does nothing.
+    """
+    import inspect
+    if ib in _instrumented:
+        return ib
+    for name in methods:
+        method = getattr(ib, name, None)
+        if method is None:
+            continue
+        label = name.removesuffix('Async')
+        setattr(ib, name, _timed_async(method, label) if inspect.iscoroutinefunction(method)
+                else _timed(method, label))
+    ib.errorEvent += _on_error
+    _instrumented.add(ib)
+    return ib
+
+
+@dataclass
+class ProfileCapture:
+    command: str
+    elapsed: float
+    path: str
+    taken: float  # epoch seconds
+
+    def summary(self):
+        return f"{time.strftime('%H:%M:%S', time.localtime(self.taken))} {self.command} " \
+               f"{self.elapsed * 1000:.0f} ms: python -m pstats {self.path}"
+
+
+class CommandProfiler:
+    """
+    Runs cProfile on a sample of the commands and keeps the profiles of
+    those slower than ``threshold`` seconds. One command is profiled at a
+    time; commands running concurrently on the event loop show up in its
+    profile too. Only the newest ``keep`` profiles are kept on disk.
+    """
+
+    def __init__(self, threshold=1.0, rate=0.1, directory=PROFILE_DIR, keep=50):
+        self.threshold = threshold
+        self.rate = rate
+        self.directory = Path(directory)
+        self.keep = keep
+        self.captures = []
+        self._active = False
+
+    def start(self):
+        """A running profiler if this command is sampled, else None."""
+        if self._active or random.random() >= self.rate:
+            return None
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active, e.g. the whole process runs under cProfile
+            return None
+        self._active = True
+        return profile
+
+    def stop(self, profile, command, elapsed):
+        profile.disable()
+        self._active = False
+        if elapsed < self.threshold:
+            return None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        taken = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(taken))}.{int(taken * 1000) % 1000:03d}"
+        path = self.directory / f"{stamp}-{command}.prof"
+        profile.dump_stats(path)
+        capture = ProfileCapture(command, elapsed, str(path), taken)
+        self.captures.append(capture)
+        metrics().profiles.inc(command)
+        for old in sorted(self.directory.glob('*.prof'))[:-self.keep]:
+            old.unlink(missing_ok=True)
+        del self.captures[:-self.keep]
+        return capture
+
+
+_profiler = None
+
+
+def command_profiler():
+    """The profiler of slow commands, or None unless profiling was switched on."""
+    return _profiler
+
+
+def enable_profiling(threshold=1.0, rate=0.1, directory=PROFILE_DIR):
+    global _profiler
+    _profiler = CommandProfiler(threshold, rate, directory)
+    return _profiler
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP from a background thread: ``/metrics`` in
+    the Prometheus text format and ``/metrics.json`` for the dashboard.
+    """
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics().exposition().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    profiler = command_profiler()
+                    snapshot = {'metrics': metrics().snapshot(),
+                                'profiles': [vars(c) for c in profiler.captures] if profiler else []}
+                    body, content_type = json.dumps(snapshot).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
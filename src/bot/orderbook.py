@@ -0,0 +1,160 @@
+import time
+from dataclasses import dataclass, field
+
+from market_data import ticker_cache
+from pacing import request_scheduler
+from shared import per_connection
+
+
+@dataclass
+class OrderRecord:
+    """Lifecycle of one order, with aggregates kept up to date as events arrive."""
+    trade: object
+    transitions: list = field(default_factory=list)  # (status, monotonic time)
+    submitted_at: float = None
+    arrival_price: float = None
+    first_fill_at: float = None
+    last_fill_at: float = None
+    filled: float = 0.0
+    fill_value: float = 0.0
+    commissions: dict = field(default_factory=dict)  # execId -> commission
+
+    @property
+    def status(self):
+        return self.trade.orderStatus.status
+
+    @property
+    def commission(self):
+        return sum(self.commissions.values())
+
+    @property
+    def avg_fill_price(self):
+        return self.fill_value / self.filled if self.filled else None
+
+    @property
+    def fill_latency(self):
+        """Seconds from submission to the first fill."""
+        if self.submitted_at is None or self.first_fill_at is None:
+            return None
+        return self.first_fill_at - self.submitted_at
+
+    @property
+    def slippage(self):
+        """Average fill price versus the arrival price per share; positive is worse for us."""
+        if self.arrival_price is None or not self.filled:
+            return None
+        sign = 1 if self.trade.order.action == 'BUY' else -1
+        return sign * (self.avg_fill_price - self.arrival_price)
+
+    def summary(self):
+        order = self.trade.order
+        text = f"Order {order.orderId} ({self.trade.contract.symbol} {order.action} {order.totalQuantity} " \
+               f"{order.orderType}): {self.status}, filled {self.filled:g}"
+        if self.filled:
+            text += f" @ {self.avg_fill_price:.4f}, commission {self.commission:.2f}"
+        if self.fill_latency is not None:
+            text += f", first fill after {self.fill_latency * 1000:.0f} ms"
+        if self.slippage is not None:
+            text += f", slippage {self.slippage:+.4f}/share"
+        if self.transitions:
+            start = self.transitions[0][1]
+            text += "\n  " + " -> ".join(f"{status} (+{(t - start) * 1000:.0f} ms)" for status, t in self.transitions)
+        return text
+
+
+class OrderBook:
+    """
+    Index of every order this connection sees, keyed by orderId and permId.
+
+    State transitions, fills and commissions are recorded from IB's events
+    with monotonic timestamps, so status, fill latency and slippage queries
+    are dictionary lookups.
+    """
+
+    def __init__(self, ib):
+        self.ib = ib
+        self._by_order_id = {}
+        self._by_perm_id = {}
+        ib.newOrderEvent += self._on_new_order
+        ib.openOrderEvent += self._record
+        ib.orderStatusEvent += self._record
+        ib.execDetailsEvent += self._on_exec_details
+        ib.commissionReportEvent += self._on_commission_report
+        for trade in ib.trades():
+            self._record(trade)
+
+    def get(self, order_id):
+        """Record for one of our order ids, or for any client's permId."""
+        return self._by_order_id.get(order_id) or self._by_perm_id.get(order_id)
+
+    def by_perm_id(self, perm_id):
+        return self._by_perm_id.get(perm_id)
+
+    def trade(self, order_id):
+        record = self.get(order_id)
+        return record.trade if record else None
+
+    def open_trades(self):
+        records = {id(r): r for r in (*self._by_order_id.values(), *self._by_perm_id.values())}
+        return [r.trade for r in records.values() if not r.trade.isDone()]
+
+    async def refresh_async(self):
+        """Pull open orders of all clients into the book and return the open trades."""
+        # Refreshes asked for at the same time share one request
+        trades = await request_scheduler(self.ib).run('account', 'open_orders', self.ib.reqAllOpenOrdersAsync)
+        for trade in trades:
+            self._record(trade)
+        return self.open_trades()
+
+    def _record(self, trade):
+        order = trade.order
+        # Order ids are only unique per client, so only ours are indexed by orderId
+        ours = order.orderId and order.clientId == self.ib.client.clientId
+        record = self._by_perm_id.get(order.permId)
+        if record is None and ours:
+            record = self._by_order_id.get(order.orderId)
+        if record is None:
+            record = OrderRecord(trade)
+        elif record.trade is not trade:
+            record.trade = trade
+        if ours:
+            self._by_order_id[order.orderId] = record
+        if order.permId:
+            self._by_perm_id[order.permId] = record
+        status = trade.orderStatus.status
+        if not record.transitions or record.transitions[-1][0] != status:
+            record.transitions.append((status, time.monotonic()))
+        return record
+
+    def _on_new_order(self, trade):
+        record = self._record(trade)
+        record.submitted_at = record.transitions[0][1]
+        record.arrival_price = self._arrival_price(trade)
+
+    def _arrival_price(self, trade):
+        cache = ticker_cache(self.ib)
+        if trade.contract in cache:
+            ticker = cache.ticker(trade.contract)
+            price = ticker.midpoint()
+            if price == price:
+                return price
+        order = trade.order
+        return order.lmtPrice if order.orderType == 'LMT' else None
+
+    def _on_exec_details(self, trade, fill):
+        record = self._record(trade)
+        if fill.execution.execId in record.commissions:
+            return
+        record.commissions[fill.execution.execId] = 0.0
+        now = time.monotonic()
+        if record.first_fill_at is None:
+            record.first_fill_at = now
+        record.last_fill_at = now
+        record.filled += fill.execution.shares
+        record.fill_value += fill.execution.shares * fill.execution.price
+
+    def _on_commission_report(self, trade, fill, report):
+        self._record(trade).commissions[fill.execution.execId] = report.commission
+
+
+order_book = per_connection(OrderBook)
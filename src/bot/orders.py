@@ -0,0 +1,546 @@
+import asyncio
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from ib_insync import Order
+
+from account import account_state
+from contracts import contract_registry, registry_key, round_to_tick
+from market_data import ticker_cache
+from orderbook import order_book
+from pacing import TokenBucket, request_scheduler
+from risk import check_legs_async
+
+# Order states that mean IB accepted or rejected the order.
+ACK_STATES = {'PreSubmitted', 'Submitted', 'Filled'}
+REJECT_STATES = {'Cancelled', 'ApiCancelled', 'Inactive'}
+
+
+@dataclass
+class Leg:
+    """One limit order of a batch, with an optional planned stop used by the risk checks."""
+    symbol: str
+    quantity: int
+    price: float
+    action: str = 'BUY'
+    stop: float = None
+
+    def __post_init__(self):
+        self.symbol = self.symbol.strip().upper()
+        self.quantity = int(self.quantity)
+        self.price = float(self.price)
+        self.action = self.action.strip().upper()
+        self.stop = float(self.stop) if self.stop not in (None, '') else None
+        if self.action not in {"BUY", "SELL"}:
+            raise ValueError(f"Invalid action for {self.symbol}. Use 'BUY' or 'SELL'.")
+
+
+@dataclass
+class LegResult:
+    leg: Leg
+    trade: object = None
+    status: str = ''
+    latency: float = None
+    error: str = ''
+
+    @property
+    def acknowledged(self):
+        return self.status in ACK_STATES
+
+    @property
+    def order_id(self):
+        return self.trade.order.orderId if self.trade else None
+
+    def summary(self):
+        latency = f"{self.latency * 1000:.0f} ms" if self.latency is not None else "-"
+        line = f"{self.leg.symbol} {self.leg.action} {self.leg.quantity} @ {self.leg.price}: " \
+               f"Status = {self.status or 'Unknown'} OrderId = {self.order_id} Latency = {latency}"
+        return line + (f" Error = {self.error}" if self.error else "")
+
+
+@dataclass
+class BatchResult:
+    results: list = field(default_factory=list)
+    elapsed: float = 0.0
+    skipped: dict = field(default_factory=dict)  # symbol -> why nothing was sent for it
+
+    @property
+    def acknowledged(self):
+        return [r for r in self.results if r.acknowledged]
+
+    @property
+    def rejected(self):
+        return [r for r in self.results if not r.acknowledged]
+
+    @property
+    def throughput(self):
+        """Acknowledged legs per second."""
+        return len(self.acknowledged) / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        lines = [r.summary() for r in self.results]
+        latencies = sorted(r.latency for r in self.acknowledged)
+        lines.append(
+            f"{len(self.acknowledged)}/{len(self.results)} legs acknowledged in {self.elapsed:.2f}s "
+            f"({self.throughput:.1f} legs/s)"
+            + (f", median ack {latencies[len(latencies) // 2] * 1000:.0f} ms" if latencies else "")
+        )
+        lines.extend(f"{symbol}: skipped, {reason}" for symbol, reason in self.skipped.items())
+        return "\n".join(lines)
+
+
+def parse_leg(text):
+    """Parse an inline leg such as ``AAPL,10,150.0,BUY`` or ``AAPL,10,150.0,BUY,145.0`` with a stop."""
+    try:
+        fields = text.split(',')
+        if len(fields) not in (4, 5):
+            raise ValueError(f"expected 4 or 5 fields, got {len(fields)}")
+        return Leg(*fields)
+    except ValueError as e:
+        raise ValueError(f"Invalid format for order: {text}. Use <symbol,quantity,price,action[,stop]>. ({e})")
+
+
+def load_legs(path):
+    """Load legs from a CSV file with a symbol,quantity,price,action[,stop] header or a JSON list."""
+    path = Path(path)
+    with open(path, newline='') as f:
+        if path.suffix.lower() == '.json':
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    legs = []
+    for row in rows:
+        if isinstance(row, dict):
+            legs.append(Leg(row['symbol'], row['quantity'], row['price'], row.get('action') or 'BUY', row.get('stop')))
+        else:
+            legs.append(Leg(*row))
+    return legs
+
+
+async def wait_for_status(trade, states, timeout):
+    """Wait until the trade reaches one of ``states``, returning False on timeout."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while trade.orderStatus.status not in states:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(_next_status(trade), remaining)
+        except asyncio.TimeoutError:
+            return False
+    return True
+
+
+async def _next_status(trade):
+    return await trade.statusEvent
+
+
+def last_error(trade):
+    for entry in reversed(trade.log):
+        if entry.errorCode:
+            return f"{entry.errorCode}: {entry.message}"
+    return ''
+
+
+def _order_pacing(ib, rate=None):
+    """
+    Wait for the next order message: its turn at the connection's request
+    scheduler, ahead of queued data requests, and at most ``rate`` per
+    second for this batch if given.
+    """
+    scheduler = request_scheduler(ib)
+    bucket = TokenBucket(rate) if rate else None
+
+    async def pace():
+        if bucket is not None:
+            await bucket.acquire()
+        await scheduler.acquire('order')
+    return pace
+
+
+async def submit_batch_async(ib, legs, rate=None, timeout=10.0, limits=None, account=''):
+    """
+    Qualify all contracts concurrently, then send the orders through the
+    connection's request scheduler, at most ``rate`` per second if given,
+    and wait for each to be acknowledged.
+    With ``limits``, legs that fail the pre-trade risk checks are rejected
+    before any order is sent. ``account`` picks the account on logins that
+    manage several.
+    """
+    start = time.perf_counter()
+    infos = await contract_registry(ib).resolve_async([leg.symbol for leg in legs])
+    checks = (await check_legs_async(ib, legs, limits, infos, account)).checks if limits else None
+    pace = _order_pacing(ib, rate)
+
+    async def submit(i, leg):
+        info = infos.get(registry_key(leg.symbol))
+        if info is None:
+            return LegResult(leg, status='Rejected', error="Unknown contract")
+        if checks and not checks[i].passed:
+            return LegResult(leg, status='Rejected', error="; ".join(checks[i].errors))
+        await pace()
+        order = Order(action=leg.action, totalQuantity=leg.quantity, orderType='LMT', lmtPrice=leg.price,
+                      account=account)
+        sent = time.perf_counter()
+        trade = ib.placeOrder(info.contract, order)
+        result = LegResult(leg, trade)
+        if await wait_for_status(trade, ACK_STATES | REJECT_STATES, timeout):
+            result.latency = time.perf_counter() - sent
+        else:
+            result.error = f"No acknowledgement within {timeout}s"
+        result.status = trade.orderStatus.status
+        if not result.error and not result.acknowledged:
+            result.error = last_error(trade)
+        return result
+
+    results = await asyncio.gather(*(submit(i, leg) for i, leg in enumerate(legs)))
+    return BatchResult(list(results), time.perf_counter() - start)
+
+
+def submit_batch(ib, legs, rate=None, timeout=10.0, limits=None, account=''):
+    """Blocking wrapper around ``submit_batch_async``."""
+    return ib.run(submit_batch_async(ib, legs, rate, timeout, limits, account))
+
+
+def parse_trail(text):
+    """Trailing distance ``2%`` as (None, 2.0) or ``1.5`` as (1.5, None): (amount, percent)."""
+    text = text.strip()
+    value = float(text.rstrip('%'))
+    if not value > 0:
+        raise ValueError(f"Trailing distance must be positive: {text}")
+    return (None, value) if text.endswith('%') else (value, None)
+
+
+@dataclass
+class Bracket:
+    """
+    Exits for a position: a take-profit limit and a stop, fixed or trailing
+    by an amount or a percent. With ``entry`` the exits are children of an
+    entry limit order and work once it fills; without one they protect
+    shares already held and cancel each other as an OCA group.
+    """
+    symbol: str
+    quantity: int
+    action: str = 'BUY'  # side of the entry, or of the position being protected
+    entry: float = None
+    take_profit: float = None
+    stop: float = None  # with a trail, the initial trailing stop price
+    trail_amount: float = None
+    trail_percent: float = None
+    account: str = ''
+
+    def __post_init__(self):
+        self.symbol = self.symbol.strip().upper()
+        self.quantity = int(self.quantity)
+        self.action = self.action.strip().upper()
+        if self.action not in {"BUY", "SELL"}:
+            raise ValueError(f"Invalid action for {self.symbol}. Use 'BUY' or 'SELL'.")
+        if not self.quantity > 0:
+            raise ValueError(f"Quantity for {self.symbol} must be positive.")
+        if self.trail_amount is not None and self.trail_percent is not None:
+            raise ValueError(f"Trail {self.symbol} by an amount or by a percent, not both.")
+        if self.take_profit is None and self.stop is None and not self.trailing:
+            raise ValueError(f"A bracket for {self.symbol} needs a take-profit, a stop or a trail.")
+        if self.entry is not None:
+            # Profit is taken beyond the entry and the stop sits on the other side of it
+            sign = 1 if self.action == 'BUY' else -1
+            if self.take_profit is not None and not (self.take_profit - self.entry) * sign > 0:
+                raise ValueError(f"Take-profit {self.take_profit} of {self.symbol} is on the wrong side of the entry.")
+            if self.stop is not None and not (self.entry - self.stop) * sign > 0:
+                raise ValueError(f"Stop {self.stop} of {self.symbol} is on the wrong side of the entry.")
+
+    @property
+    def trailing(self):
+        return self.trail_amount is not None or self.trail_percent is not None
+
+    @property
+    def exit_action(self):
+        return 'SELL' if self.action == 'BUY' else 'BUY'
+
+    def describe(self):
+        parts = [f"{self.symbol} {self.action} {self.quantity}"]
+        if self.entry is not None:
+            parts.append(f"@ {self.entry}")
+        if self.take_profit is not None:
+            parts.append(f"take-profit {self.take_profit}")
+        if self.trailing:
+            parts.append(f"trail {self.trail_amount}" if self.trail_amount is not None
+                         else f"trail {self.trail_percent}%")
+        elif self.stop is not None:
+            parts.append(f"stop {self.stop}")
+        return " ".join(parts)
+
+
+def bracket_orders(ib, bracket, account=''):
+    """
+    The orders of a bracket in transmit order. With an entry every order but
+    the last is sent with ``transmit=False`` so IB activates the group as one
+    through the parent. Exits of held shares have no parent to release them,
+    so each is transmitted and the OCA group links them.
+    """
+    has_parent = bracket.entry is not None
+
+    def order(**fields):
+        return Order(orderId=ib.client.getReqId(), totalQuantity=bracket.quantity,
+                     account=bracket.account or account, transmit=not has_parent, **fields)
+
+    orders = []
+    if bracket.entry is not None:
+        orders.append(order(action=bracket.action, orderType='LMT', lmtPrice=bracket.entry))
+    exits = []
+    if bracket.take_profit is not None:
+        exits.append(order(action=bracket.exit_action, orderType='LMT', lmtPrice=bracket.take_profit))
+    if bracket.trailing:
+        stop = order(action=bracket.exit_action, orderType='TRAIL')
+        if bracket.trail_percent is not None:
+            stop.trailingPercent = bracket.trail_percent
+        else:
+            stop.auxPrice = bracket.trail_amount
+        if bracket.stop is not None:
+            stop.trailStopPrice = bracket.stop
+        exits.append(stop)
+    elif bracket.stop is not None:
+        exits.append(order(action=bracket.exit_action, orderType='STP', auxPrice=bracket.stop))
+    for exit_order in exits:
+        if orders:
+            exit_order.parentId = orders[0].orderId
+        elif len(exits) > 1:
+            # Protecting held shares: a fill of one exit cancels the other
+            exit_order.ocaGroup = f"{bracket.symbol}-{exits[0].orderId}-{int(time.time())}"
+            exit_order.ocaType = 1
+    orders.extend(exits)
+    orders[-1].transmit = True
+    return orders
+
+
+@dataclass
+class BracketResult:
+    bracket: Bracket
+    trades: list = field(default_factory=list)
+    status: str = ''
+    latency: float = None
+    error: str = ''
+
+    @property
+    def acknowledged(self):
+        return bool(self.trades) and not self.error \
+            and all(t.orderStatus.status in ACK_STATES for t in self.trades)
+
+    def summary(self):
+        latency = f"{self.latency * 1000:.0f} ms" if self.latency is not None else "-"
+        ids = "/".join(str(t.order.orderId) for t in self.trades) or None
+        line = f"{self.bracket.describe()}: Status = {self.status or 'Unknown'} OrderIds = {ids} Latency = {latency}"
+        return line + (f" Error = {self.error}" if self.error else "")
+
+
+async def place_brackets_async(ib, brackets, rate=None, timeout=10.0, account=''):
+    """
+    Place many brackets, each as one transmit group, paced like
+    ``submit_batch_async``, and wait until every order of a group is
+    acknowledged. Returns a ``BatchResult`` of ``BracketResult``.
+    """
+    start = time.perf_counter()
+    infos = await contract_registry(ib).resolve_async([b.symbol for b in brackets])
+    pace = _order_pacing(ib, rate)
+
+    async def place(bracket):
+        info = infos.get(registry_key(bracket.symbol))
+        if info is None:
+            return BracketResult(bracket, status='Rejected', error="Unknown contract")
+        result = BracketResult(bracket)
+        sent = None
+        for order in bracket_orders(ib, bracket, account):
+            await pace()
+            sent = sent or time.perf_counter()
+            result.trades.append(ib.placeOrder(info.contract, order))
+        acked = await asyncio.gather(*(wait_for_status(t, ACK_STATES | REJECT_STATES, timeout) for t in result.trades))
+        statuses = [t.orderStatus.status for t in result.trades]
+        rejected = [t for t in result.trades if t.orderStatus.status not in ACK_STATES]
+        result.status = next((s for s in statuses if s not in ACK_STATES), statuses[0])
+        if not all(acked):
+            result.error = f"No acknowledgement within {timeout}s"
+        elif rejected:
+            result.error = last_error(rejected[0])
+        else:
+            result.latency = time.perf_counter() - sent
+        return result
+
+    results = await asyncio.gather(*(place(b) for b in brackets))
+    return BatchResult(list(results), time.perf_counter() - start)
+
+
+def place_brackets(ib, brackets, rate=None, timeout=10.0, account=''):
+    """Blocking wrapper around ``place_brackets_async``."""
+    return ib.run(place_brackets_async(ib, brackets, rate, timeout, account))
+
+
+# Working orders of these types on the exit side count as a position's stop
+STOP_TYPES = {'STP', 'STP LMT', 'TRAIL', 'TRAIL LIMIT'}
+
+
+async def protect_positions_async(ib, take_profit=None, stop=None, trail=(None, None), symbols=None,
+                                  rate=None, timeout=10.0):
+    """
+    Place exits for every held position, or those of ``symbols``, that has
+    no working stop yet, as one paced batch of brackets. ``take_profit``
+    and ``stop`` are distances from the market price in percent; ``trail``
+    is the (amount, percent) pair of ``parse_trail``.
+    """
+    positions = account_state(ib).positions
+    # Copied before the first await: the table moves rows around as positions change
+    rows = list(zip(positions.column('account'), positions.column('contract'),
+                    positions.column('position').tolist(), positions.column('market_price').tolist()))
+    wanted = {s.upper() for s in symbols} if symbols else None
+    # Orders placed without an account belong to the only one of a single-account login
+    accounts = ib.managedAccounts()
+    default_account = accounts[0] if len(accounts) == 1 else ''
+    protected = {(t.order.account or default_account, t.contract.conId, t.order.action)
+                 for t in order_book(ib).open_trades() if t.order.orderType in STOP_TYPES}
+    rows = [(account, contract, held, price) for account, contract, held, price in rows
+            if not (wanted and contract.symbol not in wanted)
+            and (account, contract.conId, 'SELL' if held > 0 else 'BUY') not in protected]
+    infos = await contract_registry(ib).resolve_async([contract for _, contract, _, _ in rows])
+    cache = ticker_cache(ib)
+    brackets, skipped = [], {}
+    for account, contract, held, price in rows:
+        if not price > 0:
+            ticker = await cache.get_async(contract)
+            price = ticker.marketPrice()
+        if not price > 0:
+            skipped[contract.symbol] = "no market price"
+            continue
+        info = infos.get(registry_key(contract))
+        tick = info.minTick if info is not None else 0.01
+        sign = 1 if held > 0 else -1
+        brackets.append(Bracket(
+            contract.symbol, abs(held), 'BUY' if held > 0 else 'SELL',
+            take_profit=round_to_tick(price * (1 + sign * take_profit / 100), tick) if take_profit else None,
+            stop=round_to_tick(price * (1 - sign * stop / 100), tick) if stop else None,
+            trail_amount=trail[0], trail_percent=trail[1], account=account,
+        ))
+    result = await place_brackets_async(ib, brackets, rate, timeout)
+    result.skipped = skipped
+    return result
+
+
+@dataclass
+class AmendResult:
+    order_id: int
+    trade: object = None
+    old_price: float = None
+    new_price: float = None
+    latency: float = None
+    error: str = ''
+    price_name: str = 'limit price'
+
+    @property
+    def acknowledged(self):
+        return self.latency is not None and not self.error
+
+    def report(self):
+        if self.acknowledged:
+            return f"Order {self.order_id}: {self.price_name} {self.old_price} -> {self.new_price} " \
+                   f"acknowledged in {self.latency * 1000:.0f} ms"
+        return f"Order {self.order_id}: {self.price_name} not changed. Error = {self.error}"
+
+
+# Order messages that do not reject it, e.g. 399 for one queued outside regular hours; also 2100-2199
+ORDER_WARNING_CODES = {110, 165, 399, 404, 434, 492, 10167}
+
+
+def is_warning(error_code):
+    return error_code in ORDER_WARNING_CODES or 2100 <= error_code < 2200
+
+
+async def wait_for_amend(ib, trade, timeout, attr=None, price=None):
+    """
+    Wait for IB to echo the modified order back through ``openOrder`` with
+    ``price`` in its ``attr`` field; echoes still carrying the old price do
+    not count. Returns an error message, or an empty string on success.
+    """
+    done = asyncio.get_event_loop().create_future()
+    order_id = trade.order.orderId
+
+    def on_open_order(t):
+        # ib_insync copies the echoed prices onto our order before emitting
+        if t is trade and not done.done() and (attr is None or _same_price(getattr(t.order, attr), price)):
+            done.set_result('')
+
+    def on_error(req_id, error_code, error_string, contract):
+        if req_id == order_id and not is_warning(error_code) and not done.done():
+            done.set_result(f"{error_code}: {error_string}")
+
+    ib.openOrderEvent += on_open_order
+    ib.errorEvent += on_error
+    try:
+        return await asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        return f"No acknowledgement within {timeout}s"
+    finally:
+        ib.openOrderEvent -= on_open_order
+        ib.errorEvent -= on_error
+
+
+def _same_price(a, b):
+    return abs(a - b) < 1e-9
+
+
+# The price field amended on each order type: (Order attribute, name, order description)
+AMEND_FIELDS = {
+    'LMT': ('lmtPrice', 'limit price', 'a limit order'),
+    'STP': ('auxPrice', 'stop price', 'a stop order'),
+}
+
+
+async def amend_price_async(ib, trade, new_price, order_type, timeout=5.0):
+    """
+    Modify the price of a working order in place by re-sending it under
+    the same orderId, keeping its queue position and any partial fills.
+    """
+    attr, name, kind = AMEND_FIELDS[order_type]
+    result = AmendResult(trade.order.orderId, trade, getattr(trade.order, attr), new_price, price_name=name)
+    if trade.order.orderType != order_type:
+        result.error = f"Order is a {trade.order.orderType} order, not {kind}"
+        return result
+    if trade.isDone():
+        result.error = f"Order is already {trade.orderStatus.status}"
+        return result
+
+    setattr(trade.order, attr, new_price)
+    sent = time.perf_counter()
+    ib.placeOrder(trade.contract, trade.order)
+    result.error = await wait_for_amend(ib, trade, timeout, attr, new_price)
+    if result.error:
+        # IB kept the old price, so put it back on our copy of the order
+        setattr(trade.order, attr, result.old_price)
+    else:
+        result.latency = time.perf_counter() - sent
+    return result
+
+
+async def amend_limit_price_async(ib, trade, new_price, timeout=5.0):
+    return await amend_price_async(ib, trade, new_price, 'LMT', timeout)
+
+
+async def amend_stop_price_async(ib, trade, new_price, timeout=5.0):
+    return await amend_price_async(ib, trade, new_price, 'STP', timeout)
+
+
+async def reprice_orders_async(ib, trades_and_prices, rate=None, timeout=5.0):
+    """Amend many working limit orders at once, paced below IB's message limit."""
+    pace = _order_pacing(ib, rate)
+
+    async def amend(trade, new_price):
+        await pace()
+        return await amend_limit_price_async(ib, trade, new_price, timeout)
+
+    return list(await asyncio.gather(*(amend(trade, price) for trade, price in trades_and_prices)))
+
+
+def reprice_orders(ib, trades_and_prices, rate=None, timeout=5.0):
+    """Blocking wrapper around ``reprice_orders_async``."""
+    return ib.run(reprice_orders_async(ib, trades_and_prices, rate, timeout))
@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import time
+import weakref
+from dataclasses import dataclass
+
+from shared import per_connection
+
+# IB disconnects clients above 50 messages per second; stay a little below
+IB_MESSAGE_RATE = 45
+
+
+class TokenBucket:
+    """
+    Async token bucket that spaces out requests to a steady rate.
+
+    ``capacity`` is the largest burst allowed; the default of one token
+    keeps any one-second window at or below ``rate`` requests.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+@dataclass
+class RequestClass:
+    """Limits of one kind of request; lower priorities get their message slot first."""
+    priority: int
+    rate: float = None  # requests per second of this kind, on top of the shared message rate
+    capacity: int = 1
+    max_in_flight: int = None
+    reuse: float = 0.0  # seconds a result is handed to identical requests instead of asking again
+
+
+# Small-bar history stays within IB's 60 requests per 10 minutes; at most 50 history requests open
+REQUEST_CLASSES = {
+    'order': RequestClass(priority=0),
+    'whatif': RequestClass(priority=1),
+    'account': RequestClass(priority=2),
+    'market_data': RequestClass(priority=3),
+    'contract': RequestClass(priority=4, max_in_flight=50),
+    'history': RequestClass(priority=5, rate=5, capacity=10, max_in_flight=50, reuse=15.0),
+    'small_bars': RequestClass(priority=5, rate=30 / 600, capacity=30, max_in_flight=50, reuse=15.0),
+}
+
+
+def history_class(bar_size):
+    """Request class of a historical data request for the bar size, e.g. '5 secs'."""
+    count, unit = bar_size.split()
+    return 'small_bars' if unit.startswith('sec') and int(count) <= 30 else 'history'
+
+
+class RequestScheduler:
+    """
+    Paces every request of one connection. All of them share IB's message
+    rate and are let through by priority, so orders overtake queued history
+    requests; each class can add its own rate and concurrency limit.
+    Identical requests in flight are merged into one, and classes with
+    ``reuse`` hand a fresh result to identical requests instead of
+    asking IB again.
+    """
+
+    def __init__(self, rate=IB_MESSAGE_RATE, classes=None):
+        self.classes = classes or REQUEST_CLASSES
+        self._bucket = TokenBucket(rate)
+        self._buckets = {name: TokenBucket(c.rate, c.capacity) for name, c in self.classes.items() if c.rate}
+        self._slots = {name: asyncio.Semaphore(c.max_in_flight) for name, c in self.classes.items()
+                       if c.max_in_flight}
+        self._waiting = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._pending = {}  # (kind, key) -> future of the request in flight
+        self._recent = {}  # (kind, key) -> (monotonic time, result)
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    async def acquire(self, kind):
+        """Wait until a request of this kind may be sent."""
+        bucket = self._buckets.get(kind)
+        if bucket is not None:
+            await bucket.acquire()
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (self.classes[kind].priority, next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiting:
+            if self._waiting[0][2].done():
+                # The waiter was cancelled
+                heapq.heappop(self._waiting)
+                continue
+            await self._bucket.acquire()
+            # Whatever has the highest priority now goes, even if it arrived while we waited
+            while self._waiting:
+                _, _, future = heapq.heappop(self._waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def run(self, kind, key, request):
+        """
+        Send ``request()``, a coroutine function, once a request of this kind
+        may go out. ``key`` identifies identical requests; None never merges.
+        """
+        if key is None:
+            return await self._send(kind, request)
+        key = (kind, key)
+        recent = self._recent.get(key)
+        if recent is not None and time.monotonic() - recent[0] <= self.classes[kind].reuse:
+            return recent[1]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._send(kind, request, key))
+        return await asyncio.shield(pending)
+
+    async def _send(self, kind, request, key=None):
+        slots = self._slots.get(kind)
+        try:
+            if slots is not None:
+                await slots.acquire()
+            try:
+                await self.acquire(kind)
+                result = await request()
+            finally:
+                if slots is not None:
+                    slots.release()
+        finally:
+            self._pending.pop(key, None)
+        if key is not None and self.classes[kind].reuse:
+            self._recent[key] = (time.monotonic(), result)
+            self._expire()
+        return result
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, (sent, _) in list(self._recent.items()):
+            if now - sent > self.classes[key[0]].reuse:
+                del self._recent[key]
+
+
+# Its locks, semaphores and dispatcher belong to one event loop, so each loop gets its own
+_schedulers = per_connection(lambda ib: weakref.WeakKeyDictionary())  # event loop -> RequestScheduler
+
+
+def request_scheduler(ib):
+    """The request scheduler of this connection on the current event loop."""
+    schedulers = _schedulers(ib)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Called ahead of ib.run(), which runs the loop of this thread
+        loop = asyncio.get_event_loop_policy().get_event_loop()
+    scheduler = schedulers.get(loop)
+    if scheduler is None:
+        scheduler = schedulers[loop] = RequestScheduler()
+    return scheduler
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+from ib_insync import IB
+
+from bars import BAR_DTYPE
+from connection import IB_HOST, PORTS, RECORDER_CLIENT_ID, ServiceClient, client_port, configured_mode
+from contracts import contract_registry
+from market_data import market_data_lines, ticker_cache
+from pacing import request_scheduler
+
+RECORD_DIR = Path(__file__).resolve().parent / 'recordings'
+
+# Quote snapshot of one ticker per update batch from IB; time is when it was received, in ns since the epoch
+TICK_DTYPE = np.dtype([
+    ('time', '<i8'),
+    ('symbol', '<i4'),  # index into the recording's symbols.json
+    ('bid', '<f8'),
+    ('ask', '<f8'),
+    ('last', '<f8'),
+    ('bid_size', '<f8'),
+    ('ask_size', '<f8'),
+    ('last_size', '<f8'),
+    ('volume', '<f8'),
+])
+
+# One 5 second real-time bar
+RTBAR_DTYPE = np.dtype([
+    ('time', '<i8'),
+    ('symbol', '<i4'),
+    ('bar_time', '<i8'),  # bar start, seconds since the epoch
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+    ('wap', '<f8'),
+    ('count', '<i4'),
+])
+
+# Every INDEX_EVERY records the index gets the time and row of the record starting the block
+INDEX_DTYPE = np.dtype([('time', '<i8'), ('row', '<i8')])
+INDEX_EVERY = 4096
+
+LOGS = {'ticks': TICK_DTYPE, 'bars': RTBAR_DTYPE}
+
+
+class RecordLog:
+    """
+    Append-only file of fixed-width records in time order, with a sparse
+    index file pointing at every ``INDEX_EVERY``-th record.
+
+    Only the writer thread appends. Reads memory-map the file, so a time
+    range comes back as a view of the mapped records without a copy.
+    """
+
+    def __init__(self, root, kind):
+        self.dtype = LOGS[kind]
+        self.path = Path(root) / f'{kind}.bin'
+        self.index_path = Path(root) / f'{kind}.idx'
+        self._last_time = None
+
+    def __len__(self):
+        return self.path.stat().st_size // self.dtype.itemsize if self.path.exists() else 0
+
+    def append(self, records):
+        """Write a batch of records; times are clamped so the log never goes back in time."""
+        if not len(records):
+            return
+        n = len(self)
+        if self._last_time is None:
+            # Drop a record torn by a crash mid-write before appending after it
+            if self.path.exists() and self.path.stat().st_size != n * self.dtype.itemsize:
+                os.truncate(self.path, n * self.dtype.itemsize)
+            self._last_time = int(self.read()['time'][-1]) if n else 0
+        records['time'] = np.maximum.accumulate(np.maximum(records['time'], self._last_time))
+        self._last_time = int(records['time'][-1])
+        with open(self.path, 'ab') as f:
+            f.write(records.tobytes())
+        rows = np.arange(-n % INDEX_EVERY, len(records), INDEX_EVERY)
+        if len(rows):
+            index = np.empty(len(rows), dtype=INDEX_DTYPE)
+            index['time'] = records['time'][rows]
+            index['row'] = rows + n
+            with open(self.index_path, 'ab') as f:
+                f.write(index.tobytes())
+
+    def read(self, start=None, end=None):
+        """Records with ``start <= time < end`` (ns since the epoch) as a read-only memory-mapped view."""
+        n = len(self)
+        if not n:
+            return np.empty(0, dtype=self.dtype)
+        records = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(n,))
+        return records[self._row(records, start, n, 0):self._row(records, end, n, n)]
+
+    def _row(self, records, t, n, default):
+        if t is None:
+            return default
+        # The index narrows the search to one block, so a lookup touches a few pages of the log
+        lo, hi = 0, n
+        if self.index_path.exists() and self.index_path.stat().st_size >= INDEX_DTYPE.itemsize:
+            index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r')
+            index = index[index['row'] < n]
+            block = np.searchsorted(index['time'], t, side='left')
+            if block > 0:
+                lo = int(index['row'][block - 1])
+            if block < len(index):
+                hi = int(index['row'][block]) + 1
+        return lo + int(np.searchsorted(records['time'][lo:hi], t, side='left'))
+
+
+class Recording:
+    """Read side of a recording directory: its symbols, ticks and bars."""
+
+    def __init__(self, root=RECORD_DIR):
+        self.root = Path(root)
+        self.logs = {kind: RecordLog(self.root, kind) for kind in LOGS}
+
+    def symbols(self):
+        path = self.root / 'symbols.json'
+        if not path.exists():
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def read(self, kind, symbols=None, start=None, end=None):
+        """
+        Records of one log between ``start`` and ``end`` in epoch seconds.
+        Without ``symbols`` this is a zero-copy view; filtering by symbol copies.
+        """
+        records = self.logs[kind].read(_ns(start), _ns(end))
+        if symbols is None:
+            return records
+        wanted = set(symbols)
+        ids = [i for i, s in enumerate(self.symbols()) if s in wanted]
+        return records[np.isin(records['symbol'], ids)]
+
+    def bars(self, symbol, start=None, end=None, bar_size=5):
+        """OHLCV bars of ``bar_size`` seconds built from the recorded 5 second bars, as a BAR_DTYPE array."""
+        recorded = self.read('bars', [symbol], start, end)
+        bars = np.empty(len(recorded), dtype=BAR_DTYPE)
+        bars['time'] = recorded['bar_time']
+        for name in ('open', 'high', 'low', 'close', 'volume'):
+            bars[name] = recorded[name]
+        return resample(bars, bar_size)
+
+    def span(self, kind='bars'):
+        """First and last record time in epoch seconds, or None for an empty log."""
+        records = self.logs[kind].read()
+        if not len(records):
+            return None
+        return records['time'][0] / 1e9, records['time'][-1] / 1e9
+
+
+def _ns(seconds):
+    return None if seconds is None else int(seconds * 1e9)
+
+
+def resample(bars, seconds):
+    """Aggregate BAR_DTYPE bars into bars of ``seconds``."""
+    if not len(bars) or seconds <= 5:
+        return bars
+    buckets = bars['time'] // seconds * seconds
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    out = np.empty(len(starts), dtype=BAR_DTYPE)
+    out['time'] = buckets[starts]
+    out['open'] = bars['open'][starts]
+    out['high'] = np.maximum.reduceat(bars['high'], starts)
+    out['low'] = np.minimum.reduceat(bars['low'], starts)
+    out['close'] = bars['close'][np.r_[starts[1:], len(bars)] - 1]
+    out['volume'] = np.add.reduceat(bars['volume'], starts)
+    return out
+
+
+def replay(recording, kind='bars', symbols=None, start=None, end=None, speed=1.0):
+    """
+    Yield batches of recorded records at ``speed`` times the pace they were
+    recorded at; a speed of 0 yields everything at once.
+    """
+    records = recording.read(kind, symbols, start, end)
+    if not len(records):
+        return
+    if not speed:
+        yield records
+        return
+    times = records['time']
+    wall_start, first = time.monotonic(), int(times[0])
+    i = 0
+    while i < len(records):
+        clock = first + (time.monotonic() - wall_start) * speed * 1e9
+        j = int(np.searchsorted(times, clock, side='right'))
+        if j > i:
+            yield records[i:j]
+            i = j
+        else:
+            time.sleep(min((times[i] - clock) / speed / 1e9, 0.25))
+
+
+class Recorder:
+    """
+    Records quotes and 5 second real-time bars of a watchlist.
+
+    IB event handlers only append tuples to in-memory queues. A writer
+    thread drains the queues every ``flush_interval`` seconds and appends
+    each batch to the logs in one write, so file I/O never runs on the
+    event loop and bursts are queued rather than dropped.
+    """
+
+    def __init__(self, ib, symbols, root=RECORD_DIR, ticks=True, bars=True, flush_interval=0.25):
+        self.ib = ib
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.symbols = [s.upper() for s in symbols]
+        self.record_ticks = ticks
+        self.record_bars = bars
+        self.flush_interval = flush_interval
+        self.logs = {kind: RecordLog(self.root, kind) for kind in LOGS}
+        self.received = {kind: 0 for kind in LOGS}
+        self.written = {kind: 0 for kind in LOGS}
+        self._queues = {kind: deque() for kind in LOGS}
+        self._ids = {}  # conId -> symbol id
+        self._tickers = []
+        self._bar_lists = []
+        self._pending_bars = []  # ContractInfo still waiting for their real-time bars subscription
+        self._bar_task = None
+        self.skipped = []  # symbols left out for lack of market data lines
+        self._stopping = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name='Recorder', daemon=True)
+
+    async def start_async(self):
+        """Subscribe to the watchlist and start the writer thread."""
+        known = Recording(self.root).symbols()
+        for symbol in self.symbols:
+            if symbol not in known:
+                known.append(symbol)
+        tmp = self.root / 'symbols.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(known, f)
+        os.replace(tmp, self.root / 'symbols.json')
+
+        infos = await contract_registry(self.ib).resolve_async(self.symbols)
+        new = [info for info in dict((info.conId, info) for info in infos.values()).values()
+               if info.conId not in self._ids]
+        # Quotes and real-time bars take a market data line each; symbols beyond the free lines are not recorded
+        per_symbol = int(self.record_ticks) + int(self.record_bars)
+        free = max(0, market_data_lines() - len(ticker_cache(self.ib)) - len(self._ids) * per_symbol)
+        if per_symbol and len(new) * per_symbol > free:
+            self.skipped = [info.contract.symbol for info in new[free // per_symbol:]]
+            new = new[:free // per_symbol]
+        for info in new:
+            self._ids[info.conId] = known.index(info.contract.symbol)
+        if self.record_ticks:
+            # Hundreds of subscriptions at once would trip IB's message rate limit
+            scheduler = request_scheduler(self.ib)
+            for info in new:
+                await scheduler.acquire('market_data')
+                self._tickers.append(self.ib.reqMktData(info.contract))
+            self.ib.pendingTickersEvent += self._on_tickers
+        if self.record_bars:
+            # Paced like historical requests of small bars, 60 in any 10 minutes, so a
+            # long watchlist takes a while: the quotes are recorded in the meantime
+            self._pending_bars = list(new)
+            self._bar_task = asyncio.ensure_future(self._subscribe_bars())
+        self._writer.start()
+        return self
+
+    async def _subscribe_bars(self):
+        scheduler = request_scheduler(self.ib)
+        while self._pending_bars:
+            await scheduler.acquire('small_bars')
+            info = self._pending_bars.pop(0)
+            bars = self.ib.reqRealTimeBars(info.contract, 5, 'TRADES', useRTH=False)
+            bars.updateEvent += self._on_bar
+            self._bar_lists.append(bars)
+
+    def stop(self):
+        """Cancel the subscriptions and write out everything still queued."""
+        if self._bar_task is not None:
+            self._bar_task.cancel()
+        self.ib.pendingTickersEvent -= self._on_tickers
+        if self.ib.isConnected():
+            for ticker in self._tickers:
+                self.ib.cancelMktData(ticker.contract)
+            for bars in self._bar_lists:
+                self.ib.cancelRealTimeBars(bars)
+        self._stopping.set()
+        if self._writer.is_alive():
+            self._writer.join()
+
+    @property
+    def backlog(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def stats(self):
+        pending = f", {len(self._pending_bars)} bar subscriptions pending" if self._pending_bars else ""
+        return ", ".join(f"{kind} {self.received[kind]} received / {self.written[kind]} written"
+                         for kind in LOGS) + f", {self.backlog} queued" + pending
+
+    def _on_tickers(self, tickers):
+        now = time.time_ns()
+        queue = self._queues['ticks']
+        for t in tickers:
+            symbol = self._ids.get(t.contract.conId)
+            if symbol is not None:
+                queue.append((now, symbol, t.bid, t.ask, t.last, t.bidSize, t.askSize, t.lastSize, t.volume))
+                self.received['ticks'] += 1
+
+    def _on_bar(self, bars, has_new_bar):
+        if not has_new_bar or not bars:
+            return
+        b = bars[-1]
+        self._queues['bars'].append((time.time_ns(), self._ids[bars.contract.conId], int(b.time.timestamp()),
+                                     b.open_, b.high, b.low, b.close, b.volume, b.wap, b.count))
+        self.received['bars'] += 1
+        # The list would otherwise keep every bar of the session in memory
+        bars.clear()
+
+    def _write_loop(self):
+        while not self._stopping.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        for kind, queue in self._queues.items():
+            batch = [queue.popleft() for _ in range(len(queue))]
+            if batch:
+                self.logs[kind].append(np.array(batch, dtype=LOGS[kind]))
+                self.written[kind] += len(batch)
+
+
+def load_watchlist(path):
+    """Symbols from a file, one per line or comma separated; ``#`` starts a comment."""
+    with open(path) as f:
+        return [s.strip().upper() for line in f for s in line.split('#')[0].split(',') if s.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record quotes and 5 second bars of a watchlist.")
+    parser.add_argument('symbols', nargs='*', help="Symbols to record")
+    parser.add_argument('--watchlist', help="File of symbols, one per line or comma separated")
+    parser.add_argument('--root', default=str(RECORD_DIR), help="Recording directory")
+    parser.add_argument('--no-ticks', action='store_true', help="Record only the 5 second bars")
+    parser.add_argument('--no-bars', action='store_true', help="Record only the quotes")
+    parser.add_argument('--mode', choices=list(PORTS), default=None,
+                        help="Paper or Live; defaults to the mode chosen in the dashboard settings")
+    parser.add_argument('--stats-every', type=float, default=10.0, help="Seconds between progress lines")
+    args = parser.parse_args()
+
+    symbols = args.symbols + (load_watchlist(args.watchlist) if args.watchlist else [])
+    if not symbols:
+        parser.error("No symbols to record.")
+
+    service = ServiceClient()
+    client_id = service.lease_client_id() if service.is_running() else RECORDER_CLIENT_ID
+    ib = IB()
+    ib.connect(IB_HOST, client_port(args.mode or configured_mode()), clientId=client_id)
+    recorder = Recorder(ib, symbols, args.root, ticks=not args.no_ticks, bars=not args.no_bars)
+    ib.run(recorder.start_async())
+    if recorder.skipped:
+        print(f"Not enough market data lines for {len(recorder.skipped)} symbols, not recording "
+              f"{', '.join(recorder.skipped)}. Set MARKET_DATA_LINES in the settings if your account has more.")
+    print(f"Recording {len(symbols) - len(recorder.skipped)} symbols to {args.root}")
+    try:
+        while True:
+            ib.sleep(args.stats_every)
+            print(recorder.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.stop()
+        print(recorder.stats())
+        ib.disconnect()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import asyncio
+import time
+from dataclasses import dataclass, field, fields
+
+import numpy as np
+from ib_insync import Order, OrderState
+
+from account import account_state
+from contracts import contract_registry, registry_key
+from market_data import contract_key
+from pacing import request_scheduler
+from sessions import session_calendar
+from settings import settings_store
+from shared import per_connection
+
+# How long a whatIf margin estimate is reused for the same contract, quantity and action
+WHATIF_TTL = 30.0
+
+
+@dataclass
+class RiskLimits:
+    max_order_value: float = 100_000.0  # notional of one leg
+    max_quantity: int = 10_000  # shares in one leg
+    max_position_perc: float = 25.0  # position value after the batch, in % of net liquidation
+    risk_perc: float = 1.0  # loss at the stop, in % of net liquidation, for legs with a stop
+    max_margin_usage: float = 0.8  # initial margin after the batch over equity with loan value
+    session: str = ''  # 'regular' or 'extended' rejects legs whose market is closed; '' sends at any time
+
+
+def configured_limits():
+    """Risk limits from the RISK section of the settings, the defaults for any not set there."""
+    values = settings_store().get('RISK') or {}
+    return RiskLimits(**{f.name: f.type(values[f.name]) for f in fields(RiskLimits) if f.name in values})
+
+
+def calculate_pos_size(account_bal, risk_perc, entry_price, stop_loss_price):
+    """
+    Calculate position size to buy based on account balance, risk tolerance, and stop-loss distance.
+    Arguments may be NumPy arrays, in which case sizes are computed element-wise.
+    """
+    # risk amount
+    risk_amt = account_bal * (risk_perc / 100)
+    # stop-loss distance
+    stop_loss_dist = abs(entry_price - stop_loss_price)
+    #  position size
+    if np.any(stop_loss_dist == 0):
+        raise ValueError("Stop-loss distance cannot be zero.")
+    pos_size = risk_amt / stop_loss_dist
+
+    return pos_size
+
+
+def position_sizes(account_bal, risk_perc, entries, stops):
+    """Whole-share position sizes for arrays of entries and stops at once."""
+    return np.floor(calculate_pos_size(account_bal, risk_perc, np.asarray(entries, dtype=float),
+                                       np.asarray(stops, dtype=float)))
+
+
+def _float(value):
+    """Number from an OrderState field; IB leaves unknown values empty or at DBL_MAX."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+    return value if abs(value) < 1e300 else float('nan')
+
+
+class WhatIfCache:
+    """
+    Margin estimates from whatIf orders, keyed by (contract, quantity, action).
+
+    Concurrent requests for the same key share one whatIf order, and
+    results are reused for ``ttl`` seconds.
+    """
+
+    def __init__(self, ib, ttl=WHATIF_TTL, timeout=5.0):
+        self.ib = ib
+        self.ttl = ttl
+        self.timeout = timeout
+        self._results = {}  # key -> (OrderState, monotonic time)
+        self._pending = {}  # key -> future
+        ib.disconnectedEvent += self.clear
+
+    def get(self, contract, quantity, action):
+        """Blocking wrapper around ``get_async``."""
+        return self.ib.run(self.get_async(contract, quantity, action))
+
+    async def get_async(self, contract, quantity, action):
+        """Return the OrderState of a whatIf market order, or None if IB gave no estimate."""
+        key = (contract_key(contract), float(quantity), action)
+        cached = self._results.get(key)
+        if cached is not None and time.monotonic() - cached[1] <= self.ttl:
+            return cached[0]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._fetch(key, contract, quantity, action))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, key, contract, quantity, action):
+        try:
+            await request_scheduler(self.ib).acquire('whatif')
+            order = Order(action=action, totalQuantity=quantity, orderType='MKT')
+            state = await asyncio.wait_for(self.ib.whatIfOrderAsync(contract, order), self.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+        finally:
+            self._pending.pop(key, None)
+        if not isinstance(state, OrderState):
+            return None
+        self._results[key] = (state, time.monotonic())
+        return state
+
+    def clear(self):
+        self._results.clear()
+
+
+what_if_cache = per_connection(WhatIfCache)
+
+
+@dataclass
+class LegRisk:
+    leg: object
+    state: OrderState = None
+    max_size: float = None
+    errors: list = field(default_factory=list)
+
+    @property
+    def passed(self):
+        return not self.errors
+
+    @property
+    def margin_change(self):
+        return _float(self.state.initMarginChange) if self.state else float('nan')
+
+    @property
+    def commission(self):
+        return _float(self.state.commission) if self.state else float('nan')
+
+
+@dataclass
+class RiskReport:
+    checks: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def passed(self):
+        return [c for c in self.checks if c.passed]
+
+    @property
+    def rejected(self):
+        return [c for c in self.checks if not c.passed]
+
+    def report(self):
+        lines = []
+        for c in self.checks:
+            leg = c.leg
+            line = f"{leg.symbol} {leg.action} {leg.quantity} @ {leg.price}: "
+            if c.passed:
+                line += f"OK, initial margin {c.margin_change:+,.2f}, commission {c.commission:.2f}"
+                if c.max_size is not None:
+                    line += f", max size {c.max_size:.0f}"
+            else:
+                line += "Rejected = " + "; ".join(c.errors)
+            lines.append(line)
+        lines.append(f"{len(self.passed)}/{len(self.checks)} legs passed the risk checks in {self.elapsed:.2f}s")
+        return "\n".join(lines)
+
+
+def _account_value(ib, tag, account=None):
+    state = account_state(ib)
+    for currency in ('USD', 'BASE'):
+        value = state.value(tag, currency, account)
+        if value is not None:
+            return float(value)
+    return float('nan')
+
+
+async def check_legs_async(ib, legs, limits=None, infos=None, account=''):
+    """
+    Check every leg of a batch against the limits before anything is sent.
+
+    whatIf margin estimates for all legs are requested concurrently; the
+    size, notional and position checks run on arrays of the whole batch.
+    Margin is accumulated over the legs that pass, in batch order.
+    With ``account``, balances and positions are those of that account only.
+    """
+    start = time.perf_counter()
+    limits = limits or configured_limits()
+    if infos is None:
+        infos = await contract_registry(ib).resolve_async([leg.symbol for leg in legs])
+    checks = [LegRisk(leg) for leg in legs]
+    contracts = [infos[registry_key(leg.symbol)].contract if registry_key(leg.symbol) in infos else None
+                 for leg in legs]
+
+    cache = what_if_cache(ib)
+
+    async def what_if(leg, contract):
+        return await cache.get_async(contract, leg.quantity, leg.action) if contract is not None else None
+
+    states = await asyncio.gather(*(what_if(leg, contract) for leg, contract in zip(legs, contracts)))
+
+    if limits.session:
+        # Answered from the parsed trading hours, without asking IB
+        market_open = session_calendar(ib).open_mask(
+            [infos.get(registry_key(leg.symbol)) for leg in legs], liquid=limits.session == 'regular')
+
+    net_liq = _account_value(ib, 'NetLiquidation', account or None)
+    equity = _account_value(ib, 'EquityWithLoanValue', account or None)
+    margin = _account_value(ib, 'InitMarginReq', account or None)
+
+    quantity = np.array([leg.quantity for leg in legs], dtype=float)
+    price = np.array([leg.price for leg in legs], dtype=float)
+    signed = np.where([leg.action == 'BUY' for leg in legs], quantity, -quantity)
+    stop = np.array([getattr(leg, 'stop', None) or np.nan for leg in legs], dtype=float)
+    notional = quantity * price
+
+    # Largest size that loses no more than risk_perc of net liquidation at the stop
+    max_size = np.full(len(legs), np.inf)
+    has_stop = ~np.isnan(stop) & (stop != price)
+    if has_stop.any() and net_liq == net_liq:
+        max_size[has_stop] = position_sizes(net_liq, limits.risk_perc, price[has_stop], stop[has_stop])
+    wrong_side = ~np.isnan(stop) & (np.sign(price - stop) != np.sign(signed))
+
+    # Positions after the batch, accumulating legs of the same symbol in order
+    positions = account_state(ib).positions
+    held = {}
+    for held_account, symbol, position in zip(positions.column('account'), positions.column('symbol'),
+                                              positions.column('position')):
+        if not account or held_account == account:
+            held[symbol] = held.get(symbol, 0) + position
+    after = np.empty(len(legs))
+    for i, leg in enumerate(legs):
+        held[leg.symbol] = held.get(leg.symbol, 0) + signed[i]
+        after[i] = held[leg.symbol]
+    position_value = np.abs(after) * price
+
+    for i, (c, state, contract) in enumerate(zip(checks, states, contracts)):
+        c.state = state
+        c.max_size = None if np.isinf(max_size[i]) else max_size[i]
+        if contract is None:
+            c.errors.append("Unknown contract")
+            continue
+        if state is None:
+            c.errors.append("No margin estimate from IB")
+        if limits.session and not market_open[i]:
+            c.errors.append(f"Market is closed ({limits.session} hours)")
+        if quantity[i] > limits.max_quantity:
+            c.errors.append(f"Quantity exceeds {limits.max_quantity}")
+        if notional[i] > limits.max_order_value:
+            c.errors.append(f"Order value {notional[i]:,.2f} exceeds {limits.max_order_value:,.2f}")
+        if wrong_side[i]:
+            c.errors.append(f"Stop {stop[i]} is on the wrong side of the price")
+        elif quantity[i] > max_size[i]:
+            c.errors.append(f"Quantity exceeds {max_size[i]:.0f} shares risking {limits.risk_perc}% "
+                            f"with the stop at {stop[i]}")
+        if net_liq == net_liq and position_value[i] > limits.max_position_perc / 100 * net_liq:
+            c.errors.append(f"Position value {position_value[i]:,.2f} exceeds {limits.max_position_perc}% "
+                            f"of net liquidation")
+        change = c.margin_change
+        if c.passed and margin == margin and equity == equity and change == change:
+            if margin + change > limits.max_margin_usage * equity:
+                c.errors.append(f"Initial margin {margin + change:,.2f} would exceed "
+                                f"{limits.max_margin_usage:.0%} of equity {equity:,.2f}")
+            else:
+                margin += change
+
+    return RiskReport(checks, time.perf_counter() - start)
+
+
+def check_legs(ib, legs, limits=None, account=''):
+    """Blocking wrapper around ``check_legs_async``."""
+    return ib.run(check_legs_async(ib, legs, limits, account=account))
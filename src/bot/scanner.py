@@ -0,0 +1,196 @@
+import asyncio
+import copy
+import operator
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from contracts import contract_registry, registry_key
+from market_data import ticker_cache
+from pacing import request_scheduler
+
+# Generic tick 165 adds the average daily volume to the quotes
+SCAN_TICKS = '165'
+# Lines left free for the ticker cache and orders placed while a scan runs
+SCAN_HEADROOM = 10
+# Seconds a symbol may take to send its first quote before it is scanned without one
+SCAN_DWELL = 2.0
+
+# Columns of a scan, all computed at once over NumPy arrays
+SCAN_COLUMNS = ['symbol', 'bid', 'ask', 'price', 'close', 'spread', 'spread_pct', 'change_pct', 'volume',
+                'volume_rate']
+FILTER_OPS = {'<=': operator.le, '>=': operator.ge, '!=': operator.ne, '==': operator.eq, '=': operator.eq,
+              '<': operator.lt, '>': operator.gt}
+
+
+def parse_filter(text):
+    """A filter such as ``spread_pct<0.1`` or ``change_pct>=-2`` as (column, op, value)."""
+    for symbol, op in FILTER_OPS.items():
+        column, found, value = text.partition(symbol)
+        if found:
+            if column not in SCAN_COLUMNS[1:]:
+                raise ValueError(f"Unknown scan column: {column}. Use one of {', '.join(SCAN_COLUMNS[1:])}.")
+            try:
+                return column, op, float(value)
+            except ValueError:
+                break
+    raise ValueError(f"Invalid filter: {text}.")
+
+
+def _positive(values):
+    # IB sends -1 or 0 for a missing price
+    return np.where(values > 0, values, np.nan)
+
+
+def scan_columns(symbols, bid, ask, last, close, volume, av_volume):
+    """
+    Derived columns of many quotes at once. ``price`` is the midpoint when
+    there is a quote, else the last trade; ``volume_rate`` is today's volume
+    as a multiple of the 90-day average daily volume.
+    """
+    bid, ask, last, close = (_positive(np.asarray(a, dtype=float)) for a in (bid, ask, last, close))
+    volume, av_volume = np.asarray(volume, dtype=float), _positive(np.asarray(av_volume, dtype=float))
+    mid = (bid + ask) / 2
+    price = np.where(np.isnan(mid), last, mid)
+    spread = ask - bid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'symbol': np.asarray(symbols, dtype=object),
+            'bid': bid,
+            'ask': ask,
+            'price': price,
+            'close': close,
+            'spread': spread,
+            'spread_pct': spread / mid * 100,
+            'change_pct': (price / close - 1) * 100,
+            'volume': volume,
+            'volume_rate': volume / av_volume,
+        }
+
+
+def apply_filters(columns, filters):
+    """Mask of the rows passing every (column, op, value) filter; NaN never passes."""
+    mask = np.ones(len(columns['symbol']), dtype=bool)
+    for column, op, value in filters:
+        values = columns[column]
+        mask &= ~np.isnan(values) & op(values, value)
+    return mask
+
+
+@dataclass
+class ScanResult:
+    columns: dict  # column -> array over all scanned symbols
+    mask: np.ndarray  # rows passing the filters
+    missing: list = field(default_factory=list)  # symbols without a contract
+    elapsed: float = 0.0
+    by: str = None  # column to sort the matches by, largest first unless ascending
+    ascending: bool = False
+    top: int = None
+
+    def frame(self, matches_only=True):
+        import pandas as pd
+        df = pd.DataFrame(self.columns, columns=SCAN_COLUMNS)
+        if matches_only:
+            df = df[self.mask]
+        if self.by:
+            df = df.sort_values(self.by, ascending=self.ascending)
+        return df.head(self.top) if self.top else df
+
+    def report(self):
+        df = self.frame()
+        lines = [df.round(4).to_string(index=False) if len(df) else "No symbols match."]
+        quoted = int(np.count_nonzero(~np.isnan(self.columns['price'])))
+        lines.append(f"{int(self.mask.sum())} of {len(self.mask)} symbols match, {quoted} quoted, "
+                     f"in {self.elapsed:.1f}s")
+        if self.missing:
+            lines.append(f"No contract for {', '.join(self.missing)}")
+        return "\n".join(lines)
+
+
+class Scanner:
+    """
+    Quotes a watchlist by rotating streaming subscriptions through the free
+    market data lines: each symbol holds a line until its first full quote
+    arrives, or for ``dwell`` seconds, and hands it to the next symbol.
+    Symbols the ticker cache already streams are read without a new line.
+    Without ``lines`` the scan uses the lines free when it starts.
+    """
+
+    def __init__(self, ib, lines=None, dwell=SCAN_DWELL):
+        self.ib = ib
+        self.lines = lines
+        self.dwell = dwell
+
+    async def scan_async(self, symbols, filters=(), on_rows=None, interval=0.5):
+        """
+        Quote every symbol and compute the scan columns. ``on_rows(columns)``
+        gets the matching rows as they come in, about every ``interval`` seconds.
+        """
+        start = time.perf_counter()
+        symbols = list(dict.fromkeys(s.upper() for s in symbols))
+        infos = await contract_registry(self.ib).resolve_async(symbols)
+        missing = [s for s in symbols if registry_key(s) not in infos]
+        symbols = [s for s in symbols if registry_key(s) in infos]
+        quotes = np.full((6, len(symbols)), np.nan)  # bid, ask, last, close, volume, average volume
+        done = np.zeros(len(symbols), dtype=bool)
+        cache = ticker_cache(self.ib)
+        lines = asyncio.Semaphore(self.lines or max(1, cache.max_lines - len(cache) - SCAN_HEADROOM))
+        scheduler = request_scheduler(self.ib)
+
+        async def quote(i, contract):
+            if contract in cache:
+                # Held while it is read so the cache does not hand its line to another symbol
+                cache.hold(contract)
+                try:
+                    ticker = await cache.get_async(contract, _quoted, self.dwell)
+                finally:
+                    cache.release(contract)
+                self._record(quotes, i, ticker)
+                done[i] = True
+                return
+            # A copy has a ticker of its own, so the cache subscribing the symbol meanwhile
+            # neither shares this line nor loses its own when the scan cancels it
+            contract = copy.copy(contract)
+            async with lines:
+                await scheduler.acquire('market_data')
+                ticker = self.ib.reqMktData(contract, SCAN_TICKS)
+                try:
+                    await cache.wait(ticker, _quoted, self.dwell)
+                    self._record(quotes, i, ticker)
+                    done[i] = True
+                finally:
+                    # Cancelling is a message too
+                    await scheduler.acquire('market_data')
+                    self.ib.cancelMktData(contract)
+
+        emitted = np.zeros(len(symbols), dtype=bool)
+
+        def emit():
+            new = np.flatnonzero(done & ~emitted)
+            emitted[new] = True
+            if len(new):
+                columns = scan_columns([symbols[i] for i in new], *quotes[:, new])
+                mask = apply_filters(columns, filters)
+                if mask.any():
+                    on_rows({name: values[mask] for name, values in columns.items()})
+
+        tasks = asyncio.ensure_future(asyncio.gather(
+            *(quote(i, infos[registry_key(s)].contract) for i, s in enumerate(symbols))))
+        while on_rows is not None and not tasks.done():
+            await asyncio.wait([tasks], timeout=interval)
+            emit()
+        await tasks
+        if on_rows is not None:
+            emit()
+
+        columns = scan_columns(symbols, *quotes)
+        return ScanResult(columns, apply_filters(columns, filters), missing, time.perf_counter() - start)
+
+    @staticmethod
+    def _record(quotes, i, ticker):
+        quotes[:, i] = (ticker.bid, ticker.ask, ticker.last, ticker.close, ticker.volume, ticker.avVolume)
+
+
+def _quoted(ticker):
+    return ticker.bid > 0 and ticker.ask > 0 and ticker.close > 0
@@ -0,0 +1,187 @@
+import datetime
+import time
+from dataclasses import dataclass
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+
+from contracts import contract_registry
+from shared import per_connection
+
+# Older gateways send abbreviations, sometimes with a description, instead of IANA names
+TIME_ZONES = {
+    'EST': 'US/Eastern', 'EST5EDT': 'US/Eastern', 'CST': 'US/Central', 'CST6CDT': 'US/Central',
+    'MST': 'US/Mountain', 'PST': 'US/Pacific', 'GMT': 'GMT', 'MET': 'MET', 'JST': 'Asia/Tokyo',
+    'HKT': 'Asia/Hong_Kong', 'AEST': 'Australia/Sydney',
+}
+
+
+def exchange_zone(name):
+    """Time zone of a contract's ``timeZoneId``, UTC if it is unknown."""
+    name = (name or 'UTC').split(' ')[0]
+    try:
+        return ZoneInfo(TIME_ZONES.get(name, name))
+    except (ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc
+
+
+def _epoch(ts):
+    if ts is None:
+        return time.time()
+    if isinstance(ts, datetime.datetime):
+        return ts.timestamp()
+    return float(ts)
+
+
+@dataclass
+class Sessions:
+    """Sorted, non-overlapping [open, close) sessions of one contract, in epoch seconds."""
+    opens: np.ndarray
+    closes: np.ndarray
+    zone: object = datetime.timezone.utc
+
+    def __len__(self):
+        return len(self.opens)
+
+    def _index(self, ts):
+        # Last session opening at or before ts
+        return int(np.searchsorted(self.opens, ts, side='right')) - 1
+
+    def is_open(self, ts=None):
+        ts = _epoch(ts)
+        i = self._index(ts)
+        return bool(i >= 0 and ts < self.closes[i])
+
+    def next_open(self, ts=None):
+        """Start of the first session at or after ``ts``; ``ts`` itself while a session is open."""
+        ts = _epoch(ts)
+        i = self._index(ts)
+        if i >= 0 and ts < self.closes[i]:
+            return ts
+        return float(self.opens[i + 1]) if i + 1 < len(self.opens) else None
+
+    def next_close(self, ts=None):
+        """End of the session open at ``ts``, or of the next one."""
+        ts = _epoch(ts)
+        i = self._index(ts)
+        if i >= 0 and ts < self.closes[i]:
+            return float(self.closes[i])
+        return float(self.closes[i + 1]) if i + 1 < len(self.closes) else None
+
+    def mask(self, timestamps):
+        """Which of many epoch timestamps fall in a session."""
+        timestamps = np.asarray(timestamps, dtype=float)
+        if not len(self):
+            return np.zeros(timestamps.shape, dtype=bool)
+        i = np.searchsorted(self.opens, timestamps, side='right') - 1
+        return (i >= 0) & (timestamps < self.closes[np.maximum(i, 0)])
+
+    def local(self, ts):
+        return None if ts is None else datetime.datetime.fromtimestamp(ts, self.zone)
+
+
+def _moment(text, date, zone):
+    # 'YYYYMMDD:HHMM' in the current format, a bare 'HHMM' of the entry's day in the old one
+    day, _, hours = text.rpartition(':')
+    moment = datetime.datetime.strptime((day or date) + hours, '%Y%m%d%H%M')
+    return moment.replace(tzinfo=zone).timestamp()
+
+
+def parse_hours(hours, time_zone_id):
+    """
+    Parse IB's ``tradingHours`` or ``liquidHours`` into sessions, e.g.
+    ``20240506:0930-20240506:1600;20240507:CLOSED`` or the older
+    ``20240506:0930-1600,1700-1800``. Overlapping sessions are merged.
+    """
+    zone = exchange_zone(time_zone_id)
+    spans = []
+    for entry in filter(None, (hours or '').split(';')):
+        date, _, ranges = entry.partition(':')
+        if not ranges or ranges == 'CLOSED':
+            continue
+        for span in ranges.split(','):
+            start, _, end = span.partition('-')
+            opens, closes = _moment(start, date, zone), _moment(end, date, zone)
+            if closes <= opens:
+                # Overnight session written without the date of its close
+                closes += 86400
+            spans.append((opens, closes))
+    spans.sort()
+    merged = []
+    for opens, closes in spans:
+        if merged and opens <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], closes)
+        else:
+            merged.append([opens, closes])
+    array = np.array(merged, dtype=float).reshape(-1, 2)
+    return Sessions(array[:, 0].copy(), array[:, 1].copy(), zone)
+
+
+@dataclass
+class MarketStatus:
+    symbol: str
+    open: bool  # within the trading hours, extended hours included
+    regular: bool  # within the liquid, regular hours
+    next_open: datetime.datetime = None
+    next_close: datetime.datetime = None
+
+    def summary(self):
+        if self.open:
+            hours = "regular hours" if self.regular else "extended hours"
+            until = f" until {self.next_close:%Y-%m-%d %H:%M %Z}" if self.next_close else ""
+            return f"open ({hours}){until}"
+        return f"closed until {self.next_open:%Y-%m-%d %H:%M %Z}" if self.next_open else "closed"
+
+
+class SessionCalendar:
+    """
+    Trading sessions of contracts, parsed once from the contract details in
+    the registry (refreshed daily) and answered from memory by binary search.
+    ``liquid`` picks the regular hours instead of the extended trading hours.
+    """
+
+    def __init__(self, ib):
+        self.ib = ib
+        self._sessions = {}  # (conId, liquid) -> (details fetched, Sessions)
+
+    def sessions(self, info, liquid=False):
+        """Sessions of a ``ContractInfo``."""
+        key = (info.conId, liquid)
+        cached = self._sessions.get(key)
+        if cached is None or cached[0] != info.fetched:
+            cached = self._sessions[key] = (
+                info.fetched, parse_hours(info.liquidHours if liquid else info.tradingHours, info.timeZoneId))
+        return cached[1]
+
+    def get(self, symbol, liquid=False):
+        return self.sessions(contract_registry(self.ib).get(symbol), liquid)
+
+    async def get_async(self, symbol, liquid=False):
+        return self.sessions(await contract_registry(self.ib).get_async(symbol), liquid)
+
+    def is_open(self, symbol, ts=None, liquid=False):
+        return self.get(symbol, liquid).is_open(ts)
+
+    def next_open(self, symbol, ts=None, liquid=False):
+        return self.get(symbol, liquid).next_open(ts)
+
+    def next_close(self, symbol, ts=None, liquid=False):
+        return self.get(symbol, liquid).next_close(ts)
+
+    def open_mask(self, infos, ts=None, liquid=False):
+        """Which of many ``ContractInfo`` are open at ``ts``; None entries count as closed."""
+        ts = _epoch(ts)
+        return np.array([info is not None and self.sessions(info, liquid).is_open(ts) for info in infos], dtype=bool)
+
+    def status(self, info, ts=None):
+        ts = _epoch(ts)
+        extended, regular = self.sessions(info), self.sessions(info, liquid=True)
+        status = MarketStatus(info.contract.symbol, extended.is_open(ts), regular.is_open(ts))
+        if status.open:
+            status.next_close = extended.local(regular.next_close(ts) if status.regular else extended.next_close(ts))
+        else:
+            status.next_open = extended.local(extended.next_open(ts))
+        return status
+
+
+session_calendar = per_connection(SessionCalendar)
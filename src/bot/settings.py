@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# The dashboard's settings in src/visualizer, read by the CLI, the service and the recorder as well
+SETTINGS_FILE = str(Path(__file__).resolve().parents[1] / 'visualizer' / 'settings.json')
+# Where the dashboard kept its settings in a shelve before, read until the first update
+LEGACY_CONFIG_DB = str(Path(__file__).resolve().parents[1] / 'visualizer' / 'config.db')
+
+_UNREAD = object()
+
+
+@contextmanager
+def file_lock(path):
+    # Serializes writers across processes; readers never wait, they see the
+    # old or the new file as a whole since it is replaced by a rename
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(f'{path}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_legacy(path):
+    try:
+        import shelve
+        with shelve.open(path, flag='r') as db:
+            return dict(db.get('settings', {}))
+    except Exception:
+        return {}
+
+
+class JsonStore:
+    """
+    A dict kept in a JSON file that several processes read and write. It is
+    read once and kept in memory; each access costs one ``stat`` to notice
+    another process replacing the file. Updates are written to a temporary
+    file beside it and renamed over it, so no reader ever sees half a file.
+    """
+    indent = None
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._values = {}
+        self._stamp = _UNREAD
+        self._lock = threading.RLock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # A rename brings a new inode, so two updates within the clock's resolution still differ
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _missing(self):
+        """Values while there is no file yet."""
+        return {}
+
+    def load(self):
+        """All values as a dict, read again only when the file changed. Do not modify it."""
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return self._values
+        with self._lock:
+            if stamp is None:
+                values = self._missing()
+            else:
+                try:
+                    with open(self.path) as f:
+                        values = json.load(f)
+                except (OSError, ValueError):
+                    # Removed since the stat, or not ours; keep what we had
+                    return self._values
+            # Stamped before reading: a file replaced in between is read again next time
+            self._values, self._stamp = values, stamp
+        return self._values
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def update(self, values=None, remove=(), **changes):
+        """Change and remove some keys, keeping the others as the latest file has them."""
+        changes = {**(values or {}), **changes}
+        with self._lock, file_lock(self.path):
+            self._stamp = _UNREAD
+            merged = {**self.load(), **changes}
+            for key in remove:
+                merged.pop(key, None)
+            self._write(merged)
+        return merged
+
+    def clear(self):
+        with self._lock, file_lock(self.path):
+            self._write({})
+
+    def _write(self, values):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f'{self.path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(values, f, indent=self.indent, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        self._values, self._stamp = values, self._stat()
+
+
+class SettingsStore(JsonStore):
+    """Settings shared by the dashboard and the bot."""
+    indent = 2
+
+    def __init__(self, path=SETTINGS_FILE, legacy=LEGACY_CONFIG_DB):
+        super().__init__(path)
+        self.legacy = legacy
+
+    def _missing(self):
+        return _read_legacy(self.legacy) if self.legacy else {}
+
+
+_store = None
+
+
+def settings_store():
+    """Return the process-wide settings store."""
+    global _store
+    if _store is None:
+        _store = SettingsStore()
+    return _store
@@ -0,0 +1,15 @@
+import weakref
+
+
+def per_connection(factory):
+    """Accessor of the one ``factory(ib)`` every caller of a connection shares."""
+    instances = weakref.WeakKeyDictionary()
+
+    def get(ib):
+        instance = instances.get(ib)
+        if instance is None:
+            instance = instances[ib] = factory(ib)
+        return instance
+
+    get.instances = instances
+    return get
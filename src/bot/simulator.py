@@ -0,0 +1,953 @@
+import asyncio
+import copy
+import datetime
+import itertools
+import math
+import random
+import time
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+
+from ib_insync import IB, BarData, Client, CommissionReport, Contract, ContractDetails, Execution, OrderState, util
+from ib_insync.util import UNSET_DOUBLE, getLoop
+
+from bars import bar_seconds, duration_seconds
+
+# How orders are filled: every order at once, only when the simulated price
+# reaches it, or never (orders are acknowledged and then rest)
+FILL_MODELS = ('immediate', 'touch', 'never')
+ORDER_TYPES = {'MKT', 'LMT', 'STP', 'STP LMT', 'TRAIL'}
+DONE_STATES = {'Filled', 'Cancelled', 'ApiCancelled'}
+
+# Regular trading hours of the simulated exchange, in its time zone
+EXCHANGE_TZ = 'US/Eastern'
+RTH = ('0930', '1600')
+EXTENDED_HOURS = ('0400', '2000')
+
+
+def _is_set(value):
+    return 0 < value < UNSET_DOUBLE
+
+
+@dataclass
+class SimConfig:
+    latency: float = 0.02  # seconds from a request to its response
+    jitter: float = 0.0  # extra random latency, up to this many seconds
+    history_latency: float = 0.1  # extra latency of historical data requests
+    seed: int = 0
+    message_rate: int = 50  # requests per second before the gateway drops the client
+    market_data_lines: int = 100
+    history_requests: int = 60  # historical requests allowed per history_window
+    history_window: float = 600.0
+    identical_history_window: float = 15.0  # identical historical requests are refused within this
+    fill_model: str = 'touch'
+    tick_interval: float = 0.25
+    volatility: float = 0.001  # standard deviation of the price change per tick
+    spread_bps: float = 5.0
+    commission_per_share: float = 0.005
+    min_commission: float = 1.0
+    initial_margin: float = 0.5
+    maintenance_margin: float = 0.25
+    cash: float = 100_000.0
+    account: str = 'DU1234567'
+    positions: dict = field(default_factory=dict)  # symbol -> (quantity, average cost)
+    symbols: tuple = None  # known symbols; None accepts any symbol
+    master_client_id: int = 0  # receives status updates for every client's orders
+
+    def __post_init__(self):
+        if self.fill_model not in FILL_MODELS:
+            raise ValueError(f"Invalid fill model {self.fill_model!r}. Use one of {', '.join(FILL_MODELS)}.")
+
+
+@dataclass
+class Quote:
+    last: float
+    bid: float = 0.0
+    ask: float = 0.0
+    close: float = 0.0
+    volume: float = 0.0
+
+
+@dataclass
+class SimPosition:
+    contract: Contract
+    quantity: float = 0.0
+    avg_cost: float = 0.0
+    realized: float = 0.0
+
+
+@dataclass
+class SimOrder:
+    client_id: int
+    order_id: int
+    perm_id: int
+    symbol: str
+    contract: Contract
+    order: object
+    status: str = 'Submitted'
+    filled: float = 0.0
+    avg_price: float = 0.0
+    last_price: float = 0.0
+
+    @property
+    def remaining(self):
+        return self.order.totalQuantity - self.filled
+
+
+class SimGateway:
+    """
+    In-process stand-in for IB Gateway.
+
+    Requests from ``SimClient`` connections are answered through the
+    ib_insync wrapper callbacks the socket decoder would call, after the
+    configured latency. Prices, contract details and historical bars are
+    derived from the symbol and the seed, so runs are repeatable.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or SimConfig()
+        self.up = True
+        self.cash = self.config.cash
+        self._rng = random.Random(self.config.seed)
+        self._clients = []
+        self._next_order_ids = {}
+        self._perm_ids = itertools.count(1_000_000)
+        self._exec_ids = itertools.count(1)
+        self._quotes = {}
+        self._rngs = {}
+        self._symbols_by_con_id = {}
+        self._subscriptions = {}  # (client, reqId) -> symbol
+        self._bar_subscriptions = {}  # (client, reqId) -> symbol, for 5 second real-time bars
+        self._building = {}  # symbol -> [start, open, high, low, close, volume at start, volume]
+        self._orders = {}  # (clientId, orderId) -> SimOrder
+        self._resting = {}  # symbol -> list of SimOrder
+        self._held = {}  # clientId -> [(orderId, contract, order)] sent with transmit=False
+        self._fills = []  # (SimOrder, Execution, CommissionReport)
+        self._positions = {}  # symbol -> SimPosition
+        self._account_subscribers = set()
+        self._position_subscribers = set()
+        self._message_times = {}  # client -> deque of request times
+        self._history_times = deque()
+        self._history_requests = {}  # request parameters -> time of the last identical request
+        self._ticking = None
+        for symbol, (quantity, avg_cost) in self.config.positions.items():
+            self._positions[symbol] = SimPosition(self._details(symbol).contract, quantity, avg_cost)
+
+    # connections
+
+    def attach(self, client):
+        if not self.up:
+            raise ConnectionRefusedError("Simulated gateway is down")
+        if any(c.clientId == client.clientId for c in self._clients):
+            raise ConnectionError(f"Peer closed connection. clientId {client.clientId} already in use?")
+        self._clients.append(client)
+        self._message_times[client] = deque()
+        return self._next_order_ids.setdefault(client.clientId, 1)
+
+    def detach(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+        self._message_times.pop(client, None)
+        self._account_subscribers.discard(client)
+        self._position_subscribers.discard(client)
+        self._held.pop(client.clientId, None)
+        for subscriptions in (self._subscriptions, self._bar_subscriptions):
+            for key in [key for key in subscriptions if key[0] is client]:
+                del subscriptions[key]
+
+    def drop(self, client=None):
+        """Close one connection, or all of them, from the gateway side."""
+        for c in ([client] if client else list(self._clients)):
+            self.detach(c)
+            if c.isReady():
+                c.connection_lost("Peer closed connection.")
+
+    def stop(self):
+        """Drop every connection and refuse new ones until ``start``."""
+        self.up = False
+        self.drop()
+
+    def start(self):
+        self.up = True
+
+    def receive(self, client, handler, args):
+        """Handle one request, enforcing the gateway's message rate."""
+        now = getLoop().time()
+        times = self._message_times.get(client)
+        if times is None:
+            return
+        times.append(now)
+        while now - times[0] > 1.0:
+            times.popleft()
+        if len(times) > self.config.message_rate:
+            self._deliver(client, [('error', (-1, 100, "Max rate of messages per second has been exceeded:"
+                                                       f"max={self.config.message_rate} rec={len(times)} (1)", ''))])
+            getLoop().call_later(self.config.latency, self.drop, client)
+            return
+        getattr(self, handler)(client, *args)
+
+    def _deliver(self, client, calls, delay=0.0):
+        """Send wrapper calls to the client as one batch, in order with everything sent before."""
+        loop = getLoop()
+        at = loop.time() + self.config.latency + delay + self._rng.random() * self.config.jitter
+        at = max(at, client.last_delivery)
+        client.last_delivery = at
+        loop.call_at(at, client.dispatch, calls)
+
+    # contracts
+
+    def _symbol(self, contract):
+        symbol = contract.symbol or self._symbols_by_con_id.get(contract.conId)
+        if not symbol or contract.conId and self._symbols_by_con_id.get(contract.conId) not in (None, symbol):
+            return None
+        if self.config.symbols is not None and symbol not in self.config.symbols:
+            return None
+        if contract.secType not in ('', 'STK'):
+            return None
+        return symbol
+
+    def _details(self, symbol):
+        con_id = zlib.crc32(symbol.encode()) & 0x7fffffff
+        self._symbols_by_con_id[con_id] = symbol
+        contract = Contract(
+            secType='STK', conId=con_id, symbol=symbol, exchange='SMART', primaryExchange='NASDAQ',
+            currency='USD', localSymbol=symbol, tradingClass='NMS'
+        )
+        return ContractDetails(
+            contract=contract, marketName='NMS', minTick=0.01, orderTypes=','.join(sorted(ORDER_TYPES)),
+            validExchanges='SMART,NASDAQ,NYSE', longName=f"{symbol} SIMULATED INC", stockType='COMMON',
+            timeZoneId=EXCHANGE_TZ, tradingHours=self._hours(*EXTENDED_HOURS), liquidHours=self._hours(*RTH)
+        )
+
+    @staticmethod
+    def _hours(open_time, close_time):
+        """Session string in IB's format for the coming week; weekends are closed."""
+        today = datetime.datetime.now(ZoneInfo(EXCHANGE_TZ)).date()
+        sessions = []
+        for i in range(7):
+            day = (today + datetime.timedelta(days=i)).strftime('%Y%m%d')
+            if (today + datetime.timedelta(days=i)).weekday() >= 5:
+                sessions.append(f"{day}:CLOSED")
+            else:
+                sessions.append(f"{day}:{open_time}-{day}:{close_time}")
+        return ';'.join(sessions)
+
+    def reqContractDetails(self, client, reqId, contract):
+        symbol = self._symbol(contract)
+        if symbol is None:
+            self._deliver(client, [('error', (reqId, 200, "No security definition has been found for the request", ''))])
+            return
+        details = self._details(symbol)
+        if contract.exchange and contract.exchange != 'SMART':
+            details.contract.exchange = contract.exchange
+        self._deliver(client, [('contractDetails', (reqId, details)), ('contractDetailsEnd', (reqId,))])
+
+    # market data
+
+    def _unit(self, symbol, *salt):
+        """Deterministic number in [0, 1) for a symbol and some salt."""
+        return zlib.crc32(f"{self.config.seed}:{symbol}:{':'.join(map(str, salt))}".encode()) / 2**32
+
+    def _base_price(self, symbol):
+        return round(20 + 480 * self._unit(symbol, 'base'), 2)
+
+    def _quote(self, symbol):
+        quote = self._quotes.get(symbol)
+        if quote is None:
+            price = self._base_price(symbol)
+            quote = self._quotes[symbol] = Quote(price, close=price)
+            self._rngs[symbol] = random.Random(zlib.crc32(f"{self.config.seed}:{symbol}".encode()))
+            self._set_spread(quote)
+        return quote
+
+    def _set_spread(self, quote):
+        spread = max(0.01, round(quote.last * self.config.spread_bps / 10_000, 2))
+        quote.bid = round(quote.last - spread / 2, 2)
+        quote.ask = round(quote.bid + spread, 2)
+
+    def _step(self, symbol):
+        quote = self._quote(symbol)
+        rng = self._rngs[symbol]
+        quote.last = max(0.01, round(quote.last * math.exp(rng.gauss(0, self.config.volatility)), 2))
+        quote.volume += rng.randint(1, 50) * 100
+        self._set_spread(quote)
+        return quote
+
+    @staticmethod
+    def _ticks(reqId, quote):
+        return [
+            ('priceSizeTick', (reqId, 1, quote.bid, 100)),
+            ('priceSizeTick', (reqId, 2, quote.ask, 100)),
+            ('priceSizeTick', (reqId, 4, quote.last, 100)),
+            ('tickSize', (reqId, 8, quote.volume)),
+        ]
+
+    def reqMktData(self, client, reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions):
+        symbol = self._symbol(contract)
+        if symbol is None:
+            self._deliver(client, [('error', (reqId, 200, "No security definition has been found for the request", ''))])
+            return
+        if not snapshot and len(self._subscriptions) >= self.config.market_data_lines:
+            self._deliver(client, [('error', (reqId, 101, "Max number of tickers has been reached", ''))])
+            return
+        quote = self._quote(symbol)
+        calls = self._ticks(reqId, quote) + [('priceSizeTick', (reqId, 9, quote.close, 0))]
+        if '165' in genericTickList.split(','):
+            # Average daily volume of the last 90 days
+            calls.append(('tickSize', (reqId, 21, int(200_000 + 4_800_000 * self._unit(symbol, 'volume')))))
+        if snapshot:
+            calls.append(('tickSnapshotEnd', (reqId,)))
+        else:
+            self._subscriptions[(client, reqId)] = symbol
+            self._start_ticking()
+        self._deliver(client, calls)
+
+    def cancelMktData(self, client, reqId):
+        self._subscriptions.pop((client, reqId), None)
+
+    def _start_ticking(self):
+        if self._ticking is None:
+            self._ticking = getLoop().call_later(self.config.tick_interval, self._tick)
+
+    def _tick(self):
+        self._ticking = None
+        symbols = set(self._subscriptions.values()) | set(self._bar_subscriptions.values()) \
+            | {s for s, orders in self._resting.items() if orders}
+        if not symbols:
+            return
+        batches = {}
+        for symbol in sorted(symbols):
+            quote = self._step(symbol)
+            for (client, reqId), subscribed in self._subscriptions.items():
+                if subscribed == symbol:
+                    batches.setdefault(client, []).extend(self._ticks(reqId, quote))
+            bar = self._build_bar(symbol, quote)
+            if bar is not None:
+                for (client, reqId), subscribed in self._bar_subscriptions.items():
+                    if subscribed == symbol:
+                        batches.setdefault(client, []).append(('realtimeBar', (reqId, *bar)))
+            for sim in list(self._resting.get(symbol, ())):
+                self._match(sim)
+        for client, calls in batches.items():
+            self._deliver(client, calls)
+        self._start_ticking()
+
+    def _build_bar(self, symbol, quote):
+        """Fold a tick into the symbol's 5 second bar; returns the previous bar once a new one starts."""
+        start = int(time.time()) // 5 * 5
+        building = self._building.get(symbol)
+        if building is None or building[0] != start:
+            self._building[symbol] = [start, quote.last, quote.last, quote.last, quote.last, quote.volume, quote.volume]
+            if building is None:
+                return None
+            t, open_, high, low, close, volume_start, volume = building
+            shares = volume - volume_start
+            return t, open_, high, low, close, shares, round((open_ + high + low + close) / 4, 4), max(1, shares // 100)
+        building[2] = max(building[2], quote.last)
+        building[3] = min(building[3], quote.last)
+        building[4] = quote.last
+        building[6] = quote.volume
+        return None
+
+    def reqRealTimeBars(self, client, reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions):
+        symbol = self._symbol(contract)
+        if symbol is None:
+            self._deliver(client, [('error', (reqId, 200, "No security definition has been found for the request", ''))])
+            return
+        self._bar_subscriptions[(client, reqId)] = symbol
+        self._start_ticking()
+
+    def cancelRealTimeBars(self, client, reqId):
+        self._bar_subscriptions.pop((client, reqId), None)
+
+    # historical data
+
+    def _bar_level(self, symbol, t):
+        days = t / 86400
+        wave = 0.1 * math.sin(days / 29) + 0.03 * math.sin(days / 3.7)
+        return self._base_price(symbol) * math.exp(wave + 0.01 * (self._unit(symbol, t) - 0.5))
+
+    def _bar(self, symbol, t, step, date, volume=True):
+        open_, close = self._bar_level(symbol, t), self._bar_level(symbol, t + step)
+        high = max(open_, close) * (1 + 0.004 * self._unit(symbol, t, 'high'))
+        low = min(open_, close) * (1 - 0.004 * self._unit(symbol, t, 'low'))
+        shares = round(1000 + 9000 * self._unit(symbol, t, 'volume')) * max(1, step // 60) if volume else -1
+        return BarData(date=date, open=round(open_, 2), high=round(high, 2), low=round(low, 2),
+                       close=round(close, 2), volume=shares, average=round((high + low + close) / 3, 2),
+                       barCount=max(1, shares // 100))
+
+    def reqHistoricalData(self, client, reqId, contract, endDateTime, durationStr, barSizeSetting,
+                          whatToShow, useRTH, formatDate, keepUpToDate, chartOptions):
+        symbol = self._symbol(contract)
+        if symbol is None:
+            self._deliver(client, [('error', (reqId, 200, "No security definition has been found for the request", ''))])
+            return
+        error = self._history_pacing((symbol, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH))
+        if error:
+            self._deliver(client, [('error', (reqId, 162, f"Historical Market Data Service error message:{error}", ''))])
+            return
+
+        end = int(util.parseIBDatetime(endDateTime).timestamp()) if endDateTime else int(datetime.datetime.now().timestamp())
+        start = end - duration_seconds(durationStr)
+        step = bar_seconds(barSizeSetting)
+        if (end - start) // step > 100_000:
+            self._deliver(client, [('error', (reqId, 162, "Historical Market Data Service error message:"
+                                                          "Time length exceed max.", ''))])
+            return
+
+        calls = []
+        volume = whatToShow not in ('MIDPOINT', 'BID', 'ASK', 'BID_ASK')
+        t = (start // step + 1) * step if step < 86400 else start - start % 86400 + 86400
+        while t < end:
+            day = datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+            # Sessions are approximated in UTC: weekdays, 13:30-20:00 for regular hours
+            minute = day.hour * 60 + day.minute
+            if day.weekday() < 5 and (step >= 86400 or not useRTH or 810 <= minute < 1200):
+                if step >= 86400:
+                    date = day.strftime('%Y%m%d')
+                elif formatDate == 2:
+                    date = str(t)
+                else:
+                    date = day.strftime('%Y%m%d %H:%M:%S UTC')
+                calls.append(('historicalData', (reqId, self._bar(symbol, t, step, date, volume))))
+            t += step
+        calls.append(('historicalDataEnd', (reqId, '', '')))
+        self._deliver(client, calls, self.config.history_latency)
+
+    def _history_pacing(self, key):
+        now = getLoop().time()
+        while self._history_times and now - self._history_times[0] > self.config.history_window:
+            self._history_times.popleft()
+        last = self._history_requests.get(key)
+        if last is not None and now - last < self.config.identical_history_window:
+            return f"Pacing violation: identical request within {self.config.identical_history_window:g} seconds"
+        if len(self._history_times) >= self.config.history_requests:
+            return f"Pacing violation: more than {self.config.history_requests} requests " \
+                   f"in {self.config.history_window:g} seconds"
+        self._history_times.append(now)
+        self._history_requests[key] = now
+        return ''
+
+    def cancelHistoricalData(self, client, reqId):
+        pass
+
+    # orders
+
+    def _order_clients(self, sim):
+        return [c for c in self._clients if c.clientId in (sim.client_id, self.config.master_client_id)]
+
+    def _order_calls(self, sim):
+        order = copy.copy(sim.order)
+        state = OrderState(status=sim.status)
+        return [
+            ('openOrder', (sim.order_id, sim.contract, order, state)),
+            ('orderStatus', (sim.order_id, sim.status, sim.filled, sim.remaining, sim.avg_price, sim.perm_id,
+                             0, sim.last_price, sim.client_id, '', 0.0)),
+        ]
+
+    def _send_order(self, sim, calls=None):
+        for client in self._order_clients(sim):
+            self._deliver(client, calls or self._order_calls(sim))
+
+    def placeOrder(self, client, orderId, contract, order):
+        if order.whatIf:
+            self._what_if(client, orderId, contract, order)
+            return
+        self._next_order_ids[client.clientId] = max(self._next_order_ids.get(client.clientId, 1), orderId + 1)
+        sim = self._orders.get((client.clientId, orderId))
+        if sim is not None:
+            self._modify(client, sim, order)
+            return
+        if not order.transmit:
+            # Held like TWS does until its parent or a child of the same parent is transmitted
+            self._held.setdefault(client.clientId, []).append((orderId, contract, order))
+            return
+        # Only the group linked by parentId is released; held orders outside it, such as
+        # OCA exits without a parent, stay held for good as they would in TWS
+        root = order.parentId or orderId
+        held = self._held.pop(client.clientId, [])
+        linked = [h for h in held if h[0] == root or h[2].parentId == root]
+        if len(linked) < len(held):
+            self._held[client.clientId] = [h for h in held if h[0] != root and h[2].parentId != root]
+        for item in linked:
+            self._submit(client, *item)
+        self._submit(client, orderId, contract, order)
+
+    def _submit(self, client, orderId, contract, order):
+        symbol = self._symbol(contract)
+        reason = self._reject_reason(order, symbol)
+        parent = self._orders.get((client.clientId, order.parentId)) if order.parentId else None
+        if order.parentId and (parent is None or parent.status in DONE_STATES - {'Filled'}):
+            reason = reason or "Parent order is not working"
+        if reason:
+            self._deliver(client, [('error', (orderId, 201, f"Order rejected - reason:{reason}", ''))])
+            return
+        order = copy.copy(order)
+        order.orderId = orderId
+        order.clientId = client.clientId
+        order.permId = next(self._perm_ids)
+        sim = SimOrder(client.clientId, orderId, order.permId, symbol, self._details(symbol).contract, order)
+        self._orders[(client.clientId, orderId)] = sim
+        if parent is not None and parent.status != 'Filled':
+            # Children of a bracket wait for their parent to fill
+            sim.status = 'PreSubmitted'
+            self._send_order(sim)
+            return
+        self._send_order(sim)
+        if any(s.status == 'Filled' for s in self._siblings(sim, working=False)):
+            # The group is activated as one, so an exit arriving after its sibling filled is cancelled
+            self._cancel(sim, "OCA group")
+            return
+        self._match(sim)
+
+    def _reject_reason(self, order, symbol):
+        if symbol is None:
+            return "No security definition has been found for the request"
+        if order.orderType not in ORDER_TYPES:
+            return f"Unsupported order type {order.orderType}"
+        if order.action not in ('BUY', 'SELL') or not order.totalQuantity > 0:
+            return "Invalid action or quantity"
+        if order.orderType in ('LMT', 'STP LMT') and not order.lmtPrice > 0:
+            return "Limit price must be positive"
+        if order.orderType in ('STP', 'STP LMT') and not order.auxPrice > 0:
+            return "Stop price must be positive"
+        if order.orderType == 'TRAIL' and _is_set(order.auxPrice) == _is_set(order.trailingPercent):
+            return "A trailing stop needs either a trailing amount or a trailing percent"
+        signed = order.totalQuantity if order.action == 'BUY' else -order.totalQuantity
+        equity, margin_after = self.net_liquidation(), self._margin({symbol: signed})
+        if margin_after > equity:
+            return f"YOUR ORDER IS NOT ACCEPTED. IN ORDER TO OBTAIN THE DESIRED POSITION YOUR EQUITY WITH LOAN " \
+                   f"VALUE [{equity:.2f} USD] MUST EXCEED THE INITIAL MARGIN [{margin_after:.2f} USD]"
+        return ''
+
+    def _modify(self, client, sim, order):
+        if sim.status in DONE_STATES:
+            self._deliver(client, [('error', (sim.order_id, 104, "Can't modify a filled order.", ''))])
+            return
+        reason = self._reject_reason(order, sim.symbol)
+        if reason:
+            # A refused modification leaves the working order as it was
+            self._deliver(client, [('error', (sim.order_id, 201, f"Order rejected - reason:{reason}", ''))])
+            return
+        for name in ('totalQuantity', 'lmtPrice', 'auxPrice', 'orderType', 'trailingPercent', 'trailStopPrice'):
+            setattr(sim.order, name, getattr(order, name))
+        self._send_order(sim)
+        if sim.status != 'PreSubmitted':
+            self._match(sim)
+
+    def cancelOrder(self, client, orderId, manualCancelOrderTime=''):
+        sim = self._orders.get((client.clientId, orderId))
+        if sim is None or sim.status in DONE_STATES:
+            self._deliver(client, [('error', (orderId, 10147, f"OrderId {orderId} that needs to be cancelled "
+                                                              f"is not found.", ''))])
+            return
+        self._cancel(sim)
+        # Cancelling a parent cancels the children waiting for it
+        for child in self._children(sim):
+            self._cancel(child)
+
+    def _cancel(self, sim, reason=''):
+        sim.status = 'Cancelled'
+        self._rest(sim, False)
+        self._send_order(sim, self._order_calls(sim)[1:]
+                         + [('error', (sim.order_id, 202, f"Order Canceled - reason:{reason}", ''))])
+
+    def _children(self, sim):
+        return [s for s in self._orders.values() if s.client_id == sim.client_id
+                and s.order.parentId == sim.order_id and s.status not in DONE_STATES]
+
+    def _siblings(self, sim, working=True):
+        """Orders that one-cancels-all ties to this one: its OCA group, or the other exits of its bracket."""
+        order = sim.order
+        return [s for s in self._orders.values() if s is not sim and s.client_id == sim.client_id
+                and (s.status not in DONE_STATES or not working)
+                and ((order.ocaGroup and s.order.ocaGroup == order.ocaGroup)
+                     or (order.parentId and s.order.parentId == order.parentId))]
+
+    def _filled(self, sim):
+        for sibling in self._siblings(sim):
+            self._cancel(sibling, "OCA group")
+        for child in self._children(sim):
+            child.status = 'Submitted'
+            self._send_order(child)
+            self._match(child)
+
+    def _trail(self, sim, quote):
+        """Move a trailing stop after the price, never back."""
+        order = sim.order
+        buy = order.action == 'BUY'
+        offset = quote.last * order.trailingPercent / 100 if _is_set(order.trailingPercent) else order.auxPrice
+        stop = round(quote.last + offset if buy else quote.last - offset, 2)
+        if not _is_set(order.trailStopPrice) or (stop < order.trailStopPrice if buy else stop > order.trailStopPrice):
+            order.trailStopPrice = stop
+
+    def _rest(self, sim, resting):
+        orders = self._resting.setdefault(sim.symbol, [])
+        if resting and sim not in orders:
+            orders.append(sim)
+            self._start_ticking()
+        elif not resting and sim in orders:
+            orders.remove(sim)
+
+    def _fill_price(self, sim):
+        """Price the order fills at now, or None if it would keep working."""
+        quote = self._quote(sim.symbol)
+        order = sim.order
+        buy = order.action == 'BUY'
+        market = quote.ask if buy else quote.bid
+        if self.config.fill_model == 'immediate':
+            return order.lmtPrice if order.orderType in ('LMT', 'STP LMT') else market
+        if order.orderType in ('STP', 'STP LMT'):
+            triggered = quote.last >= order.auxPrice if buy else quote.last <= order.auxPrice
+            if not triggered:
+                return None
+        if order.orderType == 'TRAIL':
+            self._trail(sim, quote)
+            triggered = quote.last >= order.trailStopPrice if buy else quote.last <= order.trailStopPrice
+            if not triggered:
+                return None
+        if order.orderType in ('MKT', 'STP', 'TRAIL'):
+            return market
+        if buy and quote.ask <= order.lmtPrice:
+            return min(order.lmtPrice, quote.ask)
+        if not buy and quote.bid >= order.lmtPrice:
+            return max(order.lmtPrice, quote.bid)
+        return None
+
+    def _match(self, sim):
+        if self.config.fill_model == 'never' or sim.status in DONE_STATES:
+            return
+        price = self._fill_price(sim)
+        if price is None:
+            self._rest(sim, True)
+            return
+        self._rest(sim, False)
+        self._fill(sim, price)
+
+    def _fill(self, sim, price):
+        shares = sim.remaining
+        signed = shares if sim.order.action == 'BUY' else -shares
+        commission = max(self.config.min_commission, shares * self.config.commission_per_share)
+        realized = self._apply_fill(sim.symbol, sim.contract, signed, price, commission)
+
+        sim.avg_price = (sim.avg_price * sim.filled + price * shares) / (sim.filled + shares)
+        sim.filled += shares
+        sim.last_price = price
+        sim.status = 'Filled'
+        execution = Execution(
+            execId=f"{sim.perm_id:08x}.{next(self._exec_ids):04d}", time=datetime.datetime.now(datetime.timezone.utc),
+            acctNumber=self.config.account, exchange='SIM', side='BOT' if signed > 0 else 'SLD', shares=shares,
+            price=price, permId=sim.perm_id, clientId=sim.client_id, orderId=sim.order_id, cumQty=sim.filled,
+            avgPrice=sim.avg_price
+        )
+        report = CommissionReport(execId=execution.execId, commission=commission, currency='USD',
+                                  realizedPNL=realized)
+        self._fills.append((sim, execution, report))
+        self._send_order(sim, [
+            ('execDetails', (-1, sim.contract, execution)),
+            self._order_calls(sim)[1],
+            ('commissionReport', (copy.copy(report),)),
+        ])
+        self._send_account(sim.symbol)
+        self._filled(sim)
+
+    # account
+
+    def _apply_fill(self, symbol, contract, signed, price, commission):
+        """Book a fill and return the realized P&L of the shares it closed."""
+        position = self._positions.setdefault(symbol, SimPosition(contract))
+        quantity = position.quantity
+        realized = 0.0
+        if quantity == 0 or (quantity > 0) == (signed > 0):
+            position.avg_cost = (position.avg_cost * abs(quantity) + price * abs(signed)) / abs(quantity + signed)
+        else:
+            closed = min(abs(quantity), abs(signed))
+            realized = closed * (price - position.avg_cost) * (1 if quantity > 0 else -1) - commission
+            position.realized += realized
+            if abs(signed) > abs(quantity):
+                position.avg_cost = price
+        position.quantity = quantity + signed
+        self.cash -= signed * price + commission
+        return realized
+
+    def _price(self, symbol):
+        return self._quote(symbol).last
+
+    def net_liquidation(self):
+        return self.cash + sum(p.quantity * self._price(s) for s, p in self._positions.items())
+
+    def _margin(self, changes=None):
+        """Initial margin of the positions, optionally with extra quantities per symbol."""
+        quantities = {s: p.quantity for s, p in self._positions.items()}
+        for symbol, quantity in (changes or {}).items():
+            quantities[symbol] = quantities.get(symbol, 0) + quantity
+        return sum(abs(q) * self._price(s) for s, q in quantities.items()) * self.config.initial_margin
+
+    def _account_calls(self, symbols=None):
+        account = self.config.account
+        gross = sum(abs(p.quantity) * self._price(s) for s, p in self._positions.items())
+        net_liq = self.net_liquidation()
+        available = net_liq - gross * self.config.initial_margin
+        values = {
+            'NetLiquidation': net_liq,
+            'TotalCashValue': self.cash,
+            'GrossPositionValue': gross,
+            'InitMarginReq': gross * self.config.initial_margin,
+            'MaintMarginReq': gross * self.config.maintenance_margin,
+            'AvailableFunds': available,
+            'ExcessLiquidity': net_liq - gross * self.config.maintenance_margin,
+            'BuyingPower': available / self.config.initial_margin,
+            'EquityWithLoanValue': net_liq,
+            'UnrealizedPnL': sum(p.quantity * (self._price(s) - p.avg_cost) for s, p in self._positions.items()),
+            'RealizedPnL': sum(p.realized for p in self._positions.values()),
+        }
+        calls = [('updateAccountValue', (tag, f"{value:.2f}", 'USD', account)) for tag, value in values.items()]
+        calls += [('updateAccountValue', ('TotalCashBalance', f"{self.cash:.2f}", currency, account))
+                  for currency in ('USD', 'BASE')]
+        for symbol, p in self._positions.items():
+            if symbols is None or symbol in symbols:
+                price = self._price(symbol)
+                calls.append(('updatePortfolio', (
+                    p.contract, p.quantity, price, p.quantity * price, p.avg_cost,
+                    p.quantity * (price - p.avg_cost), p.realized, account
+                )))
+        return calls
+
+    def _send_account(self, symbol):
+        position = self._positions[symbol]
+        for client in self._account_subscribers:
+            self._deliver(client, self._account_calls({symbol}))
+        for client in self._position_subscribers:
+            self._deliver(client, [('position', (self.config.account, position.contract, position.quantity,
+                                                 position.avg_cost))])
+        if not position.quantity:
+            del self._positions[symbol]
+
+    def reqAccountUpdates(self, client, subscribe, acctCode):
+        if not subscribe:
+            self._account_subscribers.discard(client)
+            return
+        self._account_subscribers.add(client)
+        self._deliver(client, self._account_calls() + [('accountDownloadEnd', (self.config.account,))])
+
+    def reqAccountUpdatesMulti(self, client, reqId, account, modelCode, ledgerAndNLV):
+        self._deliver(client, [('accountUpdateMultiEnd', (reqId,))])
+
+    def reqPositions(self, client):
+        self._position_subscribers.add(client)
+        calls = [('position', (self.config.account, p.contract, p.quantity, p.avg_cost))
+                 for p in self._positions.values()]
+        self._deliver(client, calls + [('positionEnd', ())])
+
+    def _what_if(self, client, reqId, contract, order):
+        symbol = self._symbol(contract)
+        if symbol is None:
+            self._deliver(client, [('error', (reqId, 200, "No security definition has been found for the request", ''))])
+            return
+        signed = order.totalQuantity if order.action == 'BUY' else -order.totalQuantity
+        before, after = self._margin(), self._margin({symbol: signed})
+        maintenance = self.config.maintenance_margin / self.config.initial_margin
+        commission = max(self.config.min_commission, order.totalQuantity * self.config.commission_per_share)
+        equity = self.net_liquidation()
+        state = OrderState(
+            status='PreSubmitted',
+            initMarginBefore=f"{before:.2f}", initMarginChange=f"{after - before:.2f}", initMarginAfter=f"{after:.2f}",
+            maintMarginBefore=f"{before * maintenance:.2f}", maintMarginChange=f"{(after - before) * maintenance:.2f}",
+            maintMarginAfter=f"{after * maintenance:.2f}",
+            equityWithLoanBefore=f"{equity:.2f}", equityWithLoanChange=f"{-commission:.2f}",
+            equityWithLoanAfter=f"{equity - commission:.2f}",
+            commission=commission, minCommission=commission, maxCommission=commission, commissionCurrency='USD',
+            warningText='' if after <= equity else "Insufficient equity for the initial margin"
+        )
+        order = copy.copy(order)
+        order.orderId = reqId
+        self._deliver(client, [('openOrder', (reqId, self._details(symbol).contract, order, state))])
+
+    def _open_orders(self, client_id=None):
+        return [sim for sim in self._orders.values()
+                if sim.status not in DONE_STATES and (client_id is None or sim.client_id == client_id)]
+
+    def reqOpenOrders(self, client):
+        calls = [call for sim in self._open_orders(client.clientId) for call in self._order_calls(sim)]
+        self._deliver(client, calls + [('openOrderEnd', ())])
+
+    def reqAllOpenOrders(self, client):
+        calls = [call for sim in self._open_orders() for call in self._order_calls(sim)]
+        self._deliver(client, calls + [('openOrderEnd', ())])
+
+    def reqAutoOpenOrders(self, client, bAutoBind):
+        pass
+
+    def reqCompletedOrders(self, client, apiOnly):
+        self._deliver(client, [('completedOrdersEnd', ())])
+
+    def reqExecutions(self, client, reqId, execFilter):
+        calls = [('execDetails', (reqId, sim.contract, copy.copy(execution)))
+                 for sim, execution, _ in self._fills
+                 if client.clientId in (sim.client_id, self.config.master_client_id)]
+        self._deliver(client, calls + [('execDetailsEnd', (reqId,))])
+
+    def reqMarketDataType(self, client, marketDataType):
+        pass
+
+
+class SimClient(Client):
+    """
+    ib_insync Client that talks to a SimGateway instead of a socket.
+
+    Requests are throttled exactly like the real client before they reach
+    the gateway; requests the simulator does not implement are dropped
+    with a warning.
+    """
+
+    def __init__(self, wrapper, gateway):
+        self.gateway = gateway
+        super().__init__(wrapper)
+
+    def reset(self):
+        super().reset()
+        self.last_delivery = 0.0
+
+    async def connectAsync(self, host, port, clientId, timeout=2.0):
+        self.host = host
+        self.port = int(port)
+        self.clientId = int(clientId)
+        self.connState = Client.CONNECTING
+        try:
+            await asyncio.wait_for(self._handshake(), timeout or None)
+        except BaseException as e:
+            self.disconnect()
+            self.apiError.emit(f'API connection failed: {e!r}')
+            raise
+
+    async def _handshake(self):
+        await asyncio.sleep(self.gateway.config.latency)
+        next_order_id = self.gateway.attach(self)
+        self.connState = Client.CONNECTED
+        self._serverVersion = self.MaxClientVersion
+        self._reqIdSeq = next_order_id
+        self._accounts = [self.gateway.config.account]
+        self._apiReady = True
+        self.apiStart.emit()
+
+    def disconnect(self):
+        self.gateway.detach(self)
+        super().disconnect()
+
+    def connection_lost(self, msg):
+        """Called by the gateway when it closes the connection."""
+        self._onSocketDisconnected(msg)
+
+    def dispatch(self, calls):
+        """Apply one batch of gateway responses the way the socket decoder would."""
+        if not self.isReady():
+            return
+        self.wrapper.tcpDataArrived()
+        for name, args in calls:
+            self._numMsgRecv += 1
+            getattr(self.wrapper, name)(*args)
+        self.wrapper.tcpDataProcessed()
+
+    def sendMsg(self, msg):
+        self._logger.warning('Not simulated: %s', msg[:-1].replace('\0', ','))
+
+    def _send(self, handler, *args):
+        if not self.isConnected():
+            raise ConnectionError('Not connected')
+        self._msgQ.append((handler, args))
+        self._flush()
+
+    def _flush(self):
+        # Same throttling as Client.sendMsg
+        loop = getLoop()
+        t = loop.time()
+        times = self._timeQ
+        msgs = self._msgQ
+        while times and t - times[0] > self.RequestsInterval:
+            times.popleft()
+        while msgs and (len(times) < self.MaxRequests or not self.MaxRequests) and self.isConnected():
+            handler, args = msgs.popleft()
+            times.append(t)
+            self.gateway.receive(self, handler, args)
+        if msgs and self.isConnected():
+            if not self._isThrottling:
+                self._isThrottling = True
+                self.throttleStart.emit()
+            loop.call_at(times[0] + self.RequestsInterval, self._flush)
+        elif self._isThrottling:
+            self._isThrottling = False
+            self.throttleEnd.emit()
+
+    def reqMktData(self, reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions):
+        self._send('reqMktData', reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions)
+
+    def cancelMktData(self, reqId):
+        self._send('cancelMktData', reqId)
+
+    def reqRealTimeBars(self, reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions):
+        self._send('reqRealTimeBars', reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions)
+
+    def cancelRealTimeBars(self, reqId):
+        self._send('cancelRealTimeBars', reqId)
+
+    def reqContractDetails(self, reqId, contract):
+        self._send('reqContractDetails', reqId, copy.copy(contract))
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                          formatDate, keepUpToDate, chartOptions):
+        self._send('reqHistoricalData', reqId, copy.copy(contract), endDateTime, durationStr, barSizeSetting,
+                   whatToShow, useRTH, formatDate, keepUpToDate, chartOptions)
+
+    def cancelHistoricalData(self, reqId):
+        self._send('cancelHistoricalData', reqId)
+
+    def placeOrder(self, orderId, contract, order):
+        # The gateway keeps its own copy, as it would after serializing the order
+        self._send('placeOrder', orderId, copy.copy(contract), copy.copy(order))
+
+    def cancelOrder(self, orderId, manualCancelOrderTime=''):
+        self._send('cancelOrder', orderId, manualCancelOrderTime)
+
+    def reqOpenOrders(self):
+        self._send('reqOpenOrders')
+
+    def reqAllOpenOrders(self):
+        self._send('reqAllOpenOrders')
+
+    def reqAutoOpenOrders(self, bAutoBind):
+        self._send('reqAutoOpenOrders', bAutoBind)
+
+    def reqCompletedOrders(self, apiOnly):
+        self._send('reqCompletedOrders', apiOnly)
+
+    def reqAccountUpdates(self, subscribe, acctCode):
+        self._send('reqAccountUpdates', subscribe, acctCode)
+
+    def reqAccountUpdatesMulti(self, reqId, account, modelCode, ledgerAndNLV):
+        self._send('reqAccountUpdatesMulti', reqId, account, modelCode, ledgerAndNLV)
+
+    def reqPositions(self):
+        self._send('reqPositions')
+
+    def reqExecutions(self, reqId, execFilter):
+        self._send('reqExecutions', reqId, execFilter)
+
+    def reqMarketDataType(self, marketDataType):
+        self._send('reqMarketDataType', marketDataType)
+
+
+class SimIB(IB):
+    """
+    Drop-in replacement for ``IB`` connected to a simulated gateway.
+
+    Several SimIB instances can share one gateway to act as different
+    clients of the same account.
+    """
+
+    def __init__(self, gateway=None, config=None):
+        super().__init__()
+        self.gateway = gateway or SimGateway(config)
+        self.client = SimClient(self.wrapper, self.gateway)
+        self.client.apiEnd += self.disconnectedEvent
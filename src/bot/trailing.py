@@ -0,0 +1,140 @@
+import asyncio
+import math
+from dataclasses import dataclass
+
+from contracts import round_to_tick
+from market_data import contract_key, ticker_cache
+from orders import amend_stop_price_async
+from pacing import TokenBucket, request_scheduler
+from shared import per_connection
+
+# Stop amendments per second, leaving most of IB's message budget to order entry
+TRAIL_AMEND_RATE = 10
+
+
+@dataclass
+class TrailingStop:
+    """A working STP order whose stop price follows the market from the client side."""
+    trade: object
+    trail_amount: float = None
+    trail_percent: float = None
+    min_step: float = 0.01  # smallest stop move worth an amendment
+    min_tick: float = 0.01  # stop prices are multiples of the contract's minimum tick
+    best: float = math.nan  # best price since tracking started: the high for a SELL stop, the low for a BUY stop
+    target: float = None  # stop price being sent to IB
+    amends: int = 0
+    error: str = ''
+
+    @property
+    def order_id(self):
+        return self.trade.order.orderId
+
+    @property
+    def sell(self):
+        return self.trade.order.action == 'SELL'
+
+    def stop_for(self, price):
+        offset = price * self.trail_percent / 100 if self.trail_percent is not None else self.trail_amount
+        return round_to_tick(price - offset if self.sell else price + offset, self.min_tick)
+
+    def summary(self):
+        trail = f"{self.trail_percent}%" if self.trail_percent is not None else f"{self.trail_amount}"
+        line = f"Order {self.order_id} {self.trade.contract.symbol} {self.trade.order.action}: " \
+               f"stop {self.trade.order.auxPrice} trailing {self.best} by {trail}, {self.amends} amendments"
+        return line + (f" Error = {self.error}" if self.error else "")
+
+
+class TrailingManager:
+    """
+    Client-side trailing stops for working STP orders. One handler on the
+    shared ticker stream moves every stop after its price once per batch of
+    updates, and the amendments go out through one token bucket, at most
+    one in flight per order: a stop that moved again meanwhile is sent with
+    its latest price when the previous amendment is acknowledged.
+    """
+
+    def __init__(self, ib, rate=TRAIL_AMEND_RATE, timeout=5.0):
+        self.ib = ib
+        self.timeout = timeout
+        self._bucket = TokenBucket(rate)
+        self._stops = {}  # orderId -> TrailingStop
+        self._by_contract = {}  # contract key -> set of orderIds
+        self._amending = {}  # orderId -> task sending the stop's target
+        ib.pendingTickersEvent += self._on_tickers
+        ib.orderStatusEvent += self._on_order_status
+
+    def __len__(self):
+        return len(self._stops)
+
+    def stops(self):
+        return list(self._stops.values())
+
+    def add(self, trade, trail_amount=None, trail_percent=None, min_tick=0.01, min_step=None):
+        """
+        Start trailing a working stop order by an amount or a percent of the
+        price; the stop moves by at least ``min_step``, one tick by default.
+        """
+        if trade.order.orderType != 'STP':
+            raise ValueError(f"Order {trade.order.orderId} is a {trade.order.orderType} order, not a stop order.")
+        if trade.isDone():
+            raise ValueError(f"Order {trade.order.orderId} is already {trade.orderStatus.status}.")
+        if (trail_amount is None) == (trail_percent is None):
+            raise ValueError("Trail by an amount or by a percent.")
+        stop = TrailingStop(trade, trail_amount, trail_percent, min_step or min_tick, min_tick,
+                            target=trade.order.auxPrice)
+        self._stops[stop.order_id] = stop
+        self._by_contract.setdefault(contract_key(trade.contract), set()).add(stop.order_id)
+        # The stream the stops follow is the shared one of the ticker cache, held
+        # so that other symbols needing lines never cancel it under the stop
+        self._update(stop, ticker_cache(self.ib).hold(trade.contract))
+        return stop
+
+    def remove(self, order_id):
+        stop = self._stops.pop(order_id, None)
+        if stop is not None:
+            self._by_contract.get(contract_key(stop.trade.contract), set()).discard(order_id)
+            ticker_cache(self.ib).release(stop.trade.contract)
+        return stop
+
+    def _on_tickers(self, tickers):
+        for ticker in tickers:
+            for order_id in self._by_contract.get(contract_key(ticker.contract), ()):
+                self._update(self._stops[order_id], ticker)
+
+    def _on_order_status(self, trade):
+        if trade.isDone() and trade.order.orderId in self._stops:
+            self.remove(trade.order.orderId)
+
+    def _update(self, stop, ticker):
+        price = ticker.marketPrice()
+        if not price > 0:
+            return
+        if math.isnan(stop.best) or (price > stop.best if stop.sell else price < stop.best):
+            stop.best = price
+        target = stop.stop_for(stop.best)
+        # Stops only ever move with the position, never back
+        gain = target - stop.target if stop.sell else stop.target - target
+        if gain >= stop.min_step:
+            stop.target = target
+            task = self._amending.get(stop.order_id)
+            if task is None or task.done():
+                self._amending[stop.order_id] = asyncio.ensure_future(self._amend(stop))
+
+    async def _amend(self, stop):
+        trade = stop.trade
+        try:
+            while stop.order_id in self._stops and stop.target != trade.order.auxPrice and not trade.isDone():
+                await self._bucket.acquire()
+                await request_scheduler(self.ib).acquire('order')
+                result = await amend_stop_price_async(self.ib, trade, stop.target, self.timeout)
+                if result.error:
+                    # Tried again with the next move of the price
+                    stop.error = result.error
+                    return
+                stop.amends += 1
+                stop.error = ''
+        finally:
+            self._amending.pop(stop.order_id, None)
+
+
+trailing_manager = per_connection(TrailingManager)
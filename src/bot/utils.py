@@ -1,56 +1,70 @@
 from ib_insync import *
 
+from account import account_state
+from bars import bar_store
+from contracts import contract_registry
+from market_data import has_quote, ticker_cache
+from orderbook import order_book
+from orders import Leg, reprice_orders, submit_batch
+from pacing import request_scheduler
+from risk import calculate_pos_size, configured_limits, what_if_cache
+from sessions import session_calendar
+
 def fetch_account_balance(ib, currency='USD'):
     """Fetch total cash balance in the specified currency."""
-    account_values = ib.accountValues()
-    filtered = list(filter(lambda acc: acc.currency == currency and acc.tag == 'TotalCashBalance', account_values))
-    if filtered:
-        return float(filtered[0].value)
+    balance = account_state(ib).balance(currency)
+    if balance is not None:
+        return float(balance)
     else:
         print(f"No TotalCashBalance found for {currency}.")
         return 0.0
 
 def is_market_open(ib, symbol):
-    """Check if the market is open for specific symbol."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
-    details = ib.reqContractDetails(contract)
-    return details[0].tradingHours
+    """Check if the market is open for specific symbol, and until when."""
+    return session_calendar(ib).status(contract_registry(ib).get(symbol))
+
+async def is_market_open_async(ib, symbol):
+    return session_calendar(ib).status(await contract_registry(ib).get_async(symbol))
 
 def fetch_positions(ib):
     """Fetch all current positions in the portfolio."""
     return ib.positions()
 
+def fetch_positions_frame(ib):
+    """Current positions as a DataFrame, one row per account and contract, with market values."""
+    return account_state(ib).to_frame()
+
 def get_real_time_price(ib, symbol):
     """Fetch latest price for a stock."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
-    ticker = ib.reqMktData(contract)
-    ib.sleep(2)  # Data needs to populate
+    contract = contract_registry(ib).contract(symbol)
+    ticker = ticker_cache(ib).get(contract)
+    return ticker.last
+
+async def get_real_time_price_async(ib, symbol):
+    contract = (await contract_registry(ib).get_async(symbol)).contract
+    ticker = await ticker_cache(ib).get_async(contract)
     return ticker.last
 
 def fetch_historical_data(ib, symbol, duration='1 D', bar_size='1 min'):
-    """Fetch historical data for the given symbol."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
-    bars = ib.reqHistoricalData(
-        contract,
-        endDateTime='',
-        durationStr=duration,
-        barSizeSetting=bar_size,
-        whatToShow='MIDPOINT',
-        useRTH=True
-    )
-    return bars
+    """Fetch historical data for the given symbol, downloading only bars missing from the local store."""
+    return bar_store().ensure(ib, symbol, duration, bar_size, what_to_show='MIDPOINT')
+
+async def fetch_historical_data_async(ib, symbol, duration='1 D', bar_size='1 min'):
+    return await bar_store().ensure_async(ib, symbol, duration, bar_size, what_to_show='MIDPOINT')
 
 def bid_ask_spread(ib, symbol):
     """
     Calculate difference between bid price (highest price a buyer is willing to pay) and ask price 
     (lowest price a seller is willing to accept)
     """
-    # Create stock contract
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
+    return ib.run(bid_ask_spread_async(ib, symbol))
+
+async def bid_ask_spread_async(ib, symbol):
+    # Look up the qualified stock contract
+    contract = (await contract_registry(ib).get_async(symbol)).contract
     
-    # Request market data for the contract
-    ticker = ib.reqMktData(contract)
-    ib.sleep(2)  # market data needs to populate
+    # Reuse the live subscription, waiting for the first quote if needed
+    ticker = await ticker_cache(ib).get_async(contract, ready=has_quote)
 
     # Check if bid and ask prices are available
     if ticker.bid and ticker.ask:
@@ -65,52 +79,52 @@ def bid_ask_spread(ib, symbol):
         print(f"Bid or ask price not available for {symbol}.")
         return None
 
+async def place_order_async(ib, symbol, order):
+    """Place an order once the request scheduler lets it through, ahead of any queued data requests."""
+    contract = (await contract_registry(ib).get_async(symbol)).contract
+    await request_scheduler(ib).acquire('order')
+    return ib.placeOrder(contract, order)
+
 def place_limit_order(ib, symbol, quantity, price, action='BUY'):
     """Place a limit order for the given symbol."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
+    return ib.run(place_limit_order_async(ib, symbol, quantity, price, action))
+
+async def place_limit_order_async(ib, symbol, quantity, price, action='BUY'):
     order = Order(action=action, totalQuantity=quantity, orderType='LMT', lmtPrice=price)
-    trade = ib.placeOrder(contract, order)
-    return trade
+    return await place_order_async(ib, symbol, order)
 
 def place_market_order(ib, symbol, quantity=1, action='BUY'):
     """Place a market order for a stock."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
+    return ib.run(place_market_order_async(ib, symbol, quantity, action))
+
+async def place_market_order_async(ib, symbol, quantity=1, action='BUY'):
     order = Order(action=action, totalQuantity=quantity, orderType='MKT')
-    trade = ib.placeOrder(contract, order)
-    return trade
+    return await place_order_async(ib, symbol, order)
 
-def place_batch_orders(ib, orders):
-    """Place multiple orders."""
-    trades = []
-    for order_details in orders:
-        symbol, quantity, price, action = order_details
-        trade = place_limit_order(ib, symbol, quantity, price, action)
-        trades.append(trade)
-    return trades
+def place_batch_orders(ib, orders, limits=None):
+    """
+    Place multiple limit orders concurrently and wait for IB to acknowledge them.
+    Legs that fail the pre-trade risk checks are rejected without being sent.
+    """
+    legs = [order if isinstance(order, Leg) else Leg(*order) for order in orders]
+    return submit_batch(ib, legs, limits=limits or configured_limits())
 
 def change_limit_price(ib, trade, new_price):
+    """Modify an existing limit order's price in place."""
     # Check if the existing trade has an order
     if not trade or not trade.order:
         print("No order found to modify.")
         return None
+    return reprice_orders(ib, [(trade, new_price)])[0]
 
-    # Cancel existing order
-    print(f"Cancelling order ID {trade.order.orderId} with limit price {trade.order.lmtPrice}...")
-    ib.cancelOrder(trade.order)
-    ib.sleep(2)  # Wait for cancellation to process
-
-    # Create new order with updated limit price
-    contract = trade.contract
-    new_order = Order(
-        action=trade.order.action,
-        totalQuantity=trade.order.totalQuantity,
-        orderType='LMT',
-        lmtPrice=new_price
-    )
-    new_trade = ib.placeOrder(contract, new_order)
-
-    print(f"New order placed with limit price {new_price}")
-    return new_trade
+def change_limit_prices(ib, new_prices):
+    """Modify the limit prices of many orders at once, given a dict of order ID to new price."""
+    trades_and_prices = []
+    for order_id, new_price in new_prices.items():
+        trade = get_trade_by_id(ib, order_id)
+        if trade:
+            trades_and_prices.append((trade, new_price))
+    return reprice_orders(ib, trades_and_prices)
 
 def get_order_status(ib, trade):
     """Check the status of an order."""
@@ -118,40 +132,46 @@ def get_order_status(ib, trade):
 
 def cancel_order(ib, trade):
     """Cancel a pending order."""
-    ib.cancelOrder(trade.order)
-    print(f"Order {trade.order.orderId} canceled.")
+    return ib.run(cancel_order_async(ib, trade))
+
+async def cancel_order_async(ib, trade):
+    await request_scheduler(ib).acquire('order')
+    return ib.cancelOrder(trade.order)
 
 def set_stop_loss(ib, symbol, quantity, stop_price):
     """Place a stop-loss order."""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
+    return ib.run(set_stop_loss_async(ib, symbol, quantity, stop_price))
+
+async def set_stop_loss_async(ib, symbol, quantity, stop_price):
     order = Order(action='SELL', totalQuantity=quantity, orderType='STP', auxPrice=stop_price)
-    trade = ib.placeOrder(contract, order)
-    return trade
+    return await place_order_async(ib, symbol, order)
 
-def calculate_pos_size(account_bal, risk_perc, entry_price, stop_loss_price):
-    """Calculate position size to buy based on account balance, risk tolerance, and stop-loss distance."""
-    # risk amount
-    risk_amt = account_bal * (risk_perc / 100)
-    # stop-loss distance
-    stop_loss_dist = abs(entry_price - stop_loss_price)
-    #  position size
-    if stop_loss_dist == 0:
-        raise ValueError("Stop-loss distance cannot be zero.")
-    pos_size = risk_amt / stop_loss_dist
+def set_trailing_stop(ib, symbol, quantity, trail_amount=None, trail_percent=None, stop_price=None):
+    """Place a trailing stop that IB moves after the price, by an amount or a percent."""
+    return ib.run(set_trailing_stop_async(ib, symbol, quantity, trail_amount, trail_percent, stop_price))
 
-    return pos_size
+async def set_trailing_stop_async(ib, symbol, quantity, trail_amount=None, trail_percent=None, stop_price=None):
+    order = Order(action='SELL', totalQuantity=quantity, orderType='TRAIL')
+    if trail_percent is not None:
+        order.trailingPercent = trail_percent
+    else:
+        order.auxPrice = trail_amount
+    if stop_price is not None:
+        order.trailStopPrice = stop_price
+    return await place_order_async(ib, symbol, order)
 
 def test_order(ib, symbol, quantity=1, action='BUY'):
     """Simulating orders to check for errors or margin impact"""
-    contract = Stock(symbol=symbol, exchange='SMART', currency='USD')
-    order = Order(action=action, totalQuantity=quantity, orderType='MKT')
-    validation = ib.whatIfOrder(contract, order)
+    validation = ib.run(test_order_async(ib, symbol, quantity, action))
     print(f"Order validation: {validation}")
 
+async def test_order_async(ib, symbol, quantity=1, action='BUY'):
+    contract = (await contract_registry(ib).get_async(symbol)).contract
+    return await what_if_cache(ib).get_async(contract, quantity, action)
+
 def get_trade_by_id(ib, order_id):
     """Retrieve a Trade object by its order ID."""
-    for trade in ib.trades():
-        if trade.order.orderId == order_id:
-            return trade
-    print(f"Trade with ID {order_id} not found.")
-    return None
+    trade = order_book(ib).trade(order_id)
+    if trade is None:
+        print(f"Trade with ID {order_id} not found.")
+    return trade
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# The bot modules in src/bot import each other as top-level modules, so the
+# dashboard puts that directory on the path to share them.
+BOT_DIR = str(Path(__file__).resolve().parents[2] / 'bot')
+if BOT_DIR not in sys.path:
+    sys.path.insert(0, BOT_DIR)
@@ -0,0 +1,161 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import app.botpath  # noqa: F401
+from indicators import IndicatorEngine, sma as sma_indicator
+
+# Bars drawn per chart
+CHART_BARS = 200
+# Decimals sent for prices and the SMA; plenty for stock ticks and keeps the payload short
+PRICE_DECIMALS = 4
+
+
+@dataclass
+class ChartSeries:
+    """Points of one chart's series, only the fields lightweight-charts reads."""
+    candles: list  # {'time', 'open', 'high', 'low', 'close'}
+    volume: list  # {'time', 'value'}
+    sma: list  # {'time', 'value'}, from the first bar with a full window
+
+    @property
+    def last_time(self):
+        return self.candles[-1]['time'] if self.candles else None
+
+
+def bar_times(df):
+    """Bar times of a frame with a ``date`` or ``time`` column, in epoch seconds."""
+    time = df['date'] if 'date' in df else df['time']
+    if pd.api.types.is_datetime64_any_dtype(time):
+        time = time.dt.as_unit('s').astype('int64')
+    return time.to_numpy(dtype='int64')
+
+
+def build_series(times, df, sma):
+    """Build the three series in one pass over plain lists taken from the NumPy columns."""
+    t = times.tolist()
+    o, h, l, c = (np.round(df[name].to_numpy(dtype=float), PRICE_DECIMALS).tolist()
+                  for name in ('open', 'high', 'low', 'close'))
+    v = np.nan_to_num(df['volume'].to_numpy(dtype=float)).tolist()
+    s = np.round(sma, PRICE_DECIMALS).tolist()
+    candles, volume, line = [], [], []
+    for i, time in enumerate(t):
+        candles.append({'time': time, 'open': o[i], 'high': h[i], 'low': l[i], 'close': c[i]})
+        volume.append({'time': time, 'value': v[i]})
+        if s[i] == s[i]:
+            line.append({'time': time, 'value': s[i]})
+    return ChartSeries(candles, volume, line)
+
+
+def _precomputed_sma(df, length, bars):
+    column = f'SMA_{length}'
+    return df[column].to_numpy(dtype=float)[-bars:] if column in df else None
+
+
+def _stateless_sma(df, length, bars):
+    # A window only needs the length - 1 closes before the first bar shown
+    closes = df['close'].to_numpy(dtype=float)[-(bars + length - 1):]
+    return sma_indicator(closes, length)[0][-bars:]
+
+
+class ChartCache:
+    """
+    Chart series per key (usually the symbol) and SMA length. Series are
+    reused as long as the last bar is unchanged, so a rerun sends the very
+    same payload. When bars were added only the points from the last
+    cached bar on are built, since that bar may still have been forming.
+    The SMA comes from an IndicatorEngine per chart that is updated with
+    the bars closed since the last run.
+    """
+
+    def __init__(self, bars=CHART_BARS, max_charts=256):
+        self.bars = bars
+        self.max_charts = max_charts
+        self._series = OrderedDict()  # (key, sma_length) -> ChartSeries
+        self._engines = {}  # (key, sma_length) -> (IndicatorEngine, time of its last bar)
+        self._lock = threading.Lock()  # guards _series and _engines
+
+    def __len__(self):
+        return len(self._series)
+
+    def series(self, key, df, sma_length=50):
+        # Streamlit reruns of several sessions share the cache from their own threads
+        with self._lock:
+            return self._build(key, df, sma_length)
+
+    def _build(self, key, df, sma_length):
+        cache_key = (key, sma_length)
+        cached = self._series.get(cache_key)
+        if df.empty:
+            return ChartSeries([], [], [])
+        if cached is not None and cached.candles and self._current(cached, df.tail(1)):
+            self._series.move_to_end(cache_key)
+            return cached
+
+        tail = df.tail(self.bars)
+        times = bar_times(tail)
+        sma = self._sma(cache_key, df, sma_length, len(tail))
+        start = int(np.searchsorted(times, cached.last_time)) if cached is not None and cached.candles else 0
+        if cached is not None and start < len(times) and times[start] == cached.last_time:
+            series = self._extend(cached, build_series(times[start:], tail.iloc[start:], sma[start:]))
+        else:
+            series = build_series(times, tail, sma)
+        self._series[cache_key] = series
+        self._series.move_to_end(cache_key)
+        while len(self._series) > self.max_charts:
+            evicted, _ = self._series.popitem(last=False)
+            self._engines.pop(evicted, None)
+        return series
+
+    def _sma(self, cache_key, df, length, bars):
+        """SMA of the last ``bars`` rows, read from the frame when it was precomputed."""
+        precomputed = _precomputed_sma(df, length, bars)
+        if precomputed is not None:
+            return precomputed
+        times = bar_times(df)
+        columns = [df[name].to_numpy(dtype=float) for name in ('high', 'low', 'close', 'volume')]
+        # Every bar but the last is closed; the last may still be forming, so it is only peeked at
+        closed = len(times) - 1
+        engine, last = self._engines.get(cache_key, (None, None))
+        start = int(np.searchsorted(times[:closed], last, side='right')) if engine is not None else 0
+        if engine is None or not start or times[start - 1] != last:
+            engine = IndicatorEngine(sma=(length,), rsi=0, atr=0, vwap=False)
+            if closed < engine.warmup:
+                self._engines.pop(cache_key, None)
+                return _stateless_sma(df, length, bars)
+            engine.fit(*(c[:closed] for c in columns))
+        else:
+            for i in range(start, closed):
+                engine.update(*(c[i:i + 1] for c in columns))
+        self._engines[cache_key] = (engine, times[closed - 1])
+        forming = engine.peek(*(c[-1:] for c in columns))[f'SMA_{length}']
+        return np.append(engine.column(f'SMA_{length}')[0, -bars:], forming)[-bars:]
+
+    @staticmethod
+    def _current(cached, last):
+        # Same last bar, and that bar has not grown since, as a forming bar does
+        candle = cached.candles[-1]
+        return (candle['time'] == int(bar_times(last)[0])
+                and candle['close'] == round(float(last['close'].iloc[0]), PRICE_DECIMALS)
+                and cached.volume[-1]['value'] == float(np.nan_to_num(last['volume'].iloc[0])))
+
+    def _extend(self, cached, new):
+        first = new.candles[0]['time']
+
+        def merge(old, points):
+            # Cached points from the rebuilt bar on are replaced, then the oldest dropped
+            keep = len(old)
+            while keep and old[keep - 1]['time'] >= first:
+                keep -= 1
+            return old[:keep] + points
+
+        candles = merge(cached.candles, new.candles)[-self.bars:]
+        start = candles[0]['time']
+        return ChartSeries(
+            candles,
+            merge(cached.volume, new.volume)[-self.bars:],
+            [p for p in merge(cached.sma, new.sma) if p['time'] >= start],
+        )
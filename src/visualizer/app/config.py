@@ -1,26 +1,38 @@
-import shelve  
-from typing import Any    
+from typing import Any
 from pydantic import BaseModel
 
+import app.botpath  # noqa: F401
+from settings import settings_store
 
-class PersistentSettings(BaseModel):       
-    def __init__(self, **data: Any):  
-        with shelve.open("config.db") as db:  
-            super().__init__(**db.get("settings", default={}), **data)  
-    def update(self):  
-        with shelve.open("config.db") as db:   
-            db["settings"] = self.dict()  
-
-class BotConfig(PersistentSettings):  
-    MODE: str = "Paper"  
-    def parameter_block(self, st):  
-        self.MODE = str(st.radio(  
-            "Mode",  
-            ["Paper", "Live"],  
-            index=0,  
-        ))  
-    def ib_client_port(self):  
-        if self.MODE == "Paper":  
-            return 4002  
-        elif self.MODE == "Live":  
-            return 4001
\ No newline at end of file
+
+class PersistentSettings(BaseModel):
+    # The store keeps the settings in memory and only rereads the file when
+    # another session or the CLI replaced it, so building one per rerun is cheap
+    def __init__(self, **data: Any):
+        super().__init__(**{**settings_store().load(), **data})
+
+    def update(self):
+        settings_store().update(self.dict())
+
+
+class BotConfig(PersistentSettings):
+    MODE: str = "Paper"
+    PAPER_PORT: int = 4002
+    LIVE_PORT: int = 4001
+
+    def parameter_block(self, st):
+        modes = ["Paper", "Live"]
+        self.MODE = str(st.radio(
+            "Mode",
+            modes,
+            index=modes.index(self.MODE) if self.MODE in modes else 0,
+        ))
+        with st.expander("Gateway ports"):
+            self.PAPER_PORT = int(st.number_input("Paper", value=self.PAPER_PORT, step=1))
+            self.LIVE_PORT = int(st.number_input("Live", value=self.LIVE_PORT, step=1))
+
+    def ib_client_port(self):
+        if self.MODE == "Paper":
+            return self.PAPER_PORT
+        elif self.MODE == "Live":
+            return self.LIVE_PORT
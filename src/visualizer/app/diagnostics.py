@@ -0,0 +1,65 @@
+import json
+import urllib.request
+
+import pandas as pd
+
+import app.botpath  # noqa: F401
+from metrics import METRICS_HOST, METRICS_PORT, command_profiler, histogram_quantile, metrics
+
+# Metrics of the connection service, served by src/bot/connection.py
+SERVICE_METRICS_URL = f'http://{METRICS_HOST}:{METRICS_PORT}/metrics.json'
+
+
+def load_snapshot(url=SERVICE_METRICS_URL, timeout=2.0):
+    """Metrics and profile captures served by another process."""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.load(response)
+
+
+def local_snapshot():
+    """Metrics and profile captures of the dashboard's own connections."""
+    profiler = command_profiler()
+    return {'metrics': metrics().snapshot(), 'profiles': [vars(c) for c in profiler.captures] if profiler else []}
+
+
+def latency_frame(snapshot, name, errors=None):
+    """
+    One row per label of a latency histogram with the error count and the
+    quantiles in ms, estimated from the buckets and capped at the largest.
+    """
+    histogram = snapshot['metrics'][name]
+    failed = {}
+    if errors is not None:
+        # Errors may carry more labels than the histogram, e.g. the exit code
+        for values, count in snapshot['metrics'][errors]['samples']:
+            failed[values[0]] = failed.get(values[0], 0) + count
+    rows = []
+    for values, (counts, total, count, largest) in histogram['samples']:
+        row = dict(zip(histogram['labels'], values))
+        row.update({
+            'count': count,
+            'errors': failed.get(values[0], 0) if values else 0,
+            'mean_ms': total / count * 1000 if count else float('nan'),
+            'p50_ms': min(histogram_quantile(0.5, histogram['buckets'], counts), largest) * 1000,
+            'p95_ms': min(histogram_quantile(0.95, histogram['buckets'], counts), largest) * 1000,
+            'p99_ms': min(histogram_quantile(0.99, histogram['buckets'], counts), largest) * 1000,
+            'max_ms': largest * 1000,
+        })
+        rows.append(row)
+    columns = histogram['labels'] + ['count', 'errors', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    return pd.DataFrame(rows, columns=columns).sort_values('count', ascending=False)
+
+
+def value_frame(snapshot, name):
+    """One row per label of a counter or gauge."""
+    metric = snapshot['metrics'][name]
+    rows = [dict(zip(metric['labels'], values), value=value) for values, value in metric['samples']]
+    return pd.DataFrame(rows, columns=metric['labels'] + ['value'])
+
+
+def total(snapshot, name):
+    """Sum of a counter or gauge over its labels, or the number of observations of a histogram."""
+    metric = snapshot['metrics'][name]
+    if metric['type'] == 'histogram':
+        return sum(value[2] for _, value in metric['samples'])
+    return sum(value for _, value in metric['samples'])
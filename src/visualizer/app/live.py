@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from ib_insync import IB, util
+
+import app.botpath  # noqa: F401
+from connection import IB_HOST, LIVE_CLIENT_ID, ServiceClient
+from contracts import contract_registry
+from market_data import ticker_cache
+from metrics import instrument
+
+# Raw updates kept between two renders; older ones are dropped first
+RING_SIZE = 10_000
+# Price points kept per symbol for the live charts
+CHART_POINTS = 500
+
+
+class LiveFeed:
+    """
+    Streams quotes, portfolio and order updates from a connection running on
+    its own thread and event loop.
+
+    Event handlers only append to a ring buffer. Readers fold the buffer into
+    the latest row per key, each stamped with a version, and ask for the
+    rows that changed since the version they last saw.
+    """
+
+    def __init__(self, port, client_id=None):
+        self.port = port
+        self.client_id = client_id
+        self.ib = instrument(IB())
+        self.loop = asyncio.new_event_loop()
+        self._ring = deque(maxlen=RING_SIZE)
+        self._lock = threading.Lock()
+        self._version = 0
+        self._tables = {'quotes': {}, 'positions': {}, 'orders': {}}
+        self._points = {}
+        self._thread = threading.Thread(target=self._run, name='LiveFeed', daemon=True)
+        self._ready = threading.Event()
+        self._service = None
+        self.error = None
+
+    def start(self, timeout=15):
+        self._thread.start()
+        self._ready.wait(timeout)
+        if self.error:
+            raise self.error
+        return self
+
+    def watch(self, symbols):
+        """Subscribe to quotes for more symbols."""
+        asyncio.run_coroutine_threadsafe(self._subscribe(list(symbols)), self.loop)
+
+    def changes_since(self, version):
+        """
+        Rows changed after ``version`` per table, the new version, and the
+        tick-to-read latency in seconds of every changed row.
+        """
+        self._fold()
+        now = time.monotonic()
+        with self._lock:
+            changes = {
+                name: {key: row for key, (v, _, row) in table.items() if v > version}
+                for name, table in self._tables.items()
+            }
+            latencies = [
+                now - received for table in self._tables.values()
+                for v, received, _ in table.values() if v > version
+            ]
+            return changes, self._version, latencies
+
+    def points(self, symbol):
+        with self._lock:
+            return list(self._points.get(symbol, ()))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._connect())
+        except Exception as e:
+            self.error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _connect(self):
+        client_id = self.client_id
+        if client_id is None:
+            # The lease lasts as long as this service connection stays open
+            self._service = ServiceClient()
+            client_id = self._service.lease_client_id() if self._service.is_running() else LIVE_CLIENT_ID
+        await self.ib.connectAsync(IB_HOST, self.port, clientId=client_id, timeout=10)
+        self.ib.pendingTickersEvent += self._on_tickers
+        self.ib.updatePortfolioEvent += self._on_portfolio
+        self.ib.orderStatusEvent += self._on_order_status
+        for item in self.ib.portfolio():
+            self._on_portfolio(item)
+        await self._subscribe([item.contract.symbol for item in self.ib.portfolio()])
+
+    async def _subscribe(self, symbols):
+        infos = await contract_registry(self.ib).resolve_async(symbols)
+        cache = ticker_cache(self.ib)
+        for info in infos.values():
+            # Streamed for as long as the feed runs, so never given up for lack of lines
+            if not cache.is_held(info.contract):
+                cache.hold(info.contract)
+
+    def _on_tickers(self, tickers):
+        received = time.monotonic()
+        for t in tickers:
+            self._ring.append(('quotes', t.contract.symbol, received, {
+                'symbol': t.contract.symbol, 'bid': t.bid, 'ask': t.ask, 'last': t.last,
+                'volume': t.volume, 'time': t.time.timestamp() if t.time else None,
+            }))
+
+    def _on_portfolio(self, item):
+        self._ring.append(('positions', item.contract.symbol, time.monotonic(), {
+            'symbol': item.contract.symbol, 'position': item.position, 'market_price': item.marketPrice,
+            'market_value': item.marketValue, 'unrealized_pnl': item.unrealizedPNL,
+        }))
+
+    def _on_order_status(self, trade):
+        self._ring.append(('orders', trade.order.orderId, time.monotonic(), {
+            'order_id': trade.order.orderId, 'symbol': trade.contract.symbol, 'action': trade.order.action,
+            'qty': trade.order.totalQuantity, 'type': trade.order.orderType,
+            'status': trade.orderStatus.status, 'filled': trade.orderStatus.filled,
+        }))
+
+    def _fold(self):
+        """Apply buffered updates, keeping only the latest row per key."""
+        with self._lock:
+            while self._ring:
+                table, key, received, row = self._ring.popleft()
+                self._version += 1
+                self._tables[table][key] = (self._version, received, row)
+                if table == 'quotes' and row['time'] and not util.isNan(row['last']):
+                    points = self._points.setdefault(key, deque(maxlen=CHART_POINTS))
+                    if not points or row['time'] >= points[-1]['time'] + 1:
+                        points.append({'time': int(row['time']), 'value': row['last']})
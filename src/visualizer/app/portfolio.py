@@ -0,0 +1,176 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from ib_insync.util import UNSET_DOUBLE
+
+import app.botpath  # noqa: F401
+from account import account_state
+from bars import bar_store, duration_seconds, to_frame
+from contracts import contract_registry
+from fanout import combine_positions
+from orderbook import order_book
+
+ORDER_COLUMNS = ['symbol', 'name', 'action', 'qty', 'type', 'stop_price', 'avg_cost',
+                 'dist_avg_cost', 'dist_market_price']
+
+
+class StageTimer:
+    """Collects how long each stage of a page load takes."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def summary(self):
+        parts = [f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.stages.items()]
+        return f"Loaded in {self.total * 1000:.0f} ms ({', '.join(parts)})"
+
+
+PORTFOLIO_COLUMNS = ['contract', 'symbol', 'name', 'position', 'avg_cost', 'market_price', 'market_value',
+                     'perc_change', 'unrealized_pnl', 'realized_pnl']
+
+
+def portfolio_frame(positions, infos):
+    """Add names and % change to a positions frame such as ``AccountState.to_frame()``."""
+    df = positions.copy()
+    names = [infos.get(str(contract.conId)) for contract in df['contract']]
+    df['name'] = [cds.longName if cds else symbol for cds, symbol in zip(names, df['symbol'])]
+    ratio = df['market_price'] / df['avg_cost']
+    df['perc_change'] = (ratio.where(df['position'] >= 0, 1 / ratio) - 1) * 100
+    return df[PORTFOLIO_COLUMNS]
+
+
+def portfolio_items(portfolio, infos):
+    positions = pd.DataFrame({
+        'contract': [item.contract for item in portfolio],
+        'symbol': [item.contract.symbol for item in portfolio],
+        'position': [item.position for item in portfolio],
+        'avg_cost': [item.averageCost for item in portfolio],
+        'market_price': [item.marketPrice for item in portfolio],
+        'market_value': [item.marketValue for item in portfolio],
+        'unrealized_pnl': [item.unrealizedPNL for item in portfolio],
+        'realized_pnl': [item.realizedPNL for item in portfolio],
+    })
+    return portfolio_frame(positions, infos)
+
+
+def active_orders(trades, portfolio_df):
+    def create_order_item(item):
+        if item.order.orderType == 'STP':
+            return {
+                'symbol': item.contract.symbol,
+                'action': item.order.action,
+                'qty': item.order.totalQuantity,
+                'type': 'StopLoss',
+                'stop_price': item.order.auxPrice,
+            }
+        if item.order.orderType == 'TRAIL':
+            # IB reports where the trailing stop currently is; unset until it has been computed
+            stop_price = item.order.trailStopPrice
+            return {
+                'symbol': item.contract.symbol,
+                'action': item.order.action,
+                'qty': item.order.totalQuantity,
+                'type': 'TrailingStop',
+                'stop_price': stop_price if 0 < stop_price < UNSET_DOUBLE else float('nan'),
+            }
+        if item.order.orderType == 'MKT':
+            return {
+                'symbol': item.contract.symbol,
+                'action': item.order.action,
+                'qty': item.order.totalQuantity,
+                'type': 'Market'
+            }
+
+    items_dicts = [d for d in (create_order_item(item) for item in trades) if d]
+    if not items_dicts or portfolio_df.empty:
+        return pd.DataFrame(columns=ORDER_COLUMNS)
+    df = pd.DataFrame.from_records(items_dicts)
+    if 'stop_price' not in df:
+        df['stop_price'] = float('nan')
+    orders_df = pd.merge(df, portfolio_df, on=['symbol'])
+    orders_df['dist_avg_cost'] = (orders_df['stop_price'] / orders_df['avg_cost'] - 1) * 100
+    orders_df['dist_market_price'] = (orders_df['stop_price'] / orders_df['market_price'] - 1) * 100
+    orders_df = orders_df.loc[:, ORDER_COLUMNS]
+    orders_df = orders_df.sort_values(by=['symbol'])
+    return orders_df
+
+
+async def load_positions_async(ib):
+    """
+    Positions with their contract details and the open orders, fetched
+    concurrently: contract details for all positions go out in one batch.
+    """
+    positions = account_state(ib).to_frame()
+    infos, trades = await asyncio.gather(
+        contract_registry(ib).resolve_async(list(positions['contract'])),
+        order_book(ib).refresh_async()
+    )
+    portfolio_df = portfolio_frame(positions, infos)
+    return portfolio_df, active_orders(trades, portfolio_df)
+
+
+async def load_combined_positions_async(fan):
+    """
+    Positions of every gateway merged per symbol, with the open orders of
+    all of them. Gateways that are down or slow are left out.
+    """
+    await fan.connect_async()
+    connected = fan.connected()
+    if not connected:
+        raise ConnectionRefusedError("No gateway is connected.")
+    positions = combine_positions(fan.positions_frame())
+    # Contract details are the same on every gateway, so one resolves them for all
+    ib = next(iter(connected.values()))
+    infos, books = await asyncio.gather(
+        contract_registry(ib).resolve_async(list(positions['contract'])),
+        fan.gather(lambda name, ib: order_book(ib).refresh_async())
+    )
+    portfolio_df = portfolio_frame(positions, infos)
+    trades = [trade for trades in books.results.values() for trade in trades]
+    return portfolio_df, active_orders(trades, portfolio_df)
+
+
+async def load_histories_async(ib, symbols, duration='5 Y', bar_size='1 day'):
+    """Historical bars for all symbols, fetched concurrently from the bar store."""
+    store = bar_store()
+    results = await asyncio.gather(
+        *(store.ensure_async(ib, symbol, duration, bar_size, what_to_show='TRADES') for symbol in symbols),
+        return_exceptions=True
+    )
+    histories = {}
+    for symbol, bars in zip(symbols, results):
+        if isinstance(bars, Exception):
+            print(f"Error fetching historical data for {symbol}: {bars}")
+            continue
+        histories[symbol] = to_frame(bars)
+    return histories
+
+
+def load_positions_from_service(client):
+    """Same as ``load_positions_async``, served by the connection service."""
+    portfolio = client.portfolio()
+    infos = client.contracts([item.contract for item in portfolio])
+    portfolio_df = portfolio_items(portfolio, infos)
+    return portfolio_df, active_orders(client.open_trades(), portfolio_df)
+
+
+def load_histories_from_service(client, symbols, duration='5 Y', bar_size='1 day'):
+    """Have the connection service fill the shared bar store, then read it locally."""
+    client.history(symbols, duration, bar_size, what_to_show='TRADES')
+    start = time.time() - duration_seconds(duration)
+    store = bar_store()
+    return {symbol: to_frame(store.read(symbol, bar_size, 'TRADES', start=start)) for symbol in symbols}
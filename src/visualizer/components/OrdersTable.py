@@ -4,7 +4,7 @@ import pandas as pd
 class OrdersTable:    
     @staticmethod  
     def show_table(st, df):  
-        orders_df = df.style. \  
+        orders_df = df.style. \
             format(precision=2, thousands='.', decimal=',')  
         st.dataframe(orders_df, column_config={  
             'symbol': 'Symbol',  
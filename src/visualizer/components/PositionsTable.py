@@ -8,9 +8,9 @@ class PositionsTable:
         def highlight_up(val):
             color = 'green' if val > 0 else 'red'
             return f'background-color: {color}'
-        portfolio_df = df.style
-        format(precision=2, thousands='.', decimal=',')
-        map(highlight_up, subset=['perc_change'])
+        portfolio_df = df.style. \
+            format(precision=2, thousands='.', decimal=','). \
+            map(highlight_up, subset=['perc_change'])
         st.dataframe(portfolio_df, column_config={
             'contract': None,
             'symbol': 'Symbol',
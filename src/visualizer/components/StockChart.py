@@ -1,23 +1,24 @@
-import json
+import streamlit as st
 from streamlit_lightweight_charts import renderLightweightCharts
-import pandas_ta as ta
+from app.charts import ChartCache
+
+@st.cache_resource
+def chart_cache():
+    # Shared by every session, so a chart already built for one is reused by all
+    return ChartCache()
 
 class StockChart:
 
     @staticmethod
-    def show_chart(df, symbol):
+    def show_chart(df, symbol, sma_length=50, key=None):
         COLOR_BULL = 'rgba(38,166,154,0.9)'  # #26a69a
         COLOR_BEAR = 'rgba(239,83,80,0.9)'  # #ef5350 
 
-        df.rename(columns={'date': 'time'}, inplace=True)
-        df['time'] = df['time'].astype('str')
-        df.ta.sma(close='close', length=50, append=True)
-
-        df = df.tail(200)
-
-        candles = json.loads(df.to_json(orient='records'))
-        volume = json.loads(df.rename(columns={'volume': 'value', }).to_json(orient='records'))
-        sma = json.loads(df.rename(columns={'SMA_50': 'value', }).to_json(orient='records'))
+        # Series of the last 200 bars, rebuilt only from the bars added since the last run.
+        # An unchanged chart reuses the data built for the previous run as is.
+        # ``key`` tells apart frames of one symbol with different bars, e.g. bar sizes.
+        series = chart_cache().series(key or symbol, df, sma_length)
+        candles, volume, sma = series.candles, series.volume, series.sma
 
         chartMultipaneOptions = [
             {
@@ -91,9 +92,20 @@ class StockChart:
             }
         ]
 
+        seriesSmaChart = [
+            {
+                "type": 'Line',
+                "data": sma,
+                "options": {
+                    "color": 'orange',
+                    "lineWidth": 1
+                }
+            }
+        ]
+
         renderLightweightCharts([
             {
                 "chart": chartMultipaneOptions[0],
-                "series": seriesCandlestickChart + seriesVolumeChart
+                "series": seriesCandlestickChart + seriesSmaChart + seriesVolumeChart
             }
         ], f'multipane{symbol}')
\ No newline at end of file
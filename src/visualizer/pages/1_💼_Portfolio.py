@@ -1,164 +1,150 @@
 import asyncio
+import threading
 import streamlit as st
 from components.PositionsTable import PositionsTable
 from components.PositionsChart import PositionsChart
+from components.OrdersTable import OrdersTable
 from components.StockChart import StockChart
-import yfinance as yf
-import pandas as pd
+from app.config import BotConfig
+from app.portfolio import (StageTimer, load_combined_positions_async, load_histories_async,
+                           load_histories_from_service, load_positions_async, load_positions_from_service)
 
 st.set_page_config(
     layout="wide",
     page_title="My Dashboard"
 )
 
-# Create or get the event loop
-def get_or_create_eventloop():
-    try:
-        return asyncio.get_event_loop()
-    except RuntimeError as ex:
-        if "There is no current event loop in thread" in str(ex):
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            return loop
-
-# Ensure event loop is created before using ib_insync
-loop = get_or_create_eventloop()
-asyncio.set_event_loop(loop)
-
-# Initialize IB instance.
-# Using ib_insync with Streamlit presents challenges because ib_insync relies on an asynchronous event loop, 
-# which conflicts with Streamlit's synchronous execution model. to combat this, we run an event loop at the 
-# beginning of the page before importing the ib_insync library
-from ib_insync import IB, Stock, util
-ib = IB()
-
-# Ensure IB is connected
-if not ib.isConnected():
+# How long loaded data is reused between reruns, in seconds
+POSITIONS_TTL = 10
+HISTORY_TTL = 15 * 60
+
+# Using ib_insync with Streamlit presents challenges because ib_insync relies on an asynchronous event loop,
+# which conflicts with Streamlit's synchronous execution model. The connection service (src/bot/connection.py)
+# avoids this by holding the IB session in its own process. Without it, the page keeps a connection and its own
+# event loop in st.cache_resource; a lock keeps two sessions from running the loop at once.
+# With more than one gateway in gateways.json the page holds a fan-out to all of them and shows them combined.
+from ib_insync import IB
+import app.botpath  # noqa: F401
+from connection import IB_HOST, ServiceClient, configured_client_id
+from fanout import FanOut, load_gateways
+from metrics import instrument
+
+class IBSession:
+    def __init__(self, ib, loop):
+        self.ib = ib
+        self.loop = loop
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        with self.lock:
+            asyncio.set_event_loop(self.loop)
+            return self.loop.run_until_complete(coro)
+
+    def is_connected(self):
+        return self.ib.is_connected() if isinstance(self.ib, FanOut) else self.ib.isConnected()
+
+    def history_ib(self):
+        return next(iter(self.ib.connected().values())) if isinstance(self.ib, FanOut) else self.ib
+
+@st.cache_resource
+def data_source():
+    gateways = load_gateways()
+    if len(gateways) > 1:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        session = IBSession(FanOut(gateways, factory=lambda gateway: instrument(IB())), loop)
+        if not session.run(session.ib.connect_async()).results:
+            raise ConnectionRefusedError("No gateway is connected.")
+        return session
+
+    service = ServiceClient()
+    if service.is_running():
+        return service
+    service.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ib = instrument(IB())
+    ib.connect(
+        IB_HOST,                           # IB Gateway or TWS IP address
+        BotConfig().ib_client_port(),      # Port for live trading or paper trading
+        clientId=configured_client_id('DASHBOARD'),  # Unique client ID, DASHBOARD_CLIENT_ID in the settings
+        timeout=5
+    )
+    return IBSession(ib, loop)
+
+@st.cache_data(ttl=POSITIONS_TTL, show_spinner=False)
+def load_positions(_source):
+    if isinstance(_source, ServiceClient):
+        return load_positions_from_service(_source)
+    if isinstance(_source.ib, FanOut):
+        return _source.run(load_combined_positions_async(_source.ib))
+    return _source.run(load_positions_async(_source.ib))
+
+@st.cache_data(ttl=HISTORY_TTL, show_spinner=False)
+def load_histories(_source, symbols):
+    if isinstance(_source, ServiceClient):
+        return load_histories_from_service(_source, list(symbols))
+    return _source.run(load_histories_async(_source.history_ib(), list(symbols)))
+
+def connect():
     try:
-        ib.connect(
-            "127.0.0.1",  # IB Gateway or TWS IP address
-            4001,         # Port for live trading or paper trading
-            clientId=1,   # Unique client ID
-            timeout=5
-        )
+        source = data_source()
+        if isinstance(source, IBSession) and not source.is_connected():
+            data_source.clear()
+            source = data_source()
+        return source
     except ConnectionRefusedError:
         st.info("Open IB Gateway and log in.")
         if st.button("Press here after done"):
-            st.stop()
-    except RuntimeError:
-        loop = get_or_create_eventloop()
-        asyncio.set_event_loop(loop)
+            st.rerun()
+        st.stop()
     except TimeoutError:
         st.warning("Connection timed out. Please retry.")
+        st.stop()
 
-def portfolio_items(ib):  
-    def create_portfolio_item(item):  
-        cds = ib.reqContractDetails(item.contract)[0]  
-        perc_change = (item.marketPrice / item.averageCost - 1) * 100  
-        if item.position < 0:  
-            perc_change = (item.averageCost / item.marketPrice - 1) * 100  
-
-        return {
-            'contract': item.contract,
-            'symbol': item.contract.symbol,
-            'name': cds.longName,
-            'position': item.position,
-            'avg_cost': item.averageCost,
-            'market_price': item.marketPrice,
-            'market_value': item.marketValue,
-            'perc_change': perc_change,
-            'unrealized_pnl': item.unrealizedPNL,
-            'realized_pnl': item.realizedPNL
-        }
-    
-    _portfolio_items = ib.portfolio()
-    items_dicts = [create_portfolio_item(item) for item in _portfolio_items]
-    df = pd.DataFrame.from_records(items_dicts)
-    return df
-
-# Fetch historical data for a symbol from IB or fallback to Yahoo Finance if no subscription
-def fetch_historical_data(ib, symbol, exchange, duration='5 Y', bar_size='1 day'):
+def load(loader, *args):
+    # The connection service may stop between reruns; the page then connects on its own
+    global source
     try:
-        contract = Stock(symbol=symbol, exchange=exchange)
-        bars = ib.reqHistoricalData(
-            contract,
-            endDateTime='',
-            durationStr=duration,
-            barSizeSetting=bar_size,
-            whatToShow='TRADES',
-            useRTH=True,
-            formatDate=1
-        )
-        
-        bars_df = pd.DataFrame(util.df(bars))
-        if not bars_df.empty:
-            return bars_df
-    except Exception as e:
-        print(f"Error fetching data from IB for {symbol}: {e}")
-    
-    # Fallback to Yahoo Finance
-    print(f"Falling back to Yahoo Finance for {symbol}.")
-    ticker = yf.Ticker(symbol)
-    df = ticker.history(period=duration)
-    df = df.reset_index()
-    df.rename(columns={
-        'Date': 'date', 'Open': 'open', 'High': 'high',
-        'Low': 'low', 'Close': 'close', 'Volume': 'volume'
-    }, inplace=True)
-    return df
-
-def active_orders(ib, portfolio_df):  
-    def create_order_item(item):  
-        if item.order.orderType == 'STP':  
-            return {  
-                'symbol': item.contract.symbol,  
-                'action': item.order.action,  
-                'qty': item.order.totalQuantity,  
-                'type': 'StopLoss',  
-                'stop_price': item.order.trailStopPrice,  
-            }  
-
-    if item.order.orderType == 'MKT':  
-            return {  
-                'symbol': item.contract.symbol,  
-                'action': item.order.action,  
-                'qty': item.order.totalQuantity,  
-                'type': 'Market'  
-            }  
-    _opened_orders = ib.reqAllOpenOrders()  
-    items_dicts = [create_order_item(item) for item in _opened_orders]  
-    df = pd.DataFrame.from_records(items_dicts)  
-    orders_df = pd.merge(df, portfolio_df, on=['symbol'])  
-    orders_df['dist_avg_cost'] = (orders_df['stop_price'] / orders_df['avg_cost'] - 1) * 100  
-    orders_df['dist_market_price'] = (orders_df['stop_price'] / orders_df['market_price'] - 1) * 100  
-    orders_df = orders_df.loc[:, ['symbol', 'name', 'action', 'qty', 'type', 'stop_price', 'avg_cost',  
-                                  'dist_avg_cost', 'dist_market_price']]  
-    orders_df = orders_df.sort_values(by=['symbol'])  
-    return orders_df
+        return loader(source, *args)
+    except OSError as e:
+        if not isinstance(source, ServiceClient):
+            raise
+        source.close()
+        data_source.clear()
+        st.info(f"The connection service is unavailable ({e}); connecting to IB Gateway directly.")
+        source = connect()
+        return loader(source, *args)
+
+timer = StageTimer()
 
+# Ensure IB is connected
+with timer.stage("connect"):
+    source = connect()
 
 with st.container():
     col1, col2 = st.columns([5, 3])
 
-    portfolio_df = portfolio_items(ib)
-
-    PositionsTable.show_table(col1, portfolio_df)
-    PositionsChart.show_chart(col2, portfolio_df)
-
-    # display open orders
-    col1.subheader("Opened orders")
-    orders_df = active_orders(ib, portfolio_df)
-    OrdersTable.show_table(col1, orders_df)
-    
-    for index, row in portfolio_df.iterrows():
-        contract = row['contract']
-        symbol = contract.symbol
-        stop_losses = orders_df.loc[(orders_df['type'] == 'StopLoss') & (orders_df['symbol'] == symbol)]['stop_price'].tolist()
-        
-        # Fetch historical data for each symbol
-        # historical_df = fetch_historical_data(ib, symbol, exchange)
-        # if not historical_df.empty:
-        #     st.write(f"Historical data for {symbol}:")
-        #     st.dataframe(historical_df.head())
-
-        StockChart.show_chart(col2, symbol)
\ No newline at end of file
+    with timer.stage("positions"):
+        portfolio_df, orders_df = load(load_positions)
+        if isinstance(source, IBSession) and isinstance(source.ib, FanOut):
+            balances = source.ib.balances()
+            col1.caption("Net liquidation: " + " · ".join(f"{name} {value:,.2f}" for name, value in balances.items()))
+
+    with timer.stage("history"):
+        histories = load(load_histories, tuple(portfolio_df['symbol']) if not portfolio_df.empty else ())
+
+    with timer.stage("render"):
+        PositionsTable.show_table(col1, portfolio_df)
+        PositionsChart.show_chart(col2, portfolio_df)
+
+        # display open orders
+        col1.subheader("Opened orders")
+        OrdersTable.show_table(col1, orders_df)
+
+        for symbol, historical_df in histories.items():
+            if not historical_df.empty:
+                StockChart.show_chart(historical_df, symbol)
+
+st.caption(timer.summary())
@@ -0,0 +1,65 @@
+import statistics
+import time
+import pandas as pd
+import streamlit as st
+from streamlit_lightweight_charts import renderLightweightCharts
+from app.config import BotConfig
+from app.live import LiveFeed
+
+st.set_page_config(
+    layout="wide",
+    page_title="Live"
+)
+
+# Updates are pushed into this page by a background feed; only the fragment below
+# reruns, at most MAX_FPS times per second, instead of the whole script.
+MAX_FPS = 10
+
+@st.cache_resource
+def live_feed(port):
+    return LiveFeed(port).start()
+
+try:
+    feed = live_feed(BotConfig().ib_client_port())
+except (ConnectionRefusedError, TimeoutError) as e:
+    st.info(f"Open IB Gateway and log in. ({e!r})")
+    st.stop()
+
+fps = st.sidebar.slider("Refresh rate (frames/s)", 1, MAX_FPS, 4)
+extra = st.sidebar.text_input("Watch symbols", placeholder="AAPL, MSFT")
+if extra:
+    feed.watch(s.strip().upper() for s in extra.split(',') if s.strip())
+
+if 'live' not in st.session_state:
+    st.session_state.live = {'version': 0, 'quotes': {}, 'positions': {}, 'orders': {}}
+
+@st.fragment(run_every=1 / fps)
+def live_view():
+    state = st.session_state.live
+    start = time.perf_counter()
+    changes, state['version'], latencies = feed.changes_since(state['version'])
+    for name, rows in changes.items():
+        state[name].update(rows)
+
+    col1, col2 = st.columns([5, 3])
+    col1.subheader("Positions")
+    col1.dataframe(pd.DataFrame(state['positions'].values()), hide_index=True)
+    col1.subheader("Orders")
+    col1.dataframe(pd.DataFrame(state['orders'].values()), hide_index=True)
+    col2.subheader("Quotes")
+    col2.dataframe(pd.DataFrame(state['quotes'].values()), hide_index=True)
+
+    symbols = sorted(state['quotes'])
+    if symbols:
+        symbol = col2.selectbox("Chart", symbols)
+        renderLightweightCharts([{
+            "chart": {"height": 300, "layout": {"background": {"type": "solid", "color": 'black'}, "textColor": "white"}},
+            "series": [{"type": 'Line', "data": feed.points(symbol)}]
+        }], f'live{symbol}')
+
+    updated = sum(len(rows) for rows in changes.values())
+    latency = f"tick-to-screen p50 {statistics.median(latencies) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms" \
+        if latencies else "no new ticks"
+    st.caption(f"{updated} rows updated, {latency}, frame built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+live_view()
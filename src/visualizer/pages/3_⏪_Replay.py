@@ -0,0 +1,45 @@
+import time
+import streamlit as st
+from components.StockChart import StockChart
+import app.botpath  # noqa: F401
+from bars import to_frame
+from recorder import RECORD_DIR, Recording
+
+st.set_page_config(
+    layout="wide",
+    page_title="Replay"
+)
+
+# Bars recorded by src/bot/recorder.py are replayed into the chart; the fragment below
+# advances a replay clock by the elapsed wall time times the chosen speed.
+FPS = 4
+BAR_SIZES = {'5 secs': 5, '1 min': 60, '5 mins': 300}
+CHART_BARS = 250
+
+recording = Recording(RECORD_DIR)
+span = recording.span('bars')
+symbols = recording.symbols()
+if span is None or not symbols:
+    st.info("Nothing recorded yet. Start one with: python src/bot/recorder.py AAPL MSFT ...")
+    st.stop()
+
+symbol = st.sidebar.selectbox("Symbol", symbols)
+bar_size = BAR_SIZES[st.sidebar.selectbox("Bar size", list(BAR_SIZES), index=1)]
+speed = st.sidebar.select_slider("Speed", [1, 2, 5, 10, 30, 60, 300, 1200], value=60)
+if st.sidebar.button("Restart") or st.session_state.get('replay', {}).get('key') != (symbol, speed):
+    st.session_state.replay = {'key': (symbol, speed), 'wall_start': time.monotonic()}
+
+@st.fragment(run_every=1 / FPS)
+def replay_view():
+    state = st.session_state.replay
+    clock = min(span[0] + (time.monotonic() - state['wall_start']) * speed, span[1])
+    # Only the window shown in the chart is read from the log
+    bars = recording.bars(symbol, start=clock - CHART_BARS * bar_size, end=clock, bar_size=bar_size)
+    st.caption(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(clock))} UTC, {speed}x"
+               + (" (end of recording)" if clock >= span[1] else ""))
+    if len(bars):
+        StockChart.show_chart(to_frame(bars), symbol, key=(symbol, bar_size))
+    else:
+        st.write(f"No bars for {symbol} yet at this point of the recording.")
+
+replay_view()
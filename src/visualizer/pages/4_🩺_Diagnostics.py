@@ -0,0 +1,49 @@
+import pandas as pd
+import streamlit as st
+from app.diagnostics import SERVICE_METRICS_URL, latency_frame, load_snapshot, local_snapshot, total, value_frame
+
+st.set_page_config(
+    layout="wide",
+    page_title="Diagnostics"
+)
+
+# Latency and errors of the broker calls and CLI commands, recorded by src/bot/metrics.py.
+# The connection service serves its metrics over HTTP; the dashboard's own connections are read in process.
+SOURCES = {"Connection service": SERVICE_METRICS_URL, "This dashboard": None}
+
+source = st.sidebar.selectbox("Source", list(SOURCES))
+url = st.sidebar.text_input("Metrics URL", SOURCES[source]) if SOURCES[source] else None
+refresh = st.sidebar.slider("Refresh every (s)", 1, 30, 5)
+
+@st.fragment(run_every=refresh)
+def diagnostics_view():
+    try:
+        snapshot = load_snapshot(url) if url else local_snapshot()
+    except OSError as e:
+        st.info(f"No metrics at {url}. Start the connection service: python src/bot/connection.py ({e!r})")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("IB calls", total(snapshot, 'ib_request_seconds'))
+    col2.metric("In flight", int(total(snapshot, 'ib_requests_in_flight')))
+    col3.metric("Pacing violations", int(total(snapshot, 'ib_pacing_violations_total')))
+    col4.metric("Failed commands", int(total(snapshot, 'cli_command_errors_total')))
+
+    st.subheader("Broker calls")
+    st.dataframe(latency_frame(snapshot, 'ib_request_seconds', 'ib_request_errors_total'), hide_index=True)
+    st.subheader("Commands")
+    st.dataframe(latency_frame(snapshot, 'cli_command_seconds', 'cli_command_errors_total'), hide_index=True)
+
+    col1, col2 = st.columns(2)
+    col1.subheader("IB errors by code")
+    col1.dataframe(value_frame(snapshot, 'ib_errors_total'), hide_index=True)
+    col2.subheader("Requests in flight")
+    col2.dataframe(value_frame(snapshot, 'ib_requests_in_flight'), hide_index=True)
+
+    st.subheader("Profiles of slow commands")
+    if snapshot['profiles']:
+        st.dataframe(pd.DataFrame(snapshot['profiles']), hide_index=True)
+    else:
+        st.caption("None yet. Start the CLI or the connection service with --profile-slow SECONDS to capture some.")
+
+diagnostics_view()
@@ -0,0 +1,44 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The bot's modules import each other as top-level modules; the dashboard's are under app
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'bot'))
+sys.path.insert(1, str(Path(__file__).resolve().parents[1] / 'src' / 'visualizer'))
+
+import bars  # noqa: E402
+import contracts  # noqa: E402
+import settings  # noqa: E402
+from simulator import SimConfig, SimIB  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def settings_store(tmp_path, monkeypatch):
+    """Every test gets its own settings file instead of the dashboard's."""
+    store = settings.SettingsStore(tmp_path / 'settings.json', legacy=None)
+    monkeypatch.setattr(settings, '_store', store)
+    return store
+
+
+@pytest.fixture(autouse=True)
+def bar_store(tmp_path):
+    store = bars.set_bar_store(bars.BarStore(tmp_path / 'bars'))
+    yield store
+    bars.set_bar_store(None)
+
+
+@pytest.fixture
+def sim_config():
+    """Override in a module, or parametrize indirectly, to change the simulated gateway."""
+    return SimConfig(latency=0.005, tick_interval=0.05)
+
+
+@pytest.fixture
+def ib(sim_config, tmp_path):
+    """A SimIB connected to a fresh simulated gateway, with its own contract cache."""
+    ib = SimIB(config=sim_config)
+    ib.connect('127.0.0.1', 4002, clientId=1)
+    contracts.set_contract_registry(ib, contracts.ContractRegistry(ib, path=tmp_path / 'contracts.json'))
+    yield ib
+    ib.disconnect()
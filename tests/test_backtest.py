@@ -0,0 +1,38 @@
+import numpy as np
+
+from backtest import BacktestResult, Panel, param_grid, sweep
+from bars import BAR_DTYPE
+
+
+def daily_bars(n, seed):
+    rng = np.random.default_rng(seed)
+    bars = np.zeros(n, dtype=BAR_DTYPE)
+    bars['time'] = np.arange(n) * 86400
+    bars['close'] = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+    bars['open'] = np.roll(bars['close'], 1)
+    bars['open'][0] = bars['close'][0]
+    bars['high'] = np.maximum(bars['open'], bars['close']) * 1.01
+    bars['low'] = np.minimum(bars['open'], bars['close']) * 0.99
+    return bars
+
+
+def test_sweep_skips_bars_without_an_open():
+    broken = daily_bars(200, 1)
+    broken['open'][50:60] = 0.0
+    broken['open'][80] = np.nan
+    panel = Panel.from_bars({'AAPL': daily_bars(200, 0), 'MSFT': broken})
+    grid = param_grid(np.arange(2, 12, 2), [20, 30], [0.02, 0.05], [1.0])
+
+    serial = sweep(panel, grid, workers=1, chunk_size=8)
+    assert np.isfinite(serial.metrics['pnl']).all() and serial.metrics['trades'].sum()
+    # Spawned workers give the same results
+    parallel = sweep(panel, grid, workers=2, chunk_size=8)
+    for name, values in serial.metrics.items():
+        np.testing.assert_array_equal(parallel.metrics[name], values)
+
+
+def test_report_of_an_instant_sweep():
+    panel = Panel.from_bars({'AAPL': daily_bars(60, 0)})
+    result = sweep(panel, param_grid([5], [20], [0.05], [1.0]), workers=1)
+    instant = BacktestResult(result.symbols, result.params, result.metrics, elapsed=0.0)
+    assert "1 parameter combinations over 1 symbols in 0.00s" in instant.report()
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import bars
+from bars import BAR_DTYPE, BarStore, BarsUnavailable, duration_seconds
+
+
+def bar_array(times, close=1.0):
+    array = np.zeros(len(times), dtype=BAR_DTYPE)
+    array['time'] = times
+    array['close'] = close
+    return array
+
+
+@pytest.fixture
+def fetches(bar_store, monkeypatch):
+    """The (start, end) of every range the store asks for."""
+    calls = []
+    fetch = bar_store._fetch
+
+    async def recording(ib, symbol, start, end, *args):
+        calls.append((start, end))
+        return await fetch(ib, symbol, start, end, *args)
+    monkeypatch.setattr(bar_store, '_fetch', recording)
+    return calls
+
+
+def test_write_merges_and_newer_bars_win(tmp_path):
+    store = BarStore(tmp_path)
+    store.write('AAPL', '1 day', 'TRADES', bar_array([100, 200, 300]))
+    store.write('AAPL', '1 day', 'TRADES', bar_array([400]))
+    store.write('AAPL', '1 day', 'TRADES', bar_array([50, 200], close=2.0))
+    stored = store.read('AAPL')
+    assert stored['time'].tolist() == [50, 100, 200, 300, 400]
+    assert stored['close'].tolist() == [2.0, 1.0, 2.0, 1.0, 1.0]
+    assert store.read('AAPL', start=100, end=300)['time'].tolist() == [100, 200]
+
+
+def test_ensure_fetches_only_the_missing_part(ib, bar_store, fetches):
+    # A week always holds trading days of the simulated exchange
+    first = bar_store.ensure(ib, 'AAPL', '7 D', '1 hour')
+    assert len(first) and len(fetches) == 1
+    start, end = bar_store.coverage('AAPL', '1 hour', 'TRADES')
+    assert end - start == duration_seconds('7 D')
+
+    second = bar_store.ensure(ib, 'AAPL', '14 D', '1 hour')
+    assert len(fetches) == 2
+    assert fetches[1] == (pytest.approx(time.time() - duration_seconds('14 D'), abs=60), start)
+    assert len(second) > len(first)
+    assert np.all(np.diff(second['time']) > 0)
+    assert bar_store.coverage('AAPL', '1 hour', 'TRADES')[0] < start
+
+    # Everything is stored now, so a shorter window is answered from disk
+    third = bar_store.ensure(ib, 'AAPL', '7 D', '1 hour')
+    assert len(fetches) == 2
+    assert third['time'].tolist() == first['time'].tolist()
+
+
+def test_empty_result_records_no_coverage(ib, bar_store, fetches, monkeypatch):
+    monkeypatch.setattr(bars, 'fetch_yfinance', lambda *args: np.empty(0, dtype=BAR_DTYPE))
+    # Unknown to the simulated gateway, and Yahoo Finance returns nothing
+    ib.gateway.config.symbols = ('AAPL',)
+    with pytest.raises(BarsUnavailable, match='NOPE'):
+        bar_store.ensure(ib, 'NOPE', '7 D', '1 hour')
+    assert bar_store.coverage('NOPE', '1 hour', 'TRADES') is None
+
+    # The window is asked for again rather than being taken as covered
+    with pytest.raises(BarsUnavailable):
+        bar_store.ensure(ib, 'NOPE', '7 D', '1 hour')
+    assert len(fetches) == 2
+
+
+def test_concurrent_writers_keep_every_bar(tmp_path):
+    # Separate stores of one directory, like the CLI, the connection service and the dashboard
+    def writer():
+        store = BarStore(tmp_path)
+        for start in range(0, 400, 20):
+            # Overlapping ranges, so most writes merge rather than append
+            store.write('AAPL', '1 min', 'TRADES', bar_array(np.arange(start, start + 40) * 60))
+
+    threads = [threading.Thread(target=writer) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stored = BarStore(tmp_path).read('AAPL', '1 min')
+    assert stored['time'].tolist() == (np.arange(0, 420) * 60).tolist()
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_read_ignores_a_partly_appended_bar(tmp_path):
+    store = BarStore(tmp_path)
+    store.write('AAPL', '1 day', 'TRADES', bar_array([100, 200]))
+    with open(store._path('AAPL', '1 day', 'TRADES'), 'ab') as f:
+        f.write(bar_array([300]).tobytes()[:10])
+    assert store.read('AAPL')['time'].tolist() == [100, 200]
@@ -0,0 +1,74 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from app.charts import ChartCache
+from indicators import sma
+
+
+def frame(bars=300, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, bars)))
+    return pd.DataFrame({
+        'time': np.arange(bars, dtype='int64') * 60 + 1_700_000_000,
+        'open': close, 'high': close * 1.01, 'low': close * 0.99, 'close': close,
+        'volume': rng.integers(100, 1000, bars).astype(float),
+    })
+
+
+def sma_points(series):
+    return [(p['time'], p['value']) for p in series.sma]
+
+
+def expected_sma(df, length, bars):
+    times, values = df['time'].to_numpy()[-bars:], np.round(sma(df['close'], length)[0][-bars:], 4)
+    return [(int(t), float(v)) for t, v in zip(times, values) if v == v]
+
+
+def test_sma_follows_new_and_forming_bars():
+    df = frame()
+    cache = ChartCache(bars=100)
+    assert sma_points(cache.series('AAPL', df.iloc[:150], 20)) == expected_sma(df.iloc[:150], 20, 100)
+    engine = cache._engines[('AAPL', 20)][0]
+
+    # The last bar grows, then more bars close: the engine is updated, not fitted again
+    forming = df.iloc[:151].copy()
+    forming.loc[150, 'close'] *= 0.98
+    assert sma_points(cache.series('AAPL', forming, 20)) == expected_sma(forming, 20, 100)
+    for end in (152, 160, 300):
+        assert sma_points(cache.series('AAPL', df.iloc[:end], 20)) == expected_sma(df.iloc[:end], 20, 100)
+    assert cache._engines[('AAPL', 20)][0] is engine
+    assert engine.length == 299
+
+
+def test_precomputed_sma_column_is_used():
+    df = frame(bars=50)
+    df['SMA_20'] = 1.0
+    assert {p['value'] for p in ChartCache().series('AAPL', df, 20).sma} == {1.0}
+
+
+def test_short_history_falls_back_to_the_stateless_sma():
+    df = frame(bars=10)
+    assert sma_points(ChartCache().series('AAPL', df, 5)) == expected_sma(df, 5, 10)
+
+
+def test_concurrent_reruns_share_the_cache():
+    # Sessions of the dashboard rerun from their own threads, each a few bars ahead of the others
+    df = frame()
+    cache = ChartCache(bars=100)
+    errors = []
+
+    def session(offset):
+        try:
+            for end in range(150 + offset, 300, 7):
+                assert sma_points(cache.series('AAPL', df.iloc[:end], 20)) == expected_sma(df.iloc[:end], 20, 100)
+        except AssertionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(offset,)) for offset in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
@@ -0,0 +1,101 @@
+import pytest
+from ib_insync import util
+
+import commands
+from commands import (EXIT_CONNECTION, EXIT_FAILED, EXIT_OK, EXIT_USAGE, exit_code, needs_connection,
+                      run_script_async, script_lines)
+
+
+def run(ib, *lines):
+    return util.run(run_script_async(ib, list(lines)))
+
+
+async def unreachable():
+    raise ConnectionError("Could not connect to IB Gateway")
+
+
+@pytest.mark.parametrize('line, code', [
+    ('help', EXIT_OK),
+    ('calculate_pos_size 10000 1 100 95 50 48', EXIT_OK),
+    ('calculate_pos_size 10000 1 100', EXIT_USAGE),
+    ('calculate_pos_size 10000 1 abc 95', EXIT_USAGE),
+    ('calculate_pos_size 10000 1 100 100', EXIT_FAILED),
+    ('no_such_command', EXIT_USAGE),
+    ('settings MODE=Live', EXIT_OK),
+    ('settings MODE=Demo', EXIT_USAGE),
+    ('settings PAPER_PORT=abc', EXIT_USAGE),
+    ('settings UNKNOWN=1', EXIT_USAGE),
+    ('backtest bars.csv fast=5:50:0', EXIT_USAGE),
+    ('fetch_balance', EXIT_CONNECTION),
+])
+def test_offline_exit_codes(line, code):
+    result, = run(unreachable, line)
+    assert result.code == code, result.error
+    assert result.ok == (code == EXIT_OK)
+    assert bool(result.error) == (code != EXIT_OK)
+
+
+def test_offline_results():
+    sizes, settings = run(None, 'calculate_pos_size 10000 1 100 95 50 48', 'settings MARKET_DATA_LINES=50')
+    assert [s['size'] for s in sizes.result] == [20, 50]
+    assert "Entry 100.0 with stop 95.0: 20 shares" in sizes.text
+    assert settings.result['MARKET_DATA_LINES'] == 50
+
+
+def test_settings_are_saved(settings_store):
+    run(None, 'settings MODE=Live LIVE_PORT=7496 risk.max_quantity=100')
+    assert settings_store.get('MODE') == 'Live' and settings_store.get('LIVE_PORT') == 7496
+    assert settings_store.get('RISK') == {'max_quantity': 100}
+    result, = run(None, 'settings risk.max_quantity=many')
+    assert result.code == EXIT_USAGE
+    assert settings_store.get('RISK') == {'max_quantity': 100}
+
+
+def test_malformed_arguments_are_usage_errors_before_any_request(ib):
+    results = run(ib, 'place_limit_order AAPL ten 150 BUY', 'place_limit_order AAPL 10 cheap BUY',
+                  'place_limit_order AAPL 10', 'get_order_status first', 'set_trailing_stop AAPL 10 -1%')
+    assert [r.code for r in results] == [EXIT_USAGE] * 5
+    assert not ib.trades()
+
+
+def test_connected_exit_codes(ib):
+    placed, missing = run(ib, 'place_limit_order AAPL 10 1.0 BUY', 'get_order_status 999999')
+    assert placed.code == EXIT_OK, placed.error
+    assert placed.result.orderStatus.status in ('PendingSubmit', 'Submitted')
+    assert missing.code == EXIT_FAILED and "999999" in missing.error
+    assert exit_code([placed, missing]) == EXIT_FAILED
+
+
+def test_cancel_of_an_order_ib_insync_does_not_know(ib, monkeypatch):
+    placed, = run(ib, 'place_limit_order AAPL 10 1.0 BUY')
+    monkeypatch.setattr(ib, 'cancelOrder', lambda order: None)
+    cancelled, = run(ib, f'cancel_order {placed.result.order.orderId}')
+    assert cancelled.code == EXIT_FAILED and str(placed.result.order.orderId) in cancelled.error
+
+
+def test_exit_code_is_the_highest_of_the_script():
+    assert exit_code([]) == EXIT_OK
+    assert exit_code(run(unreachable, 'help', 'fetch_balance', 'no_such_command')) == EXIT_CONNECTION
+
+
+def test_script_lines_and_connection_needs():
+    lines = ['# comment', '', 'help', 'fetch_balance  # trailing comment', 'exit', 'help']
+    assert list(script_lines(lines)) == ['help', 'fetch_balance  # trailing comment']
+    assert not needs_connection('help')
+    assert not needs_connection('calculate_pos_size 10000 1 100 95')
+    assert needs_connection('fetch_balance')
+    assert not needs_connection('no_such_command')
+
+
+def test_trail_stop_needs_a_session_that_keeps_running(ib, monkeypatch):
+    placed, = run(ib, 'set_stop_loss AAPL 10 1.0')
+    assert placed.code == EXIT_OK, placed.error
+    order_id = placed.result.order.orderId
+    refused, = run(ib, f'trail_stop {order_id} 1%')
+    assert refused.code == EXIT_FAILED and "interactive CLI" in refused.error
+
+    monkeypatch.setattr(commands, '_persistent', True)
+    trailed, = run(ib, f'trail_stop {order_id} 1%')
+    assert trailed.code == EXIT_OK, trailed.error
+    stop, = trailed.result
+    assert stop.min_tick == 0.01 and stop.stop_for(100.123) == 99.12
@@ -0,0 +1,26 @@
+import pytest
+from ib_insync import AccountValue
+
+from account import account_state
+from fanout import FanOut, Gateway
+from orders import Leg
+from risk import RiskLimits, check_legs
+
+
+def test_gateways_get_distinct_client_ids():
+    fanout = FanOut([Gateway('a', 4002), Gateway('b', 4002, account='DU2'), Gateway('c', 4001, client_id=41),
+                     Gateway('d', 4001)], factory=lambda g: None)
+    ids = [g.client_id for g in fanout.gateways.values()]
+    assert len(set(ids)) == 4 and ids[2] == 41
+    with pytest.raises(ValueError, match='used twice'):
+        FanOut([Gateway('a', 4002, client_id=40), Gateway('b', 4002, client_id=40)], factory=lambda g: None)
+
+
+def test_risk_checks_use_the_values_of_the_account(ib):
+    # A second, much smaller account on the same login
+    account_state(ib)._on_account_value(AccountValue('DU2', 'NetLiquidation', '1000', 'USD', ''))
+    legs = [Leg('AAPL', 10, 100.0)]
+    limits = RiskLimits(max_position_perc=25.0)
+    assert check_legs(ib, legs, limits).checks[0].passed
+    small, = check_legs(ib, legs, limits, account='DU2').checks
+    assert not small.passed and "net liquidation" in small.errors[0]
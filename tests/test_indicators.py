@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from indicators import IndicatorEngine, atr, ema, rsi, sma, vwap
+
+
+def history(symbols=3, bars=120, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (symbols, bars)), axis=1))
+    high = close * (1 + rng.uniform(0, 0.01, close.shape))
+    low = close * (1 - rng.uniform(0, 0.01, close.shape))
+    volume = rng.integers(100, 1000, close.shape).astype(float)
+    return high, low, close, volume
+
+
+def padded(bars, count):
+    """The bars with the first ``count`` of the last symbol replaced by NaN, as for a shorter history."""
+    bars = tuple(x.copy() for x in bars)
+    for x in bars:
+        x[-1, :count] = np.nan
+    return bars
+
+
+def test_sma_matches_a_plain_window_mean():
+    close = history()[2]
+    expected = np.array([[row[t - 4:t + 1].mean() if t >= 4 else np.nan for t in range(len(row))] for row in close])
+    np.testing.assert_allclose(sma(close, 5), expected)
+
+
+def test_shorter_histories_start_at_their_first_bar():
+    bars = history()
+    high, low, close, volume = padded(bars, 40)
+    tail = tuple(x[-1:, 40:] for x in bars)
+    for full, alone in [
+        (sma(close, 10), sma(tail[2], 10)),
+        (ema(close, 10), ema(tail[2], 10)),
+        (rsi(close, 14), rsi(tail[2], 14)),
+        (atr(high, low, close, 14), atr(*tail[:3], 14)),
+        (vwap(high, low, close, volume), vwap(*tail)),
+    ]:
+        assert np.isnan(full[-1, :40]).all()
+        np.testing.assert_allclose(full[-1:, 40:], alone)
+        # The other symbols are not affected by the padding
+        assert not np.isnan(full[:-1, -1]).any()
+
+
+@pytest.mark.parametrize('pad', [0, 50])
+def test_updates_give_the_columns_of_one_fit(pad):
+    bars = padded(history(), pad) if pad else history()
+    engine = IndicatorEngine(sma=(10, 20), ema=(12,), rsi=14, atr=14)
+    whole = IndicatorEngine(sma=(10, 20), ema=(12,), rsi=14, atr=14).fit(*bars)
+
+    engine.fit(*(x[:, :80] for x in bars))
+    for t in range(80, bars[2].shape[1]):
+        latest = engine.update(*(x[:, t] for x in bars))
+    assert engine.names == whole.names == ['SMA_10', 'SMA_20', 'EMA_12', 'RSI_14', 'ATR_14', 'VWAP']
+    for name in whole.names:
+        np.testing.assert_allclose(engine.column(name), whole.column(name), rtol=1e-9, equal_nan=True)
+        np.testing.assert_allclose(latest[name], whole.column(name)[:, -1], rtol=1e-9)
+
+
+def test_fit_needs_the_warmup_of_every_symbol():
+    engine = IndicatorEngine(sma=(50,))
+    with pytest.raises(ValueError):
+        engine.fit(*padded(history(bars=60), 20))
+    with pytest.raises(ValueError):
+        engine.update(*(x[:, 0] for x in history()))
@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+from ib_insync import LimitOrder
+
+from contracts import contract_registry
+from market_data import ticker_cache
+from orders import (Bracket, Leg, amend_limit_price_async, bracket_orders, is_warning, place_brackets_async,
+                    protect_positions_async, submit_batch, wait_for_amend)
+from risk import RiskLimits
+from simulator import SimConfig
+
+
+def market_price(ib, symbol):
+    async def price():
+        info = await contract_registry(ib).get_async(symbol)
+        return (await ticker_cache(ib).get_async(info.contract)).marketPrice()
+    return ib.run(price())
+
+
+def resting_order(ib, symbol='AAPL', price=1.0):
+    """A buy limit far below the market, acknowledged and left working."""
+    trade = ib.placeOrder(contract_registry(ib).contract(symbol), LimitOrder('BUY', 1, price))
+    ib.run(asyncio.sleep(0.05))
+    assert trade.orderStatus.status == 'Submitted'
+    return trade
+
+
+# Batches
+
+def test_batch_is_acknowledged(ib):
+    legs = [Leg('AAPL', 10, 1.0), Leg('msft', 5, 2.0, 'buy'), Leg('NVDA', 1, 1.5)]
+    batch = submit_batch(ib, legs, timeout=2.0)
+    assert [r.status for r in batch.results] == ['Submitted'] * 3
+    assert len(batch.acknowledged) == 3 and not batch.rejected
+    assert len({r.order_id for r in batch.results}) == 3
+    assert all(r.latency > 0 for r in batch.results)
+    assert "3/3 legs acknowledged" in batch.report()
+
+
+@pytest.mark.parametrize('sim_config', [SimConfig(latency=0.005, symbols=('AAPL', 'MSFT'))])
+def test_batch_rejects_legs_individually(ib):
+    legs = [Leg('AAPL', 10, 1.0), Leg('NOPE', 10, 1.0), Leg('MSFT', 1_000_000, 1.0)]
+    batch = submit_batch(ib, legs, timeout=2.0)
+    accepted, unknown, margin = batch.results
+    assert accepted.acknowledged
+    assert unknown.status == 'Rejected' and unknown.error == "Unknown contract" and unknown.trade is None
+    assert not margin.acknowledged
+    assert margin.status == 'Cancelled' and "YOUR ORDER IS NOT ACCEPTED" in margin.error
+    assert batch.rejected == [unknown, margin]
+
+
+def test_batch_risk_checks_reject_before_sending(ib):
+    legs = [Leg('AAPL', 10, 1.0), Leg('MSFT', 50, 1.0)]
+    batch = submit_batch(ib, legs, timeout=2.0, limits=RiskLimits(max_quantity=20))
+    accepted, refused = batch.results
+    assert accepted.acknowledged
+    assert refused.status == 'Rejected' and refused.trade is None and refused.error
+    assert [t.contract.symbol for t in ib.openTrades()] == ['AAPL']
+
+
+# Amending in place
+
+def test_amend_keeps_the_order_id(ib):
+    trade = resting_order(ib)
+    order_id, perm_id = trade.order.orderId, trade.order.permId
+    result = ib.run(amend_limit_price_async(ib, trade, 2.0, timeout=2.0))
+    assert result.acknowledged, result.error
+    assert (result.old_price, result.new_price) == (1.0, 2.0)
+    assert (trade.order.orderId, trade.order.permId, trade.order.lmtPrice) == (order_id, perm_id, 2.0)
+    assert len(ib.openTrades()) == 1
+
+
+def test_refused_amend_restores_the_old_price(ib):
+    trade = resting_order(ib)
+    result = ib.run(amend_limit_price_async(ib, trade, -1.0, timeout=2.0))
+    assert not result.acknowledged and result.error.startswith('201:')
+    assert trade.order.lmtPrice == 1.0
+
+
+def test_amend_of_a_done_order_is_refused(ib):
+    trade = resting_order(ib)
+    ib.cancelOrder(trade.order)
+    ib.run(asyncio.sleep(0.05))
+    result = ib.run(amend_limit_price_async(ib, trade, 2.0, timeout=2.0))
+    assert result.error == "Order is already Cancelled"
+
+
+def test_amend_ignores_warnings_and_stale_echoes(ib):
+    trade = resting_order(ib)
+    loop = asyncio.get_event_loop()
+
+    def echo(price):
+        trade.order.lmtPrice = price
+        ib.openOrderEvent.emit(trade)
+
+    async def amend():
+        waiting = asyncio.ensure_future(wait_for_amend(ib, trade, 2.0, 'lmtPrice', 2.0))
+        loop.call_soon(echo, 1.0)
+        loop.call_soon(ib.errorEvent.emit, trade.order.orderId, 399, "Order will be queued", None)
+        loop.call_later(0.05, echo, 2.0)
+        return await waiting
+
+    assert is_warning(399) and is_warning(2109) and not is_warning(201)
+    assert ib.run(amend()) == ''
+
+
+# Brackets and OCA exits
+
+def test_bracket_with_entry_is_one_transmit_group(ib):
+    orders = bracket_orders(ib, Bracket('AAPL', 10, entry=100.0, take_profit=110.0, stop=90.0))
+    entry, take_profit, stop = orders
+    assert [o.transmit for o in orders] == [False, False, True]
+    assert take_profit.parentId == stop.parentId == entry.orderId
+    assert not take_profit.ocaGroup and not stop.ocaGroup
+
+
+def test_exits_of_held_shares_are_each_transmitted(ib):
+    take_profit, stop = bracket_orders(ib, Bracket('AAPL', 10, 'SELL', take_profit=90.0, stop=110.0))
+    assert take_profit.transmit and stop.transmit
+    assert take_profit.parentId == stop.parentId == 0
+    assert take_profit.ocaGroup and take_profit.ocaGroup == stop.ocaGroup
+    assert (take_profit.action, stop.action) == ('BUY', 'BUY')
+
+
+def test_bracket_children_work_once_the_entry_fills(ib):
+    price = market_price(ib, 'AAPL')
+    bracket = Bracket('AAPL', 10, entry=round(price * 1.5, 2), take_profit=round(price * 3, 2),
+                      stop=round(price / 2, 2))
+    batch = ib.run(place_brackets_async(ib, [bracket], timeout=2.0))
+    result, = batch.results
+    assert result.acknowledged, result.error
+    entry, take_profit, stop = result.trades
+    ib.run(asyncio.sleep(0.05))
+    assert entry.orderStatus.status == 'Filled'
+    assert take_profit.orderStatus.status == stop.orderStatus.status == 'Submitted'
+
+
+@pytest.mark.parametrize('sim_config', [SimConfig(latency=0.005, fill_model='immediate')])
+def test_bracket_exit_filling_on_activation_cancels_the_other(ib):
+    batch = ib.run(place_brackets_async(ib, [Bracket('AAPL', 10, entry=100.0, take_profit=200.0, stop=50.0)],
+                                        timeout=2.0))
+    entry, *exits = batch.results[0].trades
+    ib.run(asyncio.sleep(0.05))
+    assert entry.orderStatus.status == 'Filled'
+    assert sorted(t.orderStatus.status for t in exits) == ['Cancelled', 'Filled']
+
+
+@pytest.mark.parametrize('sim_config', [SimConfig(latency=0.005, fill_model='never')])
+def test_bracket_children_wait_for_their_parent(ib):
+    batch = ib.run(place_brackets_async(ib, [Bracket('AAPL', 10, entry=1.0, take_profit=2.0, stop=0.5)],
+                                        timeout=2.0))
+    entry, take_profit, stop = batch.results[0].trades
+    assert entry.orderStatus.status == 'Submitted'
+    assert take_profit.orderStatus.status == stop.orderStatus.status == 'PreSubmitted'
+
+
+@pytest.mark.parametrize('sim_config', [SimConfig(latency=0.005, tick_interval=0.05, positions={'AAPL': (10, 100.0)})])
+def test_oca_exits_are_live_and_cancel_each_other(ib):
+    price = market_price(ib, 'AAPL')
+    bracket = Bracket('AAPL', 10, take_profit=round(price * 2, 2), stop=round(price / 2, 2))
+    batch = ib.run(place_brackets_async(ib, [bracket], timeout=2.0))
+    result, = batch.results
+    assert result.acknowledged, result.error
+    take_profit, stop = result.trades
+    assert take_profit.orderStatus.status == stop.orderStatus.status == 'Submitted'
+
+    # Pulling the take-profit below the market fills it, which cancels the stop
+    amended = ib.run(amend_limit_price_async(ib, take_profit, round(price / 2, 2), timeout=2.0))
+    assert amended.acknowledged, amended.error
+    ib.run(asyncio.sleep(0.1))
+    assert take_profit.orderStatus.status == 'Filled'
+    assert stop.orderStatus.status == 'Cancelled'
+    assert not ib.openTrades()
+
+
+@pytest.mark.parametrize('sim_config', [SimConfig(latency=0.005, positions={'AAPL': (10, 100.0), 'MSFT': (-5, 300.0)})])
+def test_protect_positions_once(ib):
+    batch = ib.run(protect_positions_async(ib, stop=5, timeout=2.0))
+    assert sorted((r.bracket.symbol, r.bracket.exit_action) for r in batch.results) == [('AAPL', 'SELL'),
+                                                                                          ('MSFT', 'BUY')]
+    assert all(r.acknowledged for r in batch.results), batch.report()
+    for result in batch.results:
+        stop = result.trades[0].order.auxPrice
+        assert round(stop, 2) == stop
+    # Every position has a working stop now
+    again = ib.run(protect_positions_async(ib, stop=5, timeout=2.0))
+    assert not again.results and not again.skipped
@@ -0,0 +1,23 @@
+import asyncio
+
+from pacing import request_scheduler
+
+
+def test_each_event_loop_gets_its_own_scheduler(ib):
+    scheduler = request_scheduler(ib)
+    ib.run(scheduler.acquire('order'))
+
+    async def elsewhere():
+        # Like a dashboard thread running its own loop over the same connection
+        other = request_scheduler(ib)
+        await asyncio.gather(*(other.acquire('market_data') for _ in range(3)))
+        return other
+
+    loop = asyncio.new_event_loop()
+    try:
+        other = loop.run_until_complete(elsewhere())
+    finally:
+        loop.close()
+    assert other is not scheduler
+    assert request_scheduler(ib) is scheduler
+    ib.run(scheduler.acquire('order'))
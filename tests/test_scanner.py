@@ -0,0 +1,40 @@
+import asyncio
+
+from contracts import contract_registry
+from market_data import ticker_cache
+from scanner import Scanner, parse_filter
+
+
+def test_scan_leaves_the_cache_subscriptions_alone(ib):
+    cache = ticker_cache(ib)
+    contract = contract_registry(ib).contract('AAPL')
+    cached = cache.ticker(contract)
+    msft_contract = contract_registry(ib).contract('MSFT')
+    scanner = Scanner(ib)
+
+    async def scan():
+        scanning = asyncio.ensure_future(scanner.scan_async(['AAPL', 'MSFT', 'NVDA'], [parse_filter('spread>=0')]))
+        while not any(t.contract.symbol == 'MSFT' for t in ib.tickers()):
+            await asyncio.sleep(0.001)
+        # The cache subscribes MSFT while the scan holds a line for it
+        msft = cache.ticker(msft_contract)
+        return await scanning, msft
+
+    result, msft = ib.run(scan())
+    assert int(result.mask.sum()) == 3
+    assert len(cache) == 2 and contract in cache
+    assert cache.ticker(contract) is cached
+    # The scan's own lines are gone, the cache's still stream
+    streaming = ib.gateway._subscriptions
+    assert sorted(streaming.values()) == ['AAPL', 'MSFT']
+    assert ib.wrapper.ticker2ReqId['mktData'][msft] in {req_id for _, req_id in streaming}
+
+
+def test_scan_lines_are_counted_when_it_starts(ib):
+    scanner = Scanner(ib)
+    assert scanner.lines is None
+    cache = ticker_cache(ib)
+    for symbol in ('AAPL', 'MSFT'):
+        cache.ticker(contract_registry(ib).contract(symbol))
+    result = ib.run(scanner.scan_async(['NVDA']))
+    assert not result.missing and len(result.mask) == 1
@@ -0,0 +1,92 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from contracts import contract_registry
+from sessions import MarketStatus, exchange_zone, parse_hours, session_calendar
+
+ET = ZoneInfo('US/Eastern')
+
+
+def et(*args):
+    return datetime.datetime(*args, tzinfo=ET).timestamp()
+
+
+def test_parse_hours_current_format():
+    sessions = parse_hours('20240506:0930-20240506:1600;20240507:CLOSED;20240508:0930-20240508:1600', 'US/Eastern')
+    assert len(sessions) == 2
+    assert sessions.is_open(et(2024, 5, 6, 9, 30))
+    assert sessions.is_open(et(2024, 5, 6, 15, 59))
+    assert not sessions.is_open(et(2024, 5, 6, 16, 0))
+    assert not sessions.is_open(et(2024, 5, 7, 12, 0))
+    assert sessions.next_open(et(2024, 5, 6, 17, 0)) == et(2024, 5, 8, 9, 30)
+    assert sessions.next_close(et(2024, 5, 6, 12, 0)) == et(2024, 5, 6, 16, 0)
+    assert sessions.next_close(et(2024, 5, 7, 12, 0)) == et(2024, 5, 8, 16, 0)
+    assert sessions.next_open(et(2024, 5, 8, 17, 0)) is None
+
+
+def test_parse_hours_older_format_with_several_ranges():
+    sessions = parse_hours('20240506:0930-1600,1700-1800', 'EST (Eastern Standard Time)')
+    assert sessions.zone == ET
+    assert sessions.opens.tolist() == [et(2024, 5, 6, 9, 30), et(2024, 5, 6, 17, 0)]
+    assert sessions.closes.tolist() == [et(2024, 5, 6, 16, 0), et(2024, 5, 6, 18, 0)]
+    assert sessions.mask([et(2024, 5, 6, 10), et(2024, 5, 6, 16, 30), et(2024, 5, 6, 17, 30)]).tolist() \
+        == [True, False, True]
+
+
+def test_parse_hours_overnight_and_overlapping_sessions():
+    overnight = parse_hours('20240506:1800-0500', 'US/Eastern')
+    assert overnight.is_open(et(2024, 5, 7, 4, 0))
+    assert overnight.next_close(et(2024, 5, 6, 20, 0)) == et(2024, 5, 7, 5, 0)
+
+    merged = parse_hours('20240506:0930-20240506:1600;20240506:0400-20240506:2000', 'US/Eastern')
+    assert len(merged) == 1
+    assert (merged.opens[0], merged.closes[0]) == (et(2024, 5, 6, 4, 0), et(2024, 5, 6, 20, 0))
+
+
+@pytest.mark.parametrize('hours', ['', None, '20240506:CLOSED;20240507:CLOSED'])
+def test_parse_hours_without_sessions(hours):
+    sessions = parse_hours(hours, 'US/Eastern')
+    assert len(sessions) == 0
+    assert not sessions.is_open(et(2024, 5, 6, 12, 0))
+    assert sessions.next_open(et(2024, 5, 6, 12, 0)) is None
+    assert not sessions.mask([et(2024, 5, 6, 12, 0)]).any()
+
+
+def test_unknown_time_zone_is_utc():
+    moment = datetime.datetime(2024, 5, 6, 12, 0)
+    assert exchange_zone('Not/AZone') == datetime.timezone.utc
+    assert exchange_zone(None).utcoffset(moment) == datetime.timedelta(0)
+
+
+def test_market_status_summary():
+    close = datetime.datetime(2024, 5, 6, 16, 0, tzinfo=ET)
+    assert MarketStatus('AAPL', True, True, next_close=close).summary() == \
+        "open (regular hours) until 2024-05-06 16:00 EDT"
+    assert MarketStatus('AAPL', True, False).summary() == "open (extended hours)"
+    assert MarketStatus('AAPL', False, False, next_open=close).summary() == "closed until 2024-05-06 16:00 EDT"
+    assert MarketStatus('AAPL', False, False).summary() == "closed"
+
+
+def test_calendar_status_from_the_simulated_contract(ib):
+    # The simulated exchange trades 04:00-20:00 ET on weekdays, 09:30-16:00 regular
+    today = datetime.datetime.now(ET).date()
+    day = next(today + datetime.timedelta(days=i) for i in range(1, 7)
+               if (today + datetime.timedelta(days=i)).weekday() < 5)
+    info = contract_registry(ib).get('AAPL')
+    calendar = session_calendar(ib)
+
+    def at(hour):
+        return datetime.datetime.combine(day, datetime.time(hour), ET).timestamp()
+
+    regular = calendar.status(info, at(10))
+    assert (regular.open, regular.regular) == (True, True)
+    assert regular.next_close == datetime.datetime.combine(day, datetime.time(16), ET)
+    extended = calendar.status(info, at(5))
+    assert (extended.open, extended.regular) == (True, False)
+    assert extended.next_close == datetime.datetime.combine(day, datetime.time(20), ET)
+    closed = calendar.status(info, at(21))
+    assert not closed.open
+    assert closed.next_open is None or closed.next_open.timestamp() > at(21)
+    assert calendar.open_mask([info, None], at(10)).tolist() == [True, False]
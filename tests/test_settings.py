@@ -0,0 +1,74 @@
+import json
+import shelve
+import threading
+
+from settings import SettingsStore
+
+
+def update_concurrently(stores, count=25):
+    """Each thread writes its own keys through one of the stores."""
+    def writer(i, store):
+        for n in range(count):
+            store.update({f'writer{i}.{n}': n})
+
+    threads = [threading.Thread(target=writer, args=(i, store)) for i, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_updates_through_one_store(tmp_path):
+    store = SettingsStore(tmp_path / 'settings.json', legacy=None)
+    update_concurrently([store] * 8)
+    assert len(store.load()) == 8 * 25
+
+
+def test_concurrent_updates_through_separate_stores(tmp_path):
+    # Like the dashboard, the CLI and the recorder each holding their own store of the same file
+    path = tmp_path / 'settings.json'
+    update_concurrently([SettingsStore(path, legacy=None) for _ in range(8)])
+    with open(path) as f:
+        values = json.load(f)
+    assert len(values) == 8 * 25
+    assert SettingsStore(path, legacy=None).load() == values
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_update_keeps_changes_of_other_stores(tmp_path):
+    path = tmp_path / 'settings.json'
+    dashboard, cli = SettingsStore(path, legacy=None), SettingsStore(path, legacy=None)
+    assert dashboard.load() == {}
+    cli.update(MODE='Live')
+    assert dashboard.get('MODE') == 'Live'
+    dashboard.update(PAPER_PORT=4002)
+    cli.update({'RISK': {'max_quantity': 10}}, remove=['MODE'])
+    assert dashboard.load() == {'PAPER_PORT': 4002, 'RISK': {'max_quantity': 10}}
+
+
+def test_load_is_cached_until_the_file_changes(tmp_path):
+    store = SettingsStore(tmp_path / 'settings.json', legacy=None)
+    store.update(MODE='Paper')
+    first = store.load()
+    assert store.load() is first
+    SettingsStore(tmp_path / 'settings.json', legacy=None).update(MODE='Live')
+    assert store.load() is not first and store.get('MODE') == 'Live'
+
+
+def test_legacy_settings_are_read_until_the_first_update(tmp_path):
+    legacy = str(tmp_path / 'config.db')
+    with shelve.open(legacy) as db:
+        db['settings'] = {'MODE': 'Live', 'LIVE_PORT': 7496}
+    store = SettingsStore(tmp_path / 'settings.json', legacy=legacy)
+    assert store.load() == {'MODE': 'Live', 'LIVE_PORT': 7496}
+    store.update(MODE='Paper')
+    with open(tmp_path / 'settings.json') as f:
+        assert json.load(f) == {'MODE': 'Paper', 'LIVE_PORT': 7496}
+
+
+def test_unreadable_file_keeps_the_last_values(tmp_path):
+    path = tmp_path / 'settings.json'
+    store = SettingsStore(path, legacy=None)
+    store.update(MODE='Live')
+    path.write_text('{not json')
+    assert store.get('MODE') == 'Live'